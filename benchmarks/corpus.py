@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Deterministic generator of synthetic Fortran sources for benchmarks.
+
+Each scenario stresses one dimension that formatting time scales with. A
+scenario is a function `scenario(n_lines, rng)` returning unformatted Fortran
+code of roughly `n_lines` lines, `rng` is a `random.Random` instance so that
+the same seed always gives the same code.
+"""
+
+import random
+
+DEFAULT_SEED = 1
+
+_OPERATORS = ["+", "-", "*", "/", "**", "==", "<", ">="]
+_TYPES = ["integer", "real(dp)", "logical", "complex(dp)", "character(len=16)"]
+
+
+def _name(rng, prefix="v"):
+    return "{}{}".format(prefix, rng.randrange(100))
+
+
+def _expression(rng, n_terms):
+    terms = [_name(rng)]
+    for _ in range(n_terms - 1):
+        terms.append(rng.choice(_OPERATORS[:5]))
+        terms.append(rng.choice([_name(rng), str(rng.randrange(1, 10))]))
+    return "".join(terms)
+
+
+def _statement(rng):
+    kind = rng.randrange(4)
+    if kind == 0:
+        return "{}={}".format(_name(rng), _expression(rng, rng.randrange(1, 6)))
+    if kind == 1:
+        return "call {}({},{})".format(_name(rng, "sub"), _name(rng), _name(rng))
+    if kind == 2:
+        return "print*,{},{}".format(_name(rng), _expression(rng, 3))
+    return "{}(i,j)={}(j,i)*{}".format(_name(rng, "a"), _name(rng, "b"), _name(rng))
+
+
+def _procedure(name, body):
+    return ["subroutine {}()".format(name)] + body + ["end subroutine"]
+
+
+def _module(name, procedures):
+    lines = ["module {}".format(name), "implicit none", "contains"]
+    for procedure in procedures:
+        lines.extend(procedure)
+    lines.append("end module")
+    return "\n".join(lines) + "\n"
+
+
+def long_file(n_lines, rng):
+    """many short procedures of simple statements"""
+    procedures = []
+    n_procedure = 0
+    while sum(map(len, procedures)) < n_lines:
+        body = [_statement(rng) for _ in range(rng.randrange(5, 30))]
+        procedures.append(_procedure("s{}".format(n_procedure), body))
+        n_procedure += 1
+    return _module("long_file", procedures)
+
+
+def deep_nesting(n_lines, rng, depth=20):
+    """deeply nested loops and conditionals"""
+    procedures = []
+    n_procedure = 0
+    while sum(map(len, procedures)) < n_lines:
+        opening, closing = [], []
+        for level in range(depth):
+            if level % 2:
+                opening.append("if({}>{})then".format(_name(rng), level))
+                closing.append("endif")
+            else:
+                opening.append("do i{}=1,{}".format(level, rng.randrange(2, 9)))
+                closing.append("enddo")
+            opening.append(_statement(rng))
+        body = opening + closing[::-1]
+        procedures.append(_procedure("s{}".format(n_procedure), body))
+        n_procedure += 1
+    return _module("deep_nesting", procedures)
+
+
+def continuations(n_lines, rng, length=40):
+    """long chains of continuation lines"""
+    body = []
+    while len(body) < n_lines:
+        body.append("x=[ &")
+        for _ in range(length - 1):
+            body.append("{},{}, &".format(_expression(rng, 3), _name(rng)))
+        body.append("{}]".format(_name(rng)))
+        body.append("call {}(a,&".format(_name(rng, "sub")))
+        for _ in range(length // 4):
+            body.append("&{}*(&".format(_name(rng)))
+            body.append("{}),&".format(_expression(rng, 4)))
+        body.append("b)")
+    return _module("continuations", [_procedure("s", body)])
+
+
+def long_strings(n_lines, rng, length=80):
+    """long string literals containing operators, delimiters and quotes"""
+    chars = "abc xyz+-*/=<>(),;:!'\"%"
+    body = []
+    while len(body) < n_lines:
+        text = "".join(rng.choice(chars) for _ in range(length))
+        if rng.randrange(2):
+            literal = "'{}'".format(text.replace("'", "''"))
+        else:
+            literal = '"{}"'.format(text.replace('"', '""'))
+        body.append("msg={}//{}".format(literal, _name(rng)))
+        body.append("print*,{},{}".format(_name(rng), literal))
+    return _module("long_strings", [_procedure("s", body)])
+
+
+def fypp(n_lines, rng):
+    """code with many fypp preprocessor directives"""
+    lines = ["module fypp_heavy", "implicit none", "contains"]
+    n_procedure = 0
+    while len(lines) < n_lines:
+        kinds = ", ".join("'{}'".format(_) for _ in ("sp", "dp", "qp"))
+        lines.extend(
+            [
+                "#:for kind in [{}]".format(kinds),
+                "subroutine s{}_${{kind}}$(x)".format(n_procedure),
+                "real(${kind}$)::x",
+                "#:if kind == 'dp'",
+                "x=x+{}".format(_expression(rng, 3)),
+                "#:else",
+                "@:assert(x>0)",
+                "$:debug_code('x = {}')".format(_name(rng)),
+                "#:endif",
+            ]
+        )
+        lines.extend(_statement(rng) for _ in range(rng.randrange(2, 6)))
+        lines.extend(["end subroutine", "#:endfor"])
+        n_procedure += 1
+    lines.append("end module")
+    return "\n".join(lines) + "\n"
+
+
+def openmp(n_lines, rng):
+    """loops with OpenMP directives and conditional compilation lines"""
+    body = []
+    while len(body) < n_lines:
+        body.extend(
+            [
+                "!$omp parallel do private(i,j) reduction(+:{})".format(_name(rng)),
+                "do i=1,n",
+                "!$ tid=omp_get_thread_num()",
+                "do j=1,m",
+                _statement(rng),
+                "!$omp atomic",
+                "{}={}+1".format(_name(rng), _name(rng)),
+                "enddo",
+                "enddo",
+                "!$omp end parallel do",
+            ]
+        )
+    return _module("openmp", [_procedure("s", body)])
+
+
+def data_tables(n_lines, rng, width=8):
+    """large DATA statements with tables of constants"""
+    body = []
+    while len(body) < n_lines:
+        rows = []
+        for _ in range(rng.randrange(10, 40)):
+            values = ["{:.4f}".format(rng.uniform(-1e3, 1e3)) for _ in range(width)]
+            rows.append(",".join(values))
+        body.append("data {}/ &".format(_name(rng, "table")))
+        body.extend(row + ", &" for row in rows[:-1])
+        body.append(rows[-1] + "/")
+    return _module("data_tables", [_procedure("s", body)])
+
+
+def wide_declarations(n_lines, rng, width=12):
+    """declarations of many entities with attributes and initializers"""
+    body = []
+    while len(body) < n_lines:
+        entities = []
+        for _ in range(width):
+            entity = _name(rng)
+            if rng.randrange(2):
+                entity += "(n,{})".format(rng.randrange(1, 9))
+            elif rng.randrange(2):
+                entity += "={}".format(rng.randrange(100))
+            entities.append(entity)
+        attributes = rng.sample(["allocatable", "save", "target", "volatile"], 2)
+        body.append(
+            "{},{}::{}".format(
+                rng.choice(_TYPES), ",".join(attributes), ",".join(entities)
+            )
+        )
+    return _module("wide_declarations", [_procedure("s", body)])
+
+
+SCENARIOS = {
+    "long_file": long_file,
+    "deep_nesting": deep_nesting,
+    "continuations": continuations,
+    "long_strings": long_strings,
+    "fypp": fypp,
+    "openmp": openmp,
+    "data_tables": data_tables,
+    "wide_declarations": wide_declarations,
+}
+
+
+def generate(scenario, n_lines, seed=DEFAULT_SEED):
+    """Fortran code of scenario `scenario` of about `n_lines` lines"""
+    return SCENARIOS[scenario](n_lines, random.Random(seed))
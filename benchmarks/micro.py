@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Micro-benchmarks of single formatting stages.
+
+A micro-benchmark is a function `benchmark(size)` returning a function without
+arguments that runs the benchmarked code once on input of size `size` (in the
+units given in MICRO_BENCHMARKS). Each benchmark is run for several sizes so
+that the scaling with the input size can be checked.
+"""
+
+import io
+
+import fprettify
+from fprettify.fparse_utils import CharFilter
+
+_CODE_STMT = "a(i,j)=b(j,i)*c%d+f(x,y,z)/2.0_dp"
+_STRING_STMT = "print*,'a = ',a,\"b(i) = \",b(i),'it''s',x//'y'"
+
+
+def _charfilter(line, spans=False):
+    if spans:
+        return lambda: CharFilter(line).spans()
+    return lambda: list(CharFilter(line))
+
+
+def charfilter_code(size):
+    """CharFilter iteration of a line of `size` code statements"""
+    return _charfilter(";".join([_CODE_STMT] * size))
+
+
+def charfilter_strings(size):
+    """CharFilter iteration of a line of `size` statements with strings"""
+    return _charfilter(";".join([_STRING_STMT] * size))
+
+
+def charfilter_spans(size):
+    """CharFilter spans of a line of `size` statements with strings"""
+    return _charfilter(";".join([_STRING_STMT] * size), spans=True)
+
+
+def charfilter_long_string(size):
+    """CharFilter iteration of a string literal of `size` characters"""
+    return _charfilter("x='{}'".format("a+b, c" * (size // 6)))
+
+
+def _array_elements(size):
+    return ["x({0})*2+f({0},j)".format(i) for i in range(size)]
+
+
+def whitespace_array(size):
+    """whitespace formatting of a line with an array constructor of `size` elements"""
+    line = "y=[{}]".format(",".join(_array_elements(size)))
+    style = fprettify.FormatStyle()
+    scope_parser = fprettify.build_scope_parser()
+
+    def run():
+        return fprettify.add_whitespace_charwise(
+            line, style.spacey, scope_parser, style.format_decl, "micro", 1
+        )
+
+    return run
+
+
+def reformat_array(size):
+    """
+    reformat_ffile of an array constructor of `size` elements continued over
+    lines of 10 elements
+    """
+    elements = _array_elements(size)
+    lines = [",".join(elements[i : i + 10]) for i in range(0, size, 10)]
+    code = "program p\ny=[{}]\nend program\n".format(",&\n".join(lines))
+
+    def run():
+        outfile = io.StringIO()
+        fprettify.reformat_ffile(io.StringIO(code), outfile, orig_filename="micro")
+        return outfile.getvalue()
+
+    return run
+
+
+# name: (benchmark, unit of size, default sizes)
+MICRO_BENCHMARKS = {
+    "charfilter_code": (charfilter_code, "stmts", (1, 10, 100)),
+    "charfilter_strings": (charfilter_strings, "stmts", (1, 10, 100)),
+    "charfilter_spans": (charfilter_spans, "stmts", (1, 10, 100)),
+    "charfilter_long_string": (charfilter_long_string, "chars", (80, 800, 8000)),
+    "whitespace_array": (whitespace_array, "elems", (500, 1000, 2000, 4000)),
+    "reformat_array": (reformat_array, "elems", (500, 1000, 2000, 4000)),
+}
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Benchmark runner: formats each scenario of the synthetic corpus with each
+preset of formatting options and reports lines/sec and bytes/sec, and runs
+micro-benchmarks of single formatting stages for several input sizes.
+
+Results are stored as JSON (by default in benchmarks/results, named after the
+current git commit) so that they can be compared across commits with
+`--compare`.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import fprettify
+from benchmarks.corpus import DEFAULT_SEED, SCENARIOS, generate
+from benchmarks.micro import MICRO_BENCHMARKS
+
+RESULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# presets of command line options
+PRESETS = {
+    "whitespace-0": ["--whitespace", "0"],
+    "whitespace-1": ["--whitespace", "1"],
+    "whitespace-2": ["--whitespace", "2"],
+    "whitespace-3": ["--whitespace", "3"],
+    "whitespace-4": ["--whitespace", "4"],
+    "case": ["--case", "1", "1", "1", "1"],
+    "enable-decl": ["--enable-decl"],
+}
+
+
+def _git_commit():
+    """short hash of the current git commit, None if not available"""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode("ascii").strip()
+
+
+def run_benchmarks(scenarios, presets, n_lines, repeat=3, seed=DEFAULT_SEED):
+    """
+    benchmark formatting of scenarios `scenarios` of about `n_lines` lines with
+    option presets `presets`, the best of `repeat` runs counts.
+    Returns list of results (dicts).
+    """
+    parser = fprettify.get_arg_parser()
+    results = []
+    for scenario in scenarios:
+        text = generate(scenario, n_lines, seed)
+        n_lines_text = text.count("\n")
+        n_bytes = len(text.encode("utf-8"))
+        for preset in presets:
+            kwargs = fprettify.process_args(parser.parse_args(PRESETS[preset]))
+            seconds = float("inf")
+            for _ in range(repeat):
+                outfile = io.StringIO()
+                start = time.perf_counter()
+                fprettify.reformat_ffile(
+                    io.StringIO(text), outfile, orig_filename=scenario, **kwargs
+                )
+                seconds = min(seconds, time.perf_counter() - start)
+            results.append(
+                {
+                    "scenario": scenario,
+                    "preset": preset,
+                    "lines": n_lines_text,
+                    "bytes": n_bytes,
+                    "seconds": seconds,
+                    "lines_per_sec": n_lines_text / seconds,
+                    "bytes_per_sec": n_bytes / seconds,
+                }
+            )
+    return results
+
+
+def run_micro_benchmarks(names, repeat=3, sizes=None):
+    """
+    run micro-benchmarks `names` for their default sizes (or for `sizes`),
+    the best of `repeat` runs counts. Returns list of results (dicts).
+    """
+    results = []
+    for name in names:
+        benchmark, unit, default_sizes = MICRO_BENCHMARKS[name]
+        for size in sizes or default_sizes:
+            timer = timeit.Timer(benchmark(size))
+            number, _ = timer.autorange()
+            seconds = min(timer.repeat(repeat, number)) / number
+            results.append(
+                {
+                    "benchmark": name,
+                    "size": size,
+                    "unit": unit,
+                    "seconds": seconds,
+                    "us_per_unit": seconds / size * 1e6,
+                }
+            )
+    return results
+
+
+def write_report(results, reference=None, outfile=None):
+    """
+    write table of `results`, with the speedup (in bytes/sec) w.r.t. results
+    `reference` (of the same scenarios and presets) if given
+    """
+    outfile = outfile or sys.stdout
+    reference = {(_["scenario"], _["preset"]): _ for _ in reference or []}
+    header = "{:<18} {:<13} {:>7} {:>9} {:>10} {:>11}".format(
+        "scenario", "preset", "lines", "bytes", "lines/s", "bytes/s"
+    )
+    if reference:
+        header += " {:>8}".format("speedup")
+    outfile.write(header + "\n")
+    for result in results:
+        line = "{scenario:<18} {preset:<13} {lines:>7} {bytes:>9} ".format(**result)
+        line += "{:>10.0f} {:>11.0f}".format(
+            result["lines_per_sec"], result["bytes_per_sec"]
+        )
+        ref = reference.get((result["scenario"], result["preset"]))
+        if ref:
+            speedup = result["bytes_per_sec"] / ref["bytes_per_sec"]
+            line += " {:>8.2f}".format(speedup)
+        outfile.write(line + "\n")
+
+
+def write_micro_report(results, reference=None, outfile=None):
+    """
+    write table of micro-benchmark `results`, with the speedup w.r.t. results
+    `reference` if given. Time per unit of size is constant for linear
+    scaling.
+    """
+    outfile = outfile or sys.stdout
+    reference = {(_["benchmark"], _["size"]): _ for _ in reference or []}
+    header = "{:<24} {:>7} {:<6} {:>12} {:>10}".format(
+        "benchmark", "size", "unit", "time/us", "us/unit"
+    )
+    if reference:
+        header += " {:>8}".format("speedup")
+    outfile.write(header + "\n")
+    for result in results:
+        line = "{benchmark:<24} {size:>7} {unit:<6} ".format(**result)
+        line += "{:>12.1f} {:>10.3f}".format(
+            result["seconds"] * 1e6, result["us_per_unit"]
+        )
+        ref = reference.get((result["benchmark"], result["size"]))
+        if ref:
+            line += " {:>8.2f}".format(ref["seconds"] / result["seconds"])
+        outfile.write(line + "\n")
+
+
+def main(argv=sys.argv[1:]):
+    """command line interface of the benchmarks, returns exit status"""
+    parser = argparse.ArgumentParser(
+        description="Run fprettify benchmarks on a synthetic Fortran corpus.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="Scenarios to run (repeat option for several), default: all",
+    )
+    parser.add_argument(
+        "--preset",
+        action="append",
+        choices=list(PRESETS),
+        help="Presets of formatting options (repeat option for several), "
+        "default: all",
+    )
+    parser.add_argument(
+        "--micro",
+        action="append",
+        choices=list(MICRO_BENCHMARKS),
+        help="Micro-benchmarks to run (repeat option for several), default: all",
+    )
+    parser.add_argument(
+        "--size",
+        action="append",
+        type=int,
+        help="Input sizes of micro-benchmarks (repeat option for several), "
+        "default: depending on benchmark",
+    )
+    parser.add_argument(
+        "--lines", type=int, default=1000, help="Approximate lines per scenario"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per benchmark, the best counts"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=DEFAULT_SEED, help="Seed of the corpus"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="JSON file to store results in, default: {} named after the "
+        "git commit".format(os.path.relpath(RESULT_DIR)),
+    )
+    parser.add_argument(
+        "--compare", type=str, help="JSON file of previous results to compare with"
+    )
+    args = parser.parse_args(argv)
+
+    fprettify.set_fprettify_logger(logging.ERROR)
+
+    reference = None
+    reference_micro = None
+    if args.compare:
+        with io.open(args.compare, "r", encoding="utf-8") as f:
+            reference = json.load(f)
+        reference_micro = reference.get("micro")
+        reference = reference["results"]
+
+    commit = _git_commit()
+    results = run_benchmarks(
+        args.scenario or list(SCENARIOS),
+        args.preset or list(PRESETS),
+        args.lines,
+        args.repeat,
+        args.seed,
+    )
+    write_report(results, reference)
+    sys.stdout.write("\n")
+    micro = run_micro_benchmarks(
+        args.micro or list(MICRO_BENCHMARKS), args.repeat, args.size
+    )
+    write_micro_report(micro, reference_micro)
+
+    output = args.output
+    if output is None:
+        output = os.path.join(RESULT_DIR, (commit or "results") + ".json")
+        if not os.path.isdir(RESULT_DIR):
+            os.mkdir(RESULT_DIR)
+    with io.open(output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "lines": args.lines,
+                "repeat": args.repeat,
+                "seed": args.seed,
+                "results": results,
+                "micro": micro,
+            },
+            f,
+            indent=1,
+        )
+    sys.stdout.write("results written to {}\n".format(output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -66,23 +66,19 @@ FIXME's
 - open files only when needed
 """
 
+import argparse
+import bisect
+import contextlib
 import io
+import json
 import logging
 import os
 import re
 import shlex
 import sys
-
-try:
-    import configargparse as argparse
-except ImportError:
-    import argparse
-
-sys.stdin = io.TextIOWrapper(sys.stdin.detach(), encoding="UTF-8", line_buffering=True)
-sys.stdout = io.TextIOWrapper(
-    sys.stdout.detach(), encoding="UTF-8", line_buffering=True
-)
-
+import time
+from collections import OrderedDict, deque
+from itertools import accumulate, chain, islice
 
 from .fparse_utils import (
     CPP_RE,
@@ -100,8 +96,10 @@ from .fparse_utils import (
     FprettifyInternalException,
     FprettifyParseException,
     InputStream,
+    LazyRegex,
     parser_re,
 )
+from .profiling import PhaseProfiler, SlowLines
 
 # recognize fortran files by extension
 FORTRAN_EXTENSIONS = [".f", ".for", ".ftn", ".f90", ".f95", ".f03", ".fpp"]
@@ -115,117 +113,128 @@ LINESPLIT_MESSAGE = (
     "auto indentation failed due to chars limit, " "line should be split"
 )
 
-EOL_STR = r"\s*;?\s*$"  # end of fortran line
+EOL_STR = r"\s*(?:;\s*)?$"  # end of fortran line
 EOL_SC = r"\s*;\s*$"  # whether line is ended with semicolon
 SOL_STR = r"^\s*"  # start of fortran line
 
-STATEMENT_LABEL_RE = re.compile(r"^\s*(\d+\s)(?!" + EOL_STR + ")", RE_FLAGS)
+STATEMENT_LABEL_RE = LazyRegex(r"^\s*(\d+\s)(?!" + EOL_STR + ")", RE_FLAGS)
 
 # regular expressions for parsing statements that start, continue or end a
 # subunit:
-IF_RE = re.compile(SOL_STR + r"(\w+\s*:)?\s*IF\s*\(.*\)\s*THEN" + EOL_STR, RE_FLAGS)
-ELSE_RE = re.compile(SOL_STR + r"ELSE(\s*IF\s*\(.*\)\s*THEN)?" + EOL_STR, RE_FLAGS)
-ENDIF_RE = re.compile(SOL_STR + r"END\s*IF(\s+\w+)?" + EOL_STR, RE_FLAGS)
+IF_RE = LazyRegex(SOL_STR + r"(\w+\s*:)?\s*IF\s*\(.*\)\s*THEN" + EOL_STR, RE_FLAGS)
+ELSE_RE = LazyRegex(SOL_STR + r"ELSE(\s*IF\s*\(.*\)\s*THEN)?" + EOL_STR, RE_FLAGS)
+ENDIF_RE = LazyRegex(SOL_STR + r"END\s*IF(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-DO_RE = re.compile(SOL_STR + r"(\w+\s*:)?\s*DO(" + EOL_STR + r"|\s+\w)", RE_FLAGS)
-ENDDO_RE = re.compile(SOL_STR + r"END\s*DO(\s+\w+)?" + EOL_STR, RE_FLAGS)
+DO_RE = LazyRegex(SOL_STR + r"(\w+\s*:)?\s*DO(" + EOL_STR + r"|\s+\w)", RE_FLAGS)
+ENDDO_RE = LazyRegex(SOL_STR + r"END\s*DO(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-SELCASE_RE = re.compile(
+SELCASE_RE = LazyRegex(
     SOL_STR + r"SELECT\s*(CASE|RANK|TYPE)\s*\(.*\)" + EOL_STR, RE_FLAGS
 )
-CASE_RE = re.compile(
+CASE_RE = LazyRegex(
     SOL_STR
     + r"((CASE|RANK|TYPE\s+IS|CLASS\s+IS)\s*(\(.*\)|DEFAULT)|CLASS\s+DEFAULT)"
     + EOL_STR,
     RE_FLAGS,
 )
-ENDSEL_RE = re.compile(SOL_STR + r"END\s*SELECT" + EOL_STR, RE_FLAGS)
+ENDSEL_RE = LazyRegex(SOL_STR + r"END\s*SELECT" + EOL_STR, RE_FLAGS)
 
-ASSOCIATE_RE = re.compile(SOL_STR + r"ASSOCIATE\s*\(.*\)" + EOL_STR, RE_FLAGS)
-ENDASSOCIATE_RE = re.compile(SOL_STR + r"END\s*ASSOCIATE" + EOL_STR, RE_FLAGS)
+ASSOCIATE_RE = LazyRegex(SOL_STR + r"ASSOCIATE\s*\(.*\)" + EOL_STR, RE_FLAGS)
+ENDASSOCIATE_RE = LazyRegex(SOL_STR + r"END\s*ASSOCIATE" + EOL_STR, RE_FLAGS)
 
-BLK_RE = re.compile(SOL_STR + r"(\w+\s*:)?\s*BLOCK" + EOL_STR, RE_FLAGS)
-ENDBLK_RE = re.compile(SOL_STR + r"END\s*BLOCK(\s+\w+)?" + EOL_STR, RE_FLAGS)
+BLK_RE = LazyRegex(SOL_STR + r"(\w+\s*:)?\s*BLOCK" + EOL_STR, RE_FLAGS)
+ENDBLK_RE = LazyRegex(SOL_STR + r"END\s*BLOCK(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-SUBR_RE = re.compile(r"^([^\"']* )?SUBROUTINE\s+\w+\s*(\(.*\))?" + EOL_STR, RE_FLAGS)
-ENDSUBR_RE = re.compile(SOL_STR + r"END\s*SUBROUTINE(\s+\w+)?" + EOL_STR, RE_FLAGS)
+SUBR_RE = LazyRegex(r"^([^\"']* )?SUBROUTINE\s+\w+\s*(\(.*\))?" + EOL_STR, RE_FLAGS)
+ENDSUBR_RE = LazyRegex(SOL_STR + r"END\s*SUBROUTINE(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-FCT_RE = re.compile(
+FCT_RE = LazyRegex(
     r"^([^\"']* )?FUNCTION\s+\w+\s*(\(.*\))?(\s*RESULT\s*\(\w+\))?" + EOL_STR, RE_FLAGS
 )
-ENDFCT_RE = re.compile(SOL_STR + r"END\s*FUNCTION(\s+\w+)?" + EOL_STR, RE_FLAGS)
+ENDFCT_RE = LazyRegex(SOL_STR + r"END\s*FUNCTION(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-MOD_RE = re.compile(SOL_STR + r"MODULE\s+\w+" + EOL_STR, RE_FLAGS)
-ENDMOD_RE = re.compile(SOL_STR + r"END\s*MODULE(\s+\w+)?" + EOL_STR, RE_FLAGS)
+MOD_RE = LazyRegex(SOL_STR + r"MODULE\s+\w+" + EOL_STR, RE_FLAGS)
+ENDMOD_RE = LazyRegex(SOL_STR + r"END\s*MODULE(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-SMOD_RE = re.compile(SOL_STR + r"SUBMODULE\s*\(\w+\)\s+\w+" + EOL_STR, RE_FLAGS)
-ENDSMOD_RE = re.compile(SOL_STR + r"END\s*SUBMODULE(\s+\w+)?" + EOL_STR, RE_FLAGS)
+SMOD_RE = LazyRegex(SOL_STR + r"SUBMODULE\s*\(\w+\)\s+\w+" + EOL_STR, RE_FLAGS)
+ENDSMOD_RE = LazyRegex(SOL_STR + r"END\s*SUBMODULE(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-TYPE_RE = re.compile(
+# attributes of a derived type except EXTENDS: EXTENDS(.*) may span any other
+# attributes, so it is matched at most once (a repeated .* backtracks
+# exponentially)
+TYPE_ATTR_STR = r"(\s*,\s*(BIND\s*\(\s*C\s*\)|ABSTRACT|PUBLIC|PRIVATE))*"
+TYPE_RE = LazyRegex(
     SOL_STR
-    + r"TYPE(\s*,\s*(BIND\s*\(\s*C\s*\)|EXTENDS\s*\(.*\)|ABSTRACT|PUBLIC|PRIVATE))*(\s*,\s*)?(\s*::\s*|\s+)\w+"
+    + r"TYPE"
+    + TYPE_ATTR_STR
+    + r"(\s*,\s*EXTENDS\s*\(.*\)"
+    + TYPE_ATTR_STR
+    + r")?(\s*,\s*)?(\s*::\s*|\s+)\w+"
     + EOL_STR,
     RE_FLAGS,
 )
-ENDTYPE_RE = re.compile(SOL_STR + r"END\s*TYPE(\s+\w+)?" + EOL_STR, RE_FLAGS)
+ENDTYPE_RE = LazyRegex(SOL_STR + r"END\s*TYPE(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-PROG_RE = re.compile(SOL_STR + r"PROGRAM\s+\w+" + EOL_STR, RE_FLAGS)
-ENDPROG_RE = re.compile(SOL_STR + r"END\s*PROGRAM(\s+\w+)?" + EOL_STR, RE_FLAGS)
+PROG_RE = LazyRegex(SOL_STR + r"PROGRAM\s+\w+" + EOL_STR, RE_FLAGS)
+ENDPROG_RE = LazyRegex(SOL_STR + r"END\s*PROGRAM(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-INTERFACE_RE = re.compile(
+INTERFACE_RE = LazyRegex(
     r"^([^\"']* )?INTERFACE(\s+\w+|\s+(OPERATOR|ASSIGNMENT)\s*\(.*\))?" + EOL_STR,
     RE_FLAGS,
 )
-ENDINTERFACE_RE = re.compile(
+ENDINTERFACE_RE = LazyRegex(
     SOL_STR + r"END\s*INTERFACE(\s+\w+|\s+(OPERATOR|ASSIGNMENT)\s*\(.*\))?" + EOL_STR,
     RE_FLAGS,
 )
 
-CONTAINS_RE = re.compile(SOL_STR + r"CONTAINS" + EOL_STR, RE_FLAGS)
+CONTAINS_RE = LazyRegex(SOL_STR + r"CONTAINS" + EOL_STR, RE_FLAGS)
 
-ENUM_RE = re.compile(
+ENUM_RE = LazyRegex(
     SOL_STR + r"ENUM(\s*,\s*(BIND\s*\(\s*C\s*\)))?((\s*::\s*|\s+)\w+)?" + EOL_STR,
     RE_FLAGS,
 )
-ENDENUM_RE = re.compile(SOL_STR + r"END\s*ENUM(\s+\w+)?" + EOL_STR, RE_FLAGS)
+ENDENUM_RE = LazyRegex(SOL_STR + r"END\s*ENUM(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-ENDANY_RE = re.compile(SOL_STR + r"END" + EOL_STR, RE_FLAGS)
+ENDANY_RE = LazyRegex(SOL_STR + r"END" + EOL_STR, RE_FLAGS)
 
 # Regular expressions for where and forall block constructs
-FORALL_RE = re.compile(SOL_STR + r"(\w+\s*:)?\s*FORALL\s*\(.*\)" + EOL_STR, RE_FLAGS)
-ENDFORALL_RE = re.compile(SOL_STR + r"END\s*FORALL(\s+\w+)?" + EOL_STR, RE_FLAGS)
+FORALL_RE = LazyRegex(SOL_STR + r"(\w+\s*:)?\s*FORALL\s*\(.*\)" + EOL_STR, RE_FLAGS)
+ENDFORALL_RE = LazyRegex(SOL_STR + r"END\s*FORALL(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
-WHERE_RE = re.compile(SOL_STR + r"(\w+\s*:)?\s*WHERE\s*\(.*\)" + EOL_STR, RE_FLAGS)
-ELSEWHERE_RE = re.compile(
+WHERE_RE = LazyRegex(SOL_STR + r"(\w+\s*:)?\s*WHERE\s*\(.*\)" + EOL_STR, RE_FLAGS)
+ELSEWHERE_RE = LazyRegex(
     SOL_STR + r"ELSE\s*WHERE(\(.*\))?(\s*\w+)?" + EOL_STR, RE_FLAGS
 )
-ENDWHERE_RE = re.compile(SOL_STR + r"END\s*WHERE(\s+\w+)?" + EOL_STR, RE_FLAGS)
+ENDWHERE_RE = LazyRegex(SOL_STR + r"END\s*WHERE(\s+\w+)?" + EOL_STR, RE_FLAGS)
 
 # Regular expressions for preprocessor directives
 
-FYPP_DEF_RE = re.compile(SOL_STR + r"#:DEF\s+", RE_FLAGS)
-FYPP_ENDDEF_RE = re.compile(SOL_STR + r"#:ENDDEF", RE_FLAGS)
+FYPP_DEF_RE = LazyRegex(SOL_STR + r"#:DEF\s+", RE_FLAGS)
+FYPP_ENDDEF_RE = LazyRegex(SOL_STR + r"#:ENDDEF", RE_FLAGS)
 
-FYPP_IF_RE = re.compile(SOL_STR + r"#:IF\s+", RE_FLAGS)
-FYPP_ELIF_ELSE_RE = re.compile(SOL_STR + r"#:(ELIF\s+|ELSE)", RE_FLAGS)
-FYPP_ENDIF_RE = re.compile(SOL_STR + r"#:ENDIF", RE_FLAGS)
+FYPP_IF_RE = LazyRegex(SOL_STR + r"#:IF\s+", RE_FLAGS)
+FYPP_ELIF_ELSE_RE = LazyRegex(SOL_STR + r"#:(ELIF\s+|ELSE)", RE_FLAGS)
+FYPP_ENDIF_RE = LazyRegex(SOL_STR + r"#:ENDIF", RE_FLAGS)
 
-FYPP_FOR_RE = re.compile(SOL_STR + r"#:FOR\s+", RE_FLAGS)
-FYPP_ENDFOR_RE = re.compile(SOL_STR + r"#:ENDFOR", RE_FLAGS)
+FYPP_FOR_RE = LazyRegex(SOL_STR + r"#:FOR\s+", RE_FLAGS)
+FYPP_ENDFOR_RE = LazyRegex(SOL_STR + r"#:ENDFOR", RE_FLAGS)
 
-FYPP_BLOCK_RE = re.compile(SOL_STR + r"#:BLOCK\s+", RE_FLAGS)
-FYPP_ENDBLOCK_RE = re.compile(SOL_STR + r"#:ENDBLOCK", RE_FLAGS)
+FYPP_BLOCK_RE = LazyRegex(SOL_STR + r"#:BLOCK\s+", RE_FLAGS)
+FYPP_ENDBLOCK_RE = LazyRegex(SOL_STR + r"#:ENDBLOCK", RE_FLAGS)
 
-FYPP_CALL_RE = re.compile(SOL_STR + r"#:CALL\s+", RE_FLAGS)
-FYPP_ENDCALL_RE = re.compile(SOL_STR + r"#:ENDCALL", RE_FLAGS)
+FYPP_CALL_RE = LazyRegex(SOL_STR + r"#:CALL\s+", RE_FLAGS)
+FYPP_ENDCALL_RE = LazyRegex(SOL_STR + r"#:ENDCALL", RE_FLAGS)
 
-FYPP_MUTE_RE = re.compile(SOL_STR + r"#:MUTE", RE_FLAGS)
-FYPP_ENDMUTE_RE = re.compile(SOL_STR + r"#:ENDMUTE", RE_FLAGS)
+FYPP_MUTE_RE = LazyRegex(SOL_STR + r"#:MUTE", RE_FLAGS)
+FYPP_ENDMUTE_RE = LazyRegex(SOL_STR + r"#:ENDMUTE", RE_FLAGS)
 
-PRIVATE_RE = re.compile(SOL_STR + r"PRIVATE\s*::", RE_FLAGS)
-PUBLIC_RE = re.compile(SOL_STR + r"PUBLIC\s*::", RE_FLAGS)
+# anything that may be parsed as a fypp line directive (conservative)
+FYPP_DIRECTIVE_RE = LazyRegex(r"[#$@]\s*[:!]", RE_FLAGS)
 
-END_RE = re.compile(
+PRIVATE_RE = LazyRegex(SOL_STR + r"PRIVATE\s*::", RE_FLAGS)
+PUBLIC_RE = LazyRegex(SOL_STR + r"PUBLIC\s*::", RE_FLAGS)
+
+END_RE = LazyRegex(
     SOL_STR
     + r"(END)\s*(IF|DO|SELECT|ASSOCIATE|BLOCK|SUBROUTINE|FUNCTION|MODULE|SUBMODULE|TYPE|PROGRAM|INTERFACE|ENUM|WHERE|FORALL)",
     RE_FLAGS,
@@ -241,30 +250,51 @@ INTR_STMTS_PAR = (
 
 # regular expressions for parsing linebreaks
 LINEBREAK_STR = r"(&)[\s]*(?:!.*)?$"
+LINEBREAK_RE = LazyRegex(LINEBREAK_STR, RE_FLAGS)
 
 # regular expressions for parsing operators
 # Note: +/- in real literals and sign operator is ignored
-PLUSMINUS_RE = re.compile(r"(?<=[\w\)\]])\s*(\+|-)\s*", RE_FLAGS)
+PLUSMINUS_RE = LazyRegex(r"(?<=[\w\)\]])\s*(\+|-)\s*", RE_FLAGS)
 # Note: ** or // (or any multiples of * or /) are ignored
 #       we also ignore any * or / before a :: because we may be seeing 'real*8'
-MULTDIV_RE = re.compile(
-    r"(?<=[\w\)\]])\s*((?<!\*)\*(?!\*)|(?<!/)/(?!/))(?=[\s\w\(])(?!.*::)", RE_FLAGS
+#       (see multdiv_parser)
+MULTDIV_RE = LazyRegex(
+    r"(?<=[\w\)\]])\s*((?<!\*)\*(?!\*)|(?<!/)/(?!/))(?=[\s\w\(])", RE_FLAGS
 )
-REL_OP_RE = re.compile(
+REL_OP_RE = LazyRegex(
     r"(?<!\()\s*(\.(?:EQ|NE|LT|LE|GT|GE)\.|(?:==|\/=|<(?!=)|<=|(?<!=)>(?!=)|>=))\s*(?!\))",
     RE_FLAGS,
 )
-LOG_OP_RE = re.compile(r"\s*(\.(?:AND|OR|EQV|NEQV)\.)\s*", RE_FLAGS)
-PRINT_RE = re.compile(r"(?:(?<=\bPRINT)|(?<=\bREAD))\s*(\*,?)\s*", RE_FLAGS)
+LOG_OP_RE = LazyRegex(r"\s*(\.(?:AND|OR|EQV|NEQV)\.)\s*", RE_FLAGS)
+PRINT_RE = LazyRegex(r"(?:(?<=\bPRINT)|(?<=\bREAD))\s*(\*,?)\s*", RE_FLAGS)
 
 # regular expressions for parsing delimiters
 DEL_OPEN_STR = r"(\(\/?|\[)"
-DEL_OPEN_RE = re.compile(r"^" + DEL_OPEN_STR, RE_FLAGS)
+DEL_OPEN_RE = LazyRegex(r"^" + DEL_OPEN_STR, RE_FLAGS)
 DEL_CLOSE_STR = r"(\/?\)|\])"
-DEL_CLOSE_RE = re.compile(r"^" + DEL_CLOSE_STR, RE_FLAGS)
+DEL_CLOSE_RE = LazyRegex(r"^" + DEL_CLOSE_STR, RE_FLAGS)
 
 # empty line regex
-EMPTY_RE = re.compile(SOL_STR + r"$", RE_FLAGS)
+EMPTY_RE = LazyRegex(SOL_STR + r"$", RE_FLAGS)
+
+# regular expressions for character wise whitespace formatting
+CHARWISE_TOKEN_RE = LazyRegex(r"[\(\)\[\]/,;%:\.=]", RE_FLAGS)
+# no separating whitespace before opening delimiter if preceded by
+NO_SEP_DEL_OPEN_RE = LazyRegex(r"[\w\*/=\+\-:\(\[]", RE_FLAGS)
+# ... except for these statements
+SEP_DEL_OPEN_STMT_RE = LazyRegex(
+    SOL_STR + r"((\w+\s*:)?(ELSE)?\s*IF|(\w+\s*:)?\s*DO\s+WHILE|(SELECT)?\s*CASE|"
+    r"(SELECT)?\s*RANK|SELECT\s*TYPE|CLASS\s*DEFAULT|(TYPE|CLASS)\s+IS)\s*$",
+    RE_FLAGS,
+)
+SEP_DEL_OPEN_INTR_RE = LazyRegex(r"(?<!%)\b" + INTR_STMTS_PAR + r"\s*$", RE_FLAGS)
+# no separating whitespace after closing delimiter if followed by
+NO_SEP_DEL_CLOSE_RE = LazyRegex(r"\s*(" + DEL_CLOSE_STR + r"|[,%:/\*])", RE_FLAGS)
+DECL_SEP_RE = LazyRegex(r"\s*::", RE_FLAGS)
+NOT_RE = LazyRegex(r"\.NOT\.", RE_FLAGS)
+
+# characters relevant for alignment of line continuations
+ALIGN_TOKEN_RE = LazyRegex(r"[\(\)\[\]/,=:]", RE_FLAGS)
 
 PREPRO_NEW_SCOPE = [
     parser_re(FYPP_DEF_RE),
@@ -285,7 +315,7 @@ PREPRO_END_SCOPE = [
 ]
 
 # line annotating fprettify options
-FPRETTIY_ANNOTATION_RE = re.compile("^\s*!\s*fprettify:\s*(.*)\s*$", RE_FLAGS)
+FPRETTIY_ANNOTATION_RE = LazyRegex("^\s*!\s*fprettify:\s*(.*)\s*$", RE_FLAGS)
 
 
 class plusminus_parser(parser_re):
@@ -293,7 +323,7 @@ class plusminus_parser(parser_re):
 
     def __init__(self, regex):
         self._re = regex
-        self._re_excl = re.compile(r"\b(\d+\.?\d*|\d*\.?\d+)[de]" + EOL_STR, RE_FLAGS)
+        self._re_excl = LazyRegex(r"\b(\d+\.?\d*|\d*\.?\d+)[de]" + EOL_STR, RE_FLAGS)
 
     def split(self, line):
         partsplit = self._re.split(line)
@@ -325,16 +355,39 @@ class plusminus_parser(parser_re):
         return partsplit_out
 
 
+class multdiv_parser(parser_re):
+    """parser for * and / in multiplication and division"""
+
+    def split(self, line):
+        # * and / before the last :: are ignored, this is checked once per line
+        # rather than by a lookahead for :: after each * and /
+        last_decl = line.rfind("::")
+        if last_decl == -1:
+            return self._re.split(line)
+        partsplit = self._re.split(line[last_decl:])
+        partsplit[0] = line[:last_decl] + partsplit[0]
+        return partsplit
+
+
 # two-sided operators
-LR_OPS_RE = [REL_OP_RE, LOG_OP_RE, plusminus_parser(PLUSMINUS_RE), MULTDIV_RE, PRINT_RE]
+LR_OPS_RE = [
+    REL_OP_RE,
+    LOG_OP_RE,
+    plusminus_parser(PLUSMINUS_RE),
+    multdiv_parser(MULTDIV_RE),
+    PRINT_RE,
+]
 
-USE_RE = re.compile(
-    SOL_STR + "USE(\s+|(,.+?)?::\s*)\w+?((,.+?=>.+?)+|,\s*only\s*:.+?)?$" + EOL_STR,
+# renames (a=>b, ...) and only lists may contain anything, so that a single
+# greedy .+ is equivalent to repeated lazy .+? groups (which backtrack
+# quadratically)
+USE_RE = LazyRegex(
+    SOL_STR + r"USE(\s+|(,.+?)?::\s*)\w+(,.+=>.+|,\s*only\s*:.+)?$" + EOL_STR,
     RE_FLAGS,
 )
 
 # markups to deactivate formatter
-NO_ALIGN_RE = re.compile(SOL_STR + r"&\s*[^\s*]+")
+NO_ALIGN_RE = LazyRegex(SOL_STR + r"&\s*[^\s*]+")
 
 
 class where_parser(parser_re):
@@ -436,358 +489,624 @@ def build_scope_parser(fypp=True, mod=True):
     return parser
 
 
+# leading keywords of scope statements: lower case prefixes of the first word
+# of a line (or of the first word after a construct label)
+SCOPE_KEYWORDS = {
+    IF_RE: ("if",),
+    ELSE_RE: ("else",),
+    ENDIF_RE: ("end",),
+    DO_RE: ("do",),
+    ENDDO_RE: ("end",),
+    SELCASE_RE: ("select",),
+    CASE_RE: ("case", "rank", "type", "class"),
+    ENDSEL_RE: ("end",),
+    ENDSUBR_RE: ("end",),
+    ENDFCT_RE: ("end",),
+    ENDINTERFACE_RE: ("end",),
+    TYPE_RE: ("type",),
+    ENDTYPE_RE: ("end",),
+    ENUM_RE: ("enum",),
+    ENDENUM_RE: ("end",),
+    ASSOCIATE_RE: ("associate",),
+    ENDASSOCIATE_RE: ("end",),
+    ENDANY_RE: ("end",),
+    BLK_RE: ("block",),
+    ENDBLK_RE: ("end",),
+    WHERE_RE: ("where",),
+    ELSEWHERE_RE: ("else",),
+    ENDWHERE_RE: ("end",),
+    FORALL_RE: ("forall",),
+    ENDFORALL_RE: ("end",),
+    CONTAINS_RE: ("contains",),
+    MOD_RE: ("module",),
+    ENDMOD_RE: ("end",),
+    SMOD_RE: ("submodule",),
+    ENDSMOD_RE: ("end",),
+    PROG_RE: ("program",),
+    ENDPROG_RE: ("end",),
+}
+for _prepro_re in PREPRO_NEW_SCOPE + PREPRO_CONTINUE_SCOPE + PREPRO_END_SCOPE:
+    if _prepro_re:
+        SCOPE_KEYWORDS[_prepro_re._re] = ("#:",)
+
+# scope statements that may be preceded by prefixes (e.g. PURE FUNCTION),
+# keyword may appear anywhere in the line
+SCOPE_KEYWORDS_ANYWHERE = {
+    SUBR_RE: "subroutine",
+    FCT_RE: "function",
+    INTERFACE_RE: "interface",
+}
+
+SCOPE_KEYWORD_RE = LazyRegex(r"^\s*(\w+|#:)(?:\s*:\s*(\w+))?", RE_FLAGS)
+
+# a line that is a Fortran line of its own (no continuation, no semicolon),
+# no preprocessor or formatter directive and can't be a scope statement by
+# its leading keyword (of ScopeDispatcher, also after a label) or keywords
+# anywhere, see _scope_lines
+PLAIN_LINE_RE = LazyRegex(
+    r"(?![ \t]*(\d+[ \t]+)?(\w+[ \t]*:[ \t]*)?("
+    + "|".join(
+        sorted(
+            set(re.escape(k) for v in SCOPE_KEYWORDS.values() for k in v),
+            key=len,
+            reverse=True,
+        )
+    )
+    + r"))(?![ \t]*([#$@]|![$!&]))(?!.*("
+    + "|".join(SCOPE_KEYWORDS_ANYWHERE.values())
+    + r"))[^&;]*$",
+    RE_FLAGS,
+)
+
+
+class ScopeDispatcher(object):
+    """
+    Select scope parsers (as returned by build_scope_parser) that may match a
+    Fortran line by its leading keyword, so that most lines (assignments,
+    calls, declarations) are not matched against any scope regex.
+    Counts lines that did not need any parser (`n_hits`) out of `n_lines`,
+    reported by PhaseProfiler.
+    """
+
+    _kinds = ("new", "continue", "end")
+
+    def __init__(self, scope_parser):
+        self._by_keyword = {}
+        self._anywhere = []
+        self._always = {kind: [] for kind in self._kinds}
+        for kind in self._kinds:
+            for n, parser in enumerate(scope_parser[kind]):
+                if parser is None:
+                    continue
+                regex = getattr(parser, "_re", None)
+                if regex in SCOPE_KEYWORDS_ANYWHERE:
+                    self._anywhere.append((SCOPE_KEYWORDS_ANYWHERE[regex], kind, n))
+                elif regex in SCOPE_KEYWORDS:
+                    for keyword in SCOPE_KEYWORDS[regex]:
+                        self._by_keyword.setdefault(keyword, []).append((kind, n))
+                else:
+                    # unknown parser, always try
+                    self._always[kind].append(n)
+        self._keyword_lengths = sorted(set(len(k) for k in self._by_keyword))
+
+        self.n_lines = 0
+        self.n_hits = 0
+        if _scope_dispatchers is not None:
+            _scope_dispatchers.append(self)
+
+    def candidates(self, f_line):
+        """
+        indices of parsers that may match `f_line` (must be filtered from
+        strings and comments), returns dict with keys "new", "continue", "end"
+        """
+        self.n_lines += 1
+        cand = {kind: list(self._always[kind]) for kind in self._kinds}
+        found = False
+
+        match = SCOPE_KEYWORD_RE.match(f_line)
+        if match:
+            for word in match.groups():
+                if not word:
+                    continue
+                word = word.lower()
+                for length in self._keyword_lengths:
+                    if length > len(word):
+                        break
+                    for kind, n in self._by_keyword.get(word[:length], ()):
+                        cand[kind].append(n)
+                        found = True
+
+        if self._anywhere:
+            f_line_lower = f_line.lower()
+            for keyword, kind, n in self._anywhere:
+                if keyword in f_line_lower:
+                    cand[kind].append(n)
+                    found = True
+
+        if found:
+            for kind in self._kinds:
+                cand[kind] = sorted(set(cand[kind]))
+        elif not any(self._always.values()):
+            self.n_hits += 1
+
+        return cand
+
+    def may_match(self, f_line):
+        """whether any parser may match `f_line` (filtered as for candidates)"""
+        return any(self.candidates(f_line).values())
+
+
+# name of a construct (label of IF, DO or BLOCK statements)
+CONSTRUCT_LABEL_RE = LazyRegex(SOL_STR + r"(\w+)\s*:")
+
+
+class StatementInfo(object):
+    """
+    Classification of a logical Fortran line `line` (stripped), shared by the
+    stages formatting that line so that it is matched against each regex at
+    most once. Attributes are determined on first access:
+
+    `scopes`: dict with keys "new", "continue", "end" of the indices of the
+        scope parsers (of `scope_parser`, preselected by ScopeDispatcher
+        `dispatcher` if given) matching the line filtered from strings and
+        comments (`filtered`), "new" excludes statements that also end a scope
+    `kind`: "new", "continue" or "end" (scope effect), "use", "decl",
+        "namelist", "data" or None
+    `construct_label`: name of an IF, DO or BLOCK construct, None if unnamed
+    `is_end`: whether the (unfiltered) line is an END statement of a scope
+    `is_decl`, `is_use`: declaration (for alignment), USE statement
+    `is_nml`, `is_data`, `is_cuda`: namelist statement, data statement,
+        CUDA kernel call
+    """
+
+    _LAZY = (
+        "filtered",
+        "scopes",
+        "kind",
+        "construct_label",
+        "is_end",
+        "is_decl",
+        "is_use",
+        "is_nml",
+        "is_data",
+        "is_cuda",
+    )
+
+    __slots__ = ("line", "_scope_parser", "_dispatcher", "_filter_fypp") + _LAZY
+
+    def __init__(self, line, scope_parser=None, dispatcher=None, filter_fypp=True):
+        self.line = line
+        self._scope_parser = scope_parser
+        self._dispatcher = dispatcher
+        self._filter_fypp = filter_fypp
+
+    def __getattr__(self, name):
+        # only called for attributes that have not been determined yet
+        if name not in StatementInfo._LAZY:
+            raise AttributeError(name)
+        value = getattr(self, "_get_" + name)()
+        setattr(self, name, value)
+        return value
+
+    def _get_filtered(self):
+        return CharFilter(self.line, filter_fypp=self._filter_fypp).filter_all()
+
+    def _get_scopes(self):
+        parser = self._scope_parser
+        filtered = self.filtered
+        if self._dispatcher is not None:
+            candidates = self._dispatcher.candidates(filtered)
+        else:
+            candidates = {
+                kind: [n for n, p in enumerate(parser[kind]) if p is not None]
+                for kind in ("new", "continue", "end")
+            }
+        return {
+            "new": [
+                n
+                for n in candidates["new"]
+                if parser["new"][n].search(filtered)
+                and not parser["end"][n].search(filtered)
+            ],
+            "continue": [
+                n
+                for n in candidates["continue"]
+                if parser["continue"][n].search(filtered)
+            ],
+            "end": [n for n in candidates["end"] if parser["end"][n].search(filtered)],
+        }
+
+    def _get_kind(self):
+        if self._scope_parser is not None:
+            for kind in ("new", "continue", "end"):
+                if self.scopes[kind]:
+                    return kind
+        if self.is_use:
+            return "use"
+        if self.is_decl:
+            return "decl"
+        if self.is_nml:
+            return "namelist"
+        if self.is_data:
+            return "data"
+        return None
+
+    def _get_construct_label(self):
+        line = self.line
+        if IF_RE.search(line) or DO_RE.search(line) or BLK_RE.search(line):
+            match = CONSTRUCT_LABEL_RE.search(line)
+            if match:
+                return match.group(1)
+        return None
+
+    def _get_is_end(self):
+        line = self.line
+        return bool(END_RE.search(line)) and any(
+            endre and endre.search(line) for endre in self._scope_parser["end"]
+        )
+
+    def _get_is_decl(self):
+        line = self.line
+        return bool(
+            VAR_DECL_RE.search(line) or PUBLIC_RE.search(line) or PRIVATE_RE.match(line)
+        )
+
+    def _get_is_use(self):
+        return bool(USE_RE.search(self.line))
+
+    def _get_is_nml(self):
+        return bool(NML_STMT_RE.match(self.line))
+
+    def _get_is_data(self):
+        return bool(DATA_STMT_RE.match(self.line))
+
+    def _get_is_cuda(self):
+        return bool(CUDA_CHEVRONS_RE.search(self.line))
+
+
 # match namelist names
-NML_RE = re.compile(r"(/\w+/)", RE_FLAGS)
+NML_RE = LazyRegex(r"(/\w+/)", RE_FLAGS)
 # find namelists and data statements
-NML_STMT_RE = re.compile(SOL_STR + r"NAMELIST.*/.*/", RE_FLAGS)
-DATA_STMT_RE = re.compile(SOL_STR + r"DATA\s+\w", RE_FLAGS)
+NML_STMT_RE = LazyRegex(SOL_STR + r"NAMELIST.*/.*/", RE_FLAGS)
+DATA_STMT_RE = LazyRegex(SOL_STR + r"DATA\s+\w", RE_FLAGS)
 # find CUDA chevrons
-CUDA_CHEVRONS_RE = re.compile(r"<<<.*>>>", RE_FLAGS)
+CUDA_CHEVRONS_RE = LazyRegex(r"<<<.*>>>", RE_FLAGS)
+
+# lists of numeric literals in array constructors and data statements
+NUM_LITERAL_STR = r"[+-]?\s*(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[de][+-]?[0-9]+)?(?:_\w+)?"
+LITERAL_LIST_RE = LazyRegex(
+    r"\s*" + NUM_LITERAL_STR + r"(?:\s*,\s*" + NUM_LITERAL_STR + r")*\s*", RE_FLAGS
+)
+LITERAL_LIST_SEP_RE = LazyRegex(r"\s*(,)\s*|(?<=[+-])\s+", RE_FLAGS)
+LITERAL_LIST_CLOSE_RE = LazyRegex(r"(/\)|\]|/)\s*$", RE_FLAGS)
+DATA_LIST_OPEN_RE = LazyRegex(SOL_STR + r"DATA\s+\w+\s*/", RE_FLAGS)
 
 ## Regexp for f90 keywords'
-F90_KEYWORDS_RE = re.compile(
-    r"\b("
-    + "|".join(
-        (
-            "allocatable",
-            "allocate",
-            "assign",
-            "assignment",
-            "backspace",
-            "block",
-            "call",
-            "case",
-            "character",
-            "close",
-            "common",
-            "complex",
-            "contains",
-            "continue",
-            "cycle",
-            "data",
-            "deallocate",
-            "dimension",
-            "do",
-            "double",
-            "else",
-            "elseif",
-            "elsewhere",
-            "end",
-            "enddo",
-            "endfile",
-            "endif",
-            "entry",
-            "equivalence",
-            "exit",
-            "external",
-            "forall",
-            "format",
-            "function",
-            "goto",
-            "if",
-            "implicit",
-            "include",
-            "inquire",
-            "integer",
-            "intent",
-            "interface",
-            "intrinsic",
-            "logical",
-            "module",
-            "namelist",
-            "none",
-            "nullify",
-            "only",
-            "open",
-            "operator",
-            "optional",
-            "parameter",
-            "pause",
-            "pointer",
-            "precision",
-            "print",
-            "private",
-            "procedure",
-            "program",
-            "public",
-            "read",
-            "real",
-            "recursive",
-            "result",
-            "return",
-            "rewind",
-            "save",
-            "select",
-            "sequence",
-            "stop",
-            "subroutine",
-            "target",
-            "then",
-            "type",
-            "use",
-            "where",
-            "while",
-            "write",
-            ## F95 keywords.
-            "elemental",
-            "pure",
-            ## F2003
-            "abstract",
-            "associate",
-            "asynchronous",
-            "bind",
-            "class",
-            "deferred",
-            "enum",
-            "enumerator",
-            "extends",
-            "extends_type_of",
-            "final",
-            "generic",
-            "import",
-            "non_intrinsic",
-            "non_overridable",
-            "nopass",
-            "pass",
-            "protected",
-            "same_type_as",
-            "value",
-            "volatile",
-            ## F2008.
-            "contiguous",
-            "submodule",
-            "concurrent",
-            "codimension",
-            "sync all",
-            "sync memory",
-            "critical",
-            "image_index",
-        )
-    )
-    + r")\b",
-    RE_FLAGS,
+F90_KEYWORDS = (
+    "allocatable",
+    "allocate",
+    "assign",
+    "assignment",
+    "backspace",
+    "block",
+    "call",
+    "case",
+    "character",
+    "close",
+    "common",
+    "complex",
+    "contains",
+    "continue",
+    "cycle",
+    "data",
+    "deallocate",
+    "dimension",
+    "do",
+    "double",
+    "else",
+    "elseif",
+    "elsewhere",
+    "end",
+    "enddo",
+    "endfile",
+    "endif",
+    "entry",
+    "equivalence",
+    "exit",
+    "external",
+    "forall",
+    "format",
+    "function",
+    "goto",
+    "if",
+    "implicit",
+    "include",
+    "inquire",
+    "integer",
+    "intent",
+    "interface",
+    "intrinsic",
+    "logical",
+    "module",
+    "namelist",
+    "none",
+    "nullify",
+    "only",
+    "open",
+    "operator",
+    "optional",
+    "parameter",
+    "pause",
+    "pointer",
+    "precision",
+    "print",
+    "private",
+    "procedure",
+    "program",
+    "public",
+    "read",
+    "real",
+    "recursive",
+    "result",
+    "return",
+    "rewind",
+    "save",
+    "select",
+    "sequence",
+    "stop",
+    "subroutine",
+    "target",
+    "then",
+    "type",
+    "use",
+    "where",
+    "while",
+    "write",
+    ## F95 keywords.
+    "elemental",
+    "pure",
+    ## F2003
+    "abstract",
+    "associate",
+    "asynchronous",
+    "bind",
+    "class",
+    "deferred",
+    "enum",
+    "enumerator",
+    "extends",
+    "extends_type_of",
+    "final",
+    "generic",
+    "import",
+    "non_intrinsic",
+    "non_overridable",
+    "nopass",
+    "pass",
+    "protected",
+    "same_type_as",
+    "value",
+    "volatile",
+    ## F2008.
+    "contiguous",
+    "submodule",
+    "concurrent",
+    "codimension",
+    "sync all",
+    "sync memory",
+    "critical",
+    "image_index",
 )
+F90_KEYWORDS_RE = LazyRegex(r"\b(" + "|".join(F90_KEYWORDS) + r")\b", RE_FLAGS)
 
 ## Regexp whose first part matches F90 intrinsic procedures.
 ## Add a parenthesis to avoid catching non-procedures.
-F90_PROCEDURES_RE = re.compile(
-    r"\b("
-    + "|".join(
-        (
-            "abs",
-            "achar",
-            "acos",
-            "adjustl",
-            "adjustr",
-            "aimag",
-            "aint",
-            "all",
-            "allocated",
-            "anint",
-            "any",
-            "asin",
-            "associated",
-            "atan",
-            "atan2",
-            "bit_size",
-            "btest",
-            "ceiling",
-            "char",
-            "cmplx",
-            "conjg",
-            "cos",
-            "cosh",
-            "count",
-            "cshift",
-            "date_and_time",
-            "dble",
-            "digits",
-            "dim",
-            "dot_product",
-            "dprod",
-            "eoshift",
-            "epsilon",
-            "exp",
-            "exponent",
-            "floor",
-            "fraction",
-            "huge",
-            "iachar",
-            "iand",
-            "ibclr",
-            "ibits",
-            "ibset",
-            "ichar",
-            "ieor",
-            "index",
-            "int",
-            "ior",
-            "ishft",
-            "ishftc",
-            "kind",
-            "lbound",
-            "len",
-            "len_trim",
-            "lge",
-            "lgt",
-            "lle",
-            "llt",
-            "log",
-            "log10",
-            "logical",
-            "matmul",
-            "max",
-            "maxexponent",
-            "maxloc",
-            "maxval",
-            "merge",
-            "min",
-            "minexponent",
-            "minloc",
-            "minval",
-            "mod",
-            "modulo",
-            "mvbits",
-            "nearest",
-            "nint",
-            "not",
-            "pack",
-            "precision",
-            "present",
-            "product",
-            "radix",
-            ## Real is taken out here to avoid highlighting declarations.
-            "random_number",
-            "random_seed",
-            "range",  ## "real"
-            "repeat",
-            "reshape",
-            "rrspacing",
-            "scale",
-            "scan",
-            "selected_int_kind",
-            "selected_real_kind",
-            "set_exponent",
-            "shape",
-            "sign",
-            "sin",
-            "sinh",
-            "size",
-            "spacing",
-            "spread",
-            "sqrt",
-            "sum",
-            "system_clock",
-            "tan",
-            "tanh",
-            "tiny",
-            "transfer",
-            "transpose",
-            "trim",
-            "ubound",
-            "unpack",
-            "verify",
-            ## F95 intrinsic functions.
-            "null",
-            "cpu_time",
-            ## F2003.
-            "move_alloc",
-            "command_argument_count",
-            "get_command",
-            "get_command_argument",
-            "get_environment_variable",
-            "selected_char_kind",
-            "wait",
-            "flush",
-            "new_line",
-            "extends",
-            "extends_type_of",
-            "same_type_as",
-            "bind",
-            ## F2003 ieee_arithmetic intrinsic module.
-            "ieee_support_underflow_control",
-            "ieee_get_underflow_mode",
-            "ieee_set_underflow_mode",
-            ## F2003 iso_c_binding intrinsic module.
-            "c_loc",
-            "c_funloc",
-            "c_associated",
-            "c_f_pointer",
-            "c_f_procpointer",
-            ## F2008.
-            "bge",
-            "bgt",
-            "ble",
-            "blt",
-            "dshiftl",
-            "dshiftr",
-            "leadz",
-            "popcnt",
-            "poppar",
-            "trailz",
-            "maskl",
-            "maskr",
-            "shifta",
-            "shiftl",
-            "shiftr",
-            "merge_bits",
-            "iall",
-            "iany",
-            "iparity",
-            "storage_size",
-            "bessel_j0",
-            "bessel_j1",
-            "bessel_jn",
-            "bessel_y0",
-            "bessel_y1",
-            "bessel_yn",
-            "erf",
-            "erfc",
-            "erfc_scaled",
-            "gamma",
-            "hypot",
-            "log_gamma",
-            "norm2",
-            "parity",
-            "findloc",
-            "is_contiguous",
-            "sync images",
-            "lock",
-            "unlock",
-            "image_index",
-            "lcobound",
-            "ucobound",
-            "num_images",
-            "this_image",
-            ## F2008 iso_fortran_env module.
-            "compiler_options",
-            "compiler_version",
-            ## F2008 iso_c_binding module.
-            "c_sizeof",
-        )
-    )
-    + r")\b",
-    RE_FLAGS,
+F90_PROCEDURES = (
+    "abs",
+    "achar",
+    "acos",
+    "adjustl",
+    "adjustr",
+    "aimag",
+    "aint",
+    "all",
+    "allocated",
+    "anint",
+    "any",
+    "asin",
+    "associated",
+    "atan",
+    "atan2",
+    "bit_size",
+    "btest",
+    "ceiling",
+    "char",
+    "cmplx",
+    "conjg",
+    "cos",
+    "cosh",
+    "count",
+    "cshift",
+    "date_and_time",
+    "dble",
+    "digits",
+    "dim",
+    "dot_product",
+    "dprod",
+    "eoshift",
+    "epsilon",
+    "exp",
+    "exponent",
+    "floor",
+    "fraction",
+    "huge",
+    "iachar",
+    "iand",
+    "ibclr",
+    "ibits",
+    "ibset",
+    "ichar",
+    "ieor",
+    "index",
+    "int",
+    "ior",
+    "ishft",
+    "ishftc",
+    "kind",
+    "lbound",
+    "len",
+    "len_trim",
+    "lge",
+    "lgt",
+    "lle",
+    "llt",
+    "log",
+    "log10",
+    "logical",
+    "matmul",
+    "max",
+    "maxexponent",
+    "maxloc",
+    "maxval",
+    "merge",
+    "min",
+    "minexponent",
+    "minloc",
+    "minval",
+    "mod",
+    "modulo",
+    "mvbits",
+    "nearest",
+    "nint",
+    "not",
+    "pack",
+    "precision",
+    "present",
+    "product",
+    "radix",
+    ## Real is taken out here to avoid highlighting declarations.
+    "random_number",
+    "random_seed",
+    "range",  ## "real"
+    "repeat",
+    "reshape",
+    "rrspacing",
+    "scale",
+    "scan",
+    "selected_int_kind",
+    "selected_real_kind",
+    "set_exponent",
+    "shape",
+    "sign",
+    "sin",
+    "sinh",
+    "size",
+    "spacing",
+    "spread",
+    "sqrt",
+    "sum",
+    "system_clock",
+    "tan",
+    "tanh",
+    "tiny",
+    "transfer",
+    "transpose",
+    "trim",
+    "ubound",
+    "unpack",
+    "verify",
+    ## F95 intrinsic functions.
+    "null",
+    "cpu_time",
+    ## F2003.
+    "move_alloc",
+    "command_argument_count",
+    "get_command",
+    "get_command_argument",
+    "get_environment_variable",
+    "selected_char_kind",
+    "wait",
+    "flush",
+    "new_line",
+    "extends",
+    "extends_type_of",
+    "same_type_as",
+    "bind",
+    ## F2003 ieee_arithmetic intrinsic module.
+    "ieee_support_underflow_control",
+    "ieee_get_underflow_mode",
+    "ieee_set_underflow_mode",
+    ## F2003 iso_c_binding intrinsic module.
+    "c_loc",
+    "c_funloc",
+    "c_associated",
+    "c_f_pointer",
+    "c_f_procpointer",
+    ## F2008.
+    "bge",
+    "bgt",
+    "ble",
+    "blt",
+    "dshiftl",
+    "dshiftr",
+    "leadz",
+    "popcnt",
+    "poppar",
+    "trailz",
+    "maskl",
+    "maskr",
+    "shifta",
+    "shiftl",
+    "shiftr",
+    "merge_bits",
+    "iall",
+    "iany",
+    "iparity",
+    "storage_size",
+    "bessel_j0",
+    "bessel_j1",
+    "bessel_jn",
+    "bessel_y0",
+    "bessel_y1",
+    "bessel_yn",
+    "erf",
+    "erfc",
+    "erfc_scaled",
+    "gamma",
+    "hypot",
+    "log_gamma",
+    "norm2",
+    "parity",
+    "findloc",
+    "is_contiguous",
+    "sync images",
+    "lock",
+    "unlock",
+    "image_index",
+    "lcobound",
+    "ucobound",
+    "num_images",
+    "this_image",
+    ## F2008 iso_fortran_env module.
+    "compiler_options",
+    "compiler_version",
+    ## F2008 iso_c_binding module.
+    "c_sizeof",
 )
-
-F90_MODULES_RE = re.compile(
-    r"\b("
-    + "|".join(
-        (
-            ## F2003/F2008 module names
-            "iso_fortran_env",
-            "iso_c_binding",
-            "ieee_exceptions",
-            "ieee_arithmetic",
-            "ieee_features",
-        )
-    )
-    + r")\b",
-    RE_FLAGS,
+F90_PROCEDURES_RE = LazyRegex(r"\b(" + "|".join(F90_PROCEDURES) + r")\b", RE_FLAGS)
+
+F90_MODULES = (
+    ## F2003/F2008 module names
+    "iso_fortran_env",
+    "iso_c_binding",
+    "ieee_exceptions",
+    "ieee_arithmetic",
+    "ieee_features",
 )
+F90_MODULES_RE = LazyRegex(r"\b(" + "|".join(F90_MODULES) + r")\b", RE_FLAGS)
 
 ## Regexp matching intrinsic operators
-F90_OPERATORS_RE = re.compile(
+F90_OPERATORS_RE = LazyRegex(
     r"("
     + "|".join(
         [
@@ -814,91 +1133,85 @@ F90_OPERATORS_RE = re.compile(
 )
 
 ## Regexp for Fortran intrinsic constants
-F90_CONSTANTS_RE = re.compile(
-    r"\b("
-    + "|".join(
-        (
-            ## F2003 iso_fortran_env constants.
-            "input_unit",
-            "output_unit",
-            "error_unit",
-            "iostat_end",
-            "iostat_eor",
-            "numeric_storage_size",
-            "character_storage_size",
-            "file_storage_size",
-            ## F2003 iso_c_binding constants.
-            "c_int",
-            "c_short",
-            "c_long",
-            "c_long_long",
-            "c_signed_char",
-            "c_size_t",
-            "c_int8_t",
-            "c_int16_t",
-            "c_int32_t",
-            "c_int64_t",
-            "c_int_least8_t",
-            "c_int_least16_t",
-            "c_int_least32_t",
-            "c_int_least64_t",
-            "c_int_fast8_t",
-            "c_int_fast16_t",
-            "c_int_fast32_t",
-            "c_int_fast64_t",
-            "c_intmax_t",
-            "c_intptr_t",
-            "c_float",
-            "c_double",
-            "c_long_double",
-            "c_float_complex",
-            "c_double_complex",
-            "c_long_double_complex",
-            "c_bool",
-            "c_char",
-            "c_null_char",
-            "c_alert",
-            "c_backspace",
-            "c_form_feed",
-            "c_new_line",
-            "c_carriage_return",
-            "c_horizontal_tab",
-            "c_vertical_tab",
-            "c_ptr",
-            "c_funptr",
-            "c_null_ptr",
-            "c_null_funptr",
-            ## F2008 iso_fortran_env constants.
-            "character_kinds",
-            "int8",
-            "int16",
-            "int32",
-            "int64",
-            "integer_kinds",
-            "iostat_inquire_internal_unit",
-            "logical_kinds",
-            "real_kinds",
-            "real32",
-            "real64",
-            "real128",
-            "lock_type",
-            "atomic_int_kind",
-            "atomic_logical_kind",
-        )
-    )
-    + r")\b",
-    RE_FLAGS,
+F90_CONSTANTS = (
+    ## F2003 iso_fortran_env constants.
+    "input_unit",
+    "output_unit",
+    "error_unit",
+    "iostat_end",
+    "iostat_eor",
+    "numeric_storage_size",
+    "character_storage_size",
+    "file_storage_size",
+    ## F2003 iso_c_binding constants.
+    "c_int",
+    "c_short",
+    "c_long",
+    "c_long_long",
+    "c_signed_char",
+    "c_size_t",
+    "c_int8_t",
+    "c_int16_t",
+    "c_int32_t",
+    "c_int64_t",
+    "c_int_least8_t",
+    "c_int_least16_t",
+    "c_int_least32_t",
+    "c_int_least64_t",
+    "c_int_fast8_t",
+    "c_int_fast16_t",
+    "c_int_fast32_t",
+    "c_int_fast64_t",
+    "c_intmax_t",
+    "c_intptr_t",
+    "c_float",
+    "c_double",
+    "c_long_double",
+    "c_float_complex",
+    "c_double_complex",
+    "c_long_double_complex",
+    "c_bool",
+    "c_char",
+    "c_null_char",
+    "c_alert",
+    "c_backspace",
+    "c_form_feed",
+    "c_new_line",
+    "c_carriage_return",
+    "c_horizontal_tab",
+    "c_vertical_tab",
+    "c_ptr",
+    "c_funptr",
+    "c_null_ptr",
+    "c_null_funptr",
+    ## F2008 iso_fortran_env constants.
+    "character_kinds",
+    "int8",
+    "int16",
+    "int32",
+    "int64",
+    "integer_kinds",
+    "iostat_inquire_internal_unit",
+    "logical_kinds",
+    "real_kinds",
+    "real32",
+    "real64",
+    "real128",
+    "lock_type",
+    "atomic_int_kind",
+    "atomic_logical_kind",
 )
+F90_CONSTANTS_RE = LazyRegex(r"\b(" + "|".join(F90_CONSTANTS) + r")\b", RE_FLAGS)
 
 F90_INT_RE = r"[-+]?[0-9]+"
 F90_FLOAT_RE = r"[-+]?([0-9]+\.[0-9]*|\.[0-9]+)"
 F90_NUMBER_RE = "(" + F90_INT_RE + "|" + F90_FLOAT_RE + ")"
 F90_FLOAT_EXP_RE = F90_NUMBER_RE + r"[eEdD]" + F90_NUMBER_RE
 F90_NUMBER_ALL_RE = "(" + F90_NUMBER_RE + "|" + F90_FLOAT_EXP_RE + ")"
-F90_NUMBER_ALL_REC = re.compile(F90_NUMBER_ALL_RE, RE_FLAGS)
+F90_NUMBER_ALL_REC = LazyRegex(F90_NUMBER_ALL_RE, RE_FLAGS)
 
 ## F90_CONSTANTS_TYPES_RE = re.compile(r"\b" + F90_NUMBER_ALL_RE + "_(" + "|".join([a + r"\b" for a in (
-F90_CONSTANTS_TYPES_RE = re.compile(
+F90_CONSTANTS_TYPES_RE = LazyRegex(
     r"("
     + F90_NUMBER_ALL_RE
     + ")_("
@@ -954,6 +1267,30 @@ F90_CONSTANTS_TYPES_RE = re.compile(
     RE_FLAGS,
 )
 
+## case category of lower case F90 words, in order of increasing precedence
+## (multi-word keywords such as "sync all" never match a single word)
+F90_WORD_CATEGORIES = {
+    word: category
+    for category, words in (
+        ("constants", F90_CONSTANTS),
+        ("procedures", F90_PROCEDURES),
+        ("modules", F90_MODULES),
+        ("keywords", F90_KEYWORDS),
+    )
+    for word in words
+}
+
+## Regexp matching operators and words (possibly containing ".") of a code part
+F90_WORD_TOKEN_RE = LazyRegex(
+    r"(?P<operator>"
+    + F90_OPERATORS_RE.pattern
+    + r")|(?:(?!"
+    + F90_OPERATORS_RE.pattern
+    + r")[a-zA-Z0-9_.])+",
+    RE_FLAGS,
+)
+NON_BLANK_RE = LazyRegex(r"\S", RE_FLAGS)
+
 
 class F90Indenter(object):
     """
@@ -970,6 +1307,7 @@ class F90Indenter(object):
         self._line_indents = []
 
         self._parser = scope_parser
+        self._dispatcher = ScopeDispatcher(scope_parser)
 
         self._filename = filename
         self._aligner = F90Aligner(filename)
@@ -998,6 +1336,7 @@ class F90Indenter(object):
         line_nr,
         indent_fypp=True,
         manual_lines_indent=None,
+        info=None,
     ):
         """
         Process all lines that belong to a Fortran line `f_line`.
@@ -1013,6 +1352,7 @@ class F90Indenter(object):
         :indent_fypp: whether or not to include fypp preprocessor lines
         :manual_lines_indent: don't use F90Aligner but manually impose
                               indents for continuations
+        :info: StatementInfo of f_line (with the scope parser of the indenter)
         """
 
         if self._initial and (PROG_RE.match(f_line) or MOD_RE.match(f_line)):
@@ -1032,64 +1372,52 @@ class F90Indenter(object):
         is_new = False
         valid_new = False
 
-        f_filter = CharFilter(f_line, filter_fypp=not indent_fypp)
-        f_line_filtered = f_filter.filter_all()
+        if info is None:
+            info = StatementInfo(
+                f_line, self._parser, self._dispatcher, filter_fypp=not indent_fypp
+            )
+        f_line_filtered = info.filtered
+        matches = info.scopes
 
-        for new_n, newre in enumerate(self._parser["new"]):
-            if (
-                newre
-                and newre.search(f_line_filtered)
-                and not self._parser["end"][new_n].search(f_line_filtered)
-            ):
-                what_new = new_n
-                is_new = True
-                valid_new = True
-                scopes.append(what_new)
-                log_message(
-                    "{}: {}".format(what_new, f_line), "debug", filename, line_nr
-                )
+        for new_n in matches["new"]:
+            what_new = new_n
+            is_new = True
+            valid_new = True
+            scopes.append(what_new)
+            log_message("{}: {}".format(what_new, f_line), "debug", filename, line_nr)
 
         # check statements that continue scope
         is_con = False
         valid_con = False
-        for con_n, conre in enumerate(self._parser["continue"]):
-            if conre and conre.search(f_line_filtered):
-                what_con = con_n
-                is_con = True
-                log_message(
-                    "{}: {}".format(what_con, f_line), "debug", filename, line_nr
-                )
-                if len(scopes) > 0:
-                    what = scopes[-1]
-                    if what == what_con or indent_fypp:
-                        valid_con = True
+        for con_n in matches["continue"]:
+            what_con = con_n
+            is_con = True
+            log_message("{}: {}".format(what_con, f_line), "debug", filename, line_nr)
+            if len(scopes) > 0:
+                what = scopes[-1]
+                if what == what_con or indent_fypp:
+                    valid_con = True
 
         # check statements that end scope
         is_end = False
         valid_end = False
-        for end_n, endre in enumerate(self._parser["end"]):
-            if endre and endre.search(f_line_filtered):
-                what_end = end_n
-                is_end = True
-                log_message(
-                    "{}: {}".format(what_end, f_line), "debug", filename, line_nr
-                )
-                if len(scopes) > 0:
-                    what = scopes.pop()
-                    if (
-                        what == what_end
-                        or not self._parser["end"][what_end].spec
-                        or indent_fypp
-                    ):
-                        valid_end = True
-                        log_message(
-                            "{}: {}".format(what_end, f_line),
-                            "debug",
-                            filename,
-                            line_nr,
-                        )
-                else:
+        for end_n in matches["end"]:
+            what_end = end_n
+            is_end = True
+            log_message("{}: {}".format(what_end, f_line), "debug", filename, line_nr)
+            if len(scopes) > 0:
+                what = scopes.pop()
+                if (
+                    what == what_end
+                    or not self._parser["end"][what_end].spec
+                    or indent_fypp
+                ):
                     valid_end = True
+                    log_message(
+                        "{}: {}".format(what_end, f_line), "debug", filename, line_nr
+                    )
+            else:
+                valid_end = True
 
         # fypp preprocessor scopes may be within continuation lines
         if indent_fypp and len(lines) > 1 and not FYPP_LINE_RE.search(f_line_filtered):
@@ -1111,7 +1439,9 @@ class F90Indenter(object):
 
         # deal with line breaks
         if not manual_lines_indent:
-            self._aligner.process_lines_of_fline(f_line, lines, rel_ind_con, line_nr)
+            self._aligner.process_lines_of_fline(
+                f_line, lines, rel_ind_con, line_nr, info
+            )
             br_indent_list = self._aligner.get_lines_indent()
         else:
             br_indent_list = manual_lines_indent
@@ -1160,6 +1490,22 @@ class F90Indenter(object):
         self._scope_storage = scopes
         self._indent_storage = indents
 
+    def get_state(self):
+        """
+        scopes and indents after processing, to continue processing with
+        `set_state` (None if no lines have been processed).
+        """
+        if self._initial:
+            return None
+        return tuple(self._scope_storage), tuple(self._indent_storage)
+
+    def set_state(self, state):
+        """continue processing after the lines that led to `state`"""
+        scopes, indents = state
+        self._scope_storage = list(scopes)
+        self._indent_storage = list(indents)
+        self._initial = False
+
     def get_fline_indent(self):
         """after processing, retrieve the indentation of the full Fortran line."""
         return self._indent_storage[-1]
@@ -1201,20 +1547,19 @@ class F90Aligner(object):
         self._level = 0
         self._br_indent_list = [0]
 
-    def process_lines_of_fline(self, f_line, lines, rel_ind, line_nr):
+    def process_lines_of_fline(self, f_line, lines, rel_ind, line_nr, info=None):
         """
         process all lines that belong to a Fortran line `f_line`,
-        `rel_ind` is the relative indentation size.
+        `rel_ind` is the relative indentation size, `info` the StatementInfo
+        of `f_line`.
         """
 
         self.__init_line(line_nr)
 
-        is_decl = (
-            VAR_DECL_RE.search(f_line)
-            or PUBLIC_RE.search(f_line)
-            or PRIVATE_RE.match(f_line)
-        )
-        is_use = USE_RE.search(f_line)
+        if info is None:
+            info = StatementInfo(f_line)
+        is_decl = info.is_decl
+        is_use = info.is_use
         for pos, line in enumerate(lines):
             self.__align_line_continuations(
                 line, is_decl, is_use, rel_ind, self._line_nr + pos
@@ -1251,7 +1596,8 @@ class F90Aligner(object):
 
         end_of_delim = -1
 
-        for pos, char in CharFilter(line):
+        for pos in self.__token_positions(line):
+            char = line[pos]
 
             what_del_open = None
             what_del_close = None
@@ -1345,6 +1691,13 @@ class F90Aligner(object):
 
         self._level = level
 
+    @staticmethod
+    def __token_positions(line):
+        """positions of characters relevant for alignment"""
+        for start, end in CharFilter(line).spans():
+            for token in ALIGN_TOKEN_RE.finditer(line, start, end):
+                yield token.start()
+
 
 def inspect_ffile_format(
     infile, indent_size, strict_indent, indent_fypp=False, orig_filename=None
@@ -1380,28 +1733,270 @@ def inspect_ffile_format(
         if FYPP_LINE_RE.search(f_line):
             has_fypp = True
 
-        f_line, lines, label = preprocess_labels(f_line, lines)
+        indent, offset, line_first_indent = _inspect_fline(
+            f_line, lines, prev_offset, indent_size, strict_indent
+        )
+        if first_indent == -1 and line_first_indent is not None:
+            first_indent = line_first_indent
 
-        offset = len(lines[0]) - len(lines[0].lstrip(" "))
-        if f_line.strip() and first_indent == -1:
-            if PROG_RE.match(f_line) or MOD_RE.match(f_line):
-                first_indent = 0
-            else:
-                first_indent = offset
+        indents.append(indent)
+        prev_offset = offset
+
+    return indents, first_indent, has_fypp
 
-        indents.append(offset - prev_offset)
 
-        # don't impose indentation for blocked do/if constructs:
-        if IF_RE.search(f_line) or DO_RE.search(f_line):
-            indent_misaligned = indent_size > 0 and offset % indent_size != 0
-            if prev_offset != offset or strict_indent or indent_misaligned:
-                indents[-1] = indent_size
+def _inspect_fline(f_line, lines, prev_offset, indent_size, strict_indent):
+    """
+    Determine indentation of a single Fortran line (see inspect_ffile_format).
+    :returns: [ target indent size, offset of line,
+                indent of first line if this may be the first line, else None ]
+    """
+    # labels are only removed from a copy of the first line
+    f_line, lines, label = preprocess_labels(f_line, lines[:1])
+
+    offset = len(lines[0]) - len(lines[0].lstrip(" "))
+    first_indent = None
+    if f_line.strip():
+        if PROG_RE.match(f_line) or MOD_RE.match(f_line):
+            first_indent = 0
         else:
-            indents[-1] = indent_size
+            first_indent = offset
 
-        prev_offset = offset
+    # don't impose indentation for blocked do/if constructs:
+    indent = indent_size
+    if IF_RE.search(f_line) or DO_RE.search(f_line):
+        indent_misaligned = indent_size > 0 and offset % indent_size != 0
+        if not (prev_offset != offset or strict_indent or indent_misaligned):
+            indent = offset - prev_offset
 
-    return indents, first_indent, has_fypp
+    return indent, offset, first_indent
+
+
+def _read_flines(stream, req_indents):
+    """
+    generator of logical Fortran lines, yields [f_line, comments, lines,
+    line number, target indent of next line] where target indents are taken
+    from inspect_ffile_format.
+    """
+    nfl = 0  # fortran line counter
+    while 1:
+        f_line, comments, lines = stream.next_fortran_line()
+        if not lines:
+            break
+        nfl += 1
+        rel_indent = req_indents[nfl] if nfl < len(req_indents) else 0
+        yield f_line, comments, lines, stream.line_nr, rel_indent
+
+
+def _fline_span(lines, start, end, orig_filename):
+    """
+    extend lines `start` to `end` (1-based, inclusive) of `lines` to entire
+    Fortran lines, also if several Fortran lines share a line (separated by
+    semicolons). Returns the first and the last line number.
+    """
+    end = min(end, len(lines))
+    start = max(1, min(start, end + 1))
+    if start > end:
+        return start, end
+
+    stream = InputStream(io.StringIO("".join(lines)), orig_filename=orig_filename)
+    first = 1
+    while True:
+        _, _, flines = stream.next_fortran_line()
+        if not flines:
+            return first, len(lines)
+        if stream.line_buffer:
+            # next Fortran line starts on the same line
+            continue
+        if stream.line_nr >= end:
+            return first, stream.line_nr
+        if stream.line_nr < start:
+            first = stream.line_nr + 1
+
+
+def _scope_lines(lines, end):
+    """
+    indices of the lines preceding line `end` (1-based) of `lines` that are
+    needed for the state of formatting after them (scopes, indentation,
+    formatter directives): lines up to the first statement, the last line,
+    all lines that are not plain (PLAIN_LINE_RE) and their continuation lines
+    and the line following each of them (the indent of a new scope depends on
+    it). Plain lines don't change scopes and are left out.
+    """
+    indices = []
+    in_code = False
+    in_cont = False
+    keep_next = False
+    plain_re = PLAIN_LINE_RE
+    for index in range(end - 1):
+        line = lines[index]
+        stripped = line.strip()
+        if in_cont:
+            in_cont = "&" in line or not stripped or stripped.startswith("!")
+        elif not in_code or not plain_re.match(line):
+            in_cont = "&" in line
+            keep_next = True
+        elif keep_next:
+            keep_next = False
+        else:
+            continue
+        if stripped and not stripped.startswith("!"):
+            in_code = True
+        indices.append(index)
+    if end > 1 and (not indices or indices[-1] != end - 2):
+        indices.append(end - 2)
+    return indices
+
+
+# lines that change the state of formatting of the following lines (formatter
+# directives, preprocessor)
+PINNED_LINE_RE = LazyRegex(r"[ \t]*([#$@]|!&)", RE_FLAGS)
+
+
+def _reduce_scope_lines(lines, indices, scope_parser, orig_filename):
+    """
+    reduce lines `indices` of `lines` as returned by _scope_lines by leaving out
+    blocks of statements that are closed before the last line (from a
+    statement opening a scope of `scope_parser` to the statement ending it),
+    they don't change scopes and indentation. The statements opening and
+    closing such a block are kept if the indent of the scope opened by the
+    preceding statement depends on them. Returns `indices` unchanged if
+    scopes are not well nested.
+    """
+    if not indices:
+        return indices
+    # the last Fortran line may continue after the last line
+    stream = InputStream(
+        _ChunkReader(
+            chain((lines[_] for _ in indices), islice(lines, indices[-1] + 1, None)),
+            orig_filename,
+        ),
+        orig_filename=orig_filename,
+    )
+    dispatcher = ScopeDispatcher(scope_parser)
+    n_code = next(
+        (n for n, _ in enumerate(indices) if lines[_].strip()[:1] not in ("", "!")),
+        len(indices),
+    )
+
+    # Fortran lines as [first line, last line (positions in indices), pinned]
+    flines = []
+    kinds = []
+    # position of the statement ending the block opened by a statement
+    block_end = {}
+    opened = []
+    shared = False
+    while not flines or flines[-1][1] < len(indices) - 1:
+        f_line, _, flines_lines = stream.next_fortran_line()
+        if not flines_lines:
+            break
+        last = stream.line_nr - 1
+        first = last + 1 - len(flines_lines)
+        last = min(last, len(indices) - 1)
+        pinned = shared or first <= n_code or last == len(indices) - 1
+        shared = bool(stream.line_buffer)
+        pinned = pinned or shared
+        pinned = pinned or any(PINNED_LINE_RE.match(_) for _ in flines_lines)
+        flines.append([first, last, pinned])
+
+        f_line, flines_lines, _ = preprocess_omp(f_line, flines_lines)
+        f_line, flines_lines, _ = preprocess_labels(f_line, flines_lines)
+        kind = None
+        if not EMPTY_RE.search(f_line):
+            scopes = StatementInfo(f_line.strip(" "), scope_parser, dispatcher).scopes
+            if len(scopes["new"]) + len(scopes["end"]) > 1:
+                return indices
+            if scopes["new"]:
+                kind = "new"
+                opened.append((len(flines) - 1, scopes["new"][0]))
+            elif scopes["end"]:
+                if not opened:
+                    return indices
+                opening, what = opened.pop()
+                what_end = scopes["end"][0]
+                if what != what_end and scope_parser["end"][what_end].spec:
+                    return indices
+                block_end[opening] = len(flines) - 1
+        kinds.append(kind)
+
+    n_pinned = [0]
+    for _, _, pinned in flines:
+        n_pinned.append(n_pinned[-1] + pinned)
+
+    # the indent of a scope depends on the statement following the statement
+    # opening it, this is kept as well
+    keep = [False] * len(flines)
+    need_next = False
+    pos = 0
+    while pos < len(flines):
+        end = block_end.get(pos)
+        if end is not None and n_pinned[end + 1] == n_pinned[pos]:
+            keep[pos] = keep[end] = need_next
+            need_next = False
+            pos = end + 1
+            continue
+        if end is not None:
+            keep[end] = True
+        keep[pos] = keep[pos] or need_next or flines[pos][2] or kinds[pos] == "new"
+        need_next = kinds[pos] == "new"
+        pos += 1
+
+    # flines separated by ';' share their lines
+    kept = set()
+    for (first, last, _), k in zip(flines, keep):
+        if k:
+            kept.update(range(first, last + 1))
+    return [indices[_] for _ in sorted(kept)]
+
+
+class _InspectedStream(object):
+    """
+    Iterator over logical Fortran lines like _read_flines, but target indents
+    are determined on the fly (equivalent to inspect_ffile_format) so that
+    input is parsed only once. Lines are read ahead until the indent of the
+    first line is known.
+
+    Only valid if inspection and formatting use the same parsing rules,
+    i.e. not for files with fypp directives.
+
+    Given `prev_offset` (`offset` after a line), inspection resumes after
+    that line and the first indent is not determined.
+    """
+
+    def __init__(self, stream, indent_size, strict_indent, prev_offset=None):
+        self._stream = stream
+        self._indent_size = indent_size
+        self._strict_indent = strict_indent
+        self._prev_offset = prev_offset or 0
+        self._buffer = deque()
+        # offset of the last line yielded
+        self.offset = self._prev_offset
+        self.first_indent = -1
+        if prev_offset is None:
+            while self.first_indent == -1 and self._read_fline():
+                pass
+
+    def _read_fline(self):
+        f_line, comments, lines = self._stream.next_fortran_line()
+        if not lines:
+            return False
+        indent, self._prev_offset, first_indent = _inspect_fline(
+            f_line, lines, self._prev_offset, self._indent_size, self._strict_indent
+        )
+        if self.first_indent == -1 and first_indent is not None:
+            self.first_indent = first_indent
+        self._buffer.append(
+            (f_line, comments, lines, self._stream.line_nr, indent, self._prev_offset)
+        )
+        return True
+
+    def __iter__(self):
+        while self._buffer or self._read_fline():
+            if len(self._buffer) < 2:
+                self._read_fline()
+            f_line, comments, lines, line_nr, _, self.offset = self._buffer.popleft()
+            rel_indent = self._buffer[0][4] if self._buffer else 0
+            yield f_line, comments, lines, line_nr, rel_indent
 
 
 def replace_relational_single_fline(f_line, cstyle):
@@ -1422,20 +2017,19 @@ def replace_relational_single_fline(f_line, cstyle):
     if REL_OP_RE.search(f_line):
         # check that relation is not inside quotes, a string, or commented
         # (think of underlining a heading with === or things like markup being printed which we do not replace)
-        pos_prev = -1
-        pos = -1
+        pos = 0
         line_parts = [""]
-        for pos, char in CharFilter(f_line):
-            if pos > pos_prev + 1:  # skipped string
-                line_parts.append(f_line[pos_prev + 1 : pos].strip())  # append string
+        for start, end in CharFilter(f_line).spans():
+            if start > pos:  # skipped string
+                line_parts.append(f_line[pos:start].strip())  # append string
                 line_parts.append("")
 
-            line_parts[-1] += char
+            line_parts[-1] += f_line[start:end]
 
-            pos_prev = pos
+            pos = end
 
-        if pos + 1 < len(f_line):
-            line_parts.append(f_line[pos + 1 :])
+        if pos < len(f_line):
+            line_parts.append(f_line[pos:])
 
         for pos, part in enumerate(line_parts):
             # exclude comments, strings:
@@ -1471,144 +2065,314 @@ def replace_keywords_single_fline(f_line, case_dict):
     new_line = f_line
 
     # Collect words list
-    pos_prev = -1
-    pos = -1
+    pos = 0
     line_parts = [""]
-    for pos, char in CharFilter(f_line):
-        if pos > pos_prev + 1:  # skipped string
-            line_parts.append(f_line[pos_prev + 1 : pos].strip())  # append string
+    for start, end in CharFilter(f_line).spans():
+        if start > pos:  # skipped string
+            line_parts.append(f_line[pos:start].strip())  # append string
             line_parts.append("")
 
-        line_parts[-1] += char
+        line_parts[-1] += f_line[start:end]
 
-        pos_prev = pos
+        pos = end
 
-    if pos + 1 < len(f_line):
-        line_parts.append(f_line[pos + 1 :])
+    if pos < len(f_line):
+        if STR_OPEN_RE.match(f_line[pos:]):
+            line_parts.append(f_line[pos:])
+        else:  # e.g. cpp comment, whose pieces may start like strings
+            line_parts.extend(F90_OPERATORS_RE.split(f_line[pos:]))
 
-    line_parts = [
-        [a] if STR_OPEN_RE.match(a) else re.split(F90_OPERATORS_RE, a)
-        for a in line_parts
-    ]  # problem, split "."
-    line_parts = [b for a in line_parts for b in a]
+    swapcase = lambda s, a: s if a == 0 else (s.lower() if a == 1 else s.upper())
 
-    ## line_parts = [[a] if STR_OPEN_RE.match(a) else re.split('(\W)',a)
-    ##               for a in line_parts]  # problem, split "."
-    line_parts = [
-        [a] if STR_OPEN_RE.match(a) else re.split("([^a-zA-Z0-9_.])", a)
-        for a in line_parts
-    ]
-    line_parts = [b for a in line_parts for b in a]
+    def followed_by_parenthesis(pos, end):
+        """next significant character after end of line_parts[pos] is "(" """
+        match = NON_BLANK_RE.search(line_parts[pos], end)
+        if match:
+            return match.group() == "("
+        for part in line_parts[pos + 1 :]:
+            # exclude comments, strings:
+            if not STR_OPEN_RE.match(part):
+                match = NON_BLANK_RE.search(part)
+                if match:
+                    return match.group() == "("
+        return False
 
-    swapcase = lambda s, a: s if a == 0 else (s.lower() if a == 1 else s.upper())
+    def replace_word(match, pos):
+        word = match.group()
+        if match.group("operator"):
+            return swapcase(word, case_dict["operators"])
+        category = F90_WORD_CATEGORIES.get(word.split(".", 1)[0].lower())
+        if category == "modules":
+            return swapcase(word, case_dict["procedures"])
+        if category == "procedures":
+            if followed_by_parenthesis(pos, match.end()):
+                return swapcase(word, case_dict["procedures"])
+            return word
+        if category:
+            return swapcase(word, case_dict[category])
+        if F90_NUMBER_ALL_REC.match(word):  # including kind suffixed literals
+            return swapcase(word, case_dict["constants"])
+        return word
 
-    nbparts = len(line_parts)
     for pos, part in enumerate(line_parts):
         # exclude comments, strings:
-        if part.strip() and not STR_OPEN_RE.match(part):
-            if F90_KEYWORDS_RE.match(part):
-                part = swapcase(part, case_dict["keywords"])
-            elif F90_MODULES_RE.match(part):
-                part = swapcase(part, case_dict["procedures"])
-            elif F90_PROCEDURES_RE.match(part):
-                ok = False
-                for pos2 in range(pos + 1, nbparts):
-                    part2 = line_parts[pos2]
-                    if part2.strip() and not (
-                        part2 == "\n" or STR_OPEN_RE.match(part2)
-                    ):
-                        ok = part2 == "("
-                        break
-                if ok:
-                    part = swapcase(part, case_dict["procedures"])
-            elif F90_OPERATORS_RE.match(part):
-                part = swapcase(part, case_dict["operators"])
-            elif F90_CONSTANTS_RE.match(part):
-                part = swapcase(part, case_dict["constants"])
-            elif F90_CONSTANTS_TYPES_RE.match(part):
-                part = swapcase(part, case_dict["constants"])
-            elif F90_NUMBER_ALL_REC.match(part):
-                part = swapcase(part, case_dict["constants"])
-
-            line_parts[pos] = part
+        if not STR_OPEN_RE.match(part):
+            line_parts[pos] = F90_WORD_TOKEN_RE.sub(
+                lambda match: replace_word(match, pos), part
+            )
 
     new_line = "".join(line_parts)
 
     return new_line
 
 
-def format_single_fline(
-    f_line,
-    whitespace,
-    whitespace_dict,
-    linebreak_pos,
-    ampersand_sep,
-    scope_parser,
-    format_decl,
-    filename,
-    line_nr,
-    auto_format=True,
-):
+# index of each whitespace option (key of whitespace_dict) in the spacing table
+_SPACING_INDEX = {
+    "comma": 0,  # 0: comma, semicolon
+    "assignments": 1,  # 1: assignment operators
+    "relational": 2,  # 2: relational operators
+    "logical": 3,  # 3: logical operators
+    "plusminus": 4,  # 4: arithm. operators plus and minus
+    "multdiv": 5,  # 5: arithm. operators multiply and divide
+    "print": 6,  # 6: print / read statements
+    "type": 7,  # 7: select type components
+    "intrinsics": 8,  # 8: intrinsics
+    "decl": 9,  # 9: declarations
+    "concat": 10,  # 10: string concatenation
+}
+
+# spacing table (whether to put whitespaces around operators) per whitespace
+# level
+_SPACING = {
+    0: (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+    1: (1, 1, 1, 1, 0, 0, 1, 0, 1, 1, 0),
+    2: (1, 1, 1, 1, 1, 0, 1, 0, 1, 1, 0),
+    3: (1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 0),
+    4: (1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1),
+}
+
+
+class FormatStyle(object):
     """
-    format a single Fortran line - imposes white space formatting
-    and inserts linebreaks.
-    Takes a logical Fortran line `f_line` as input as well as the positions
-    of the linebreaks (`linebreak_pos`), and the number of
-    separating whitespace characters before ampersand (`ampersand_sep`).
-    `filename` and `line_nr` just for error messages.
+    Formatting options (see reformat_ffile) together with the settings derived
+    from them (`spacey`: spacing table, `impose_case`, `rules`: replacements of
+    relational operators and of the case of keywords to be applied to each
+    Fortran line, in this order), built once for all lines and files formatted
+    with these options.
+    Styles must not be modified, they are hashable and compare equal if their
+    options are equal (e.g. to be used as cache keys).
+    """
+
+    OPTIONS = (
+        "impose_indent",
+        "indent_size",
+        "strict_indent",
+        "impose_whitespace",
+        "case_dict",
+        "impose_replacements",
+        "cstyle",
+        "whitespace",
+        "whitespace_dict",
+        "llength",
+        "strip_comments",
+        "comment_spacing",
+        "format_decl",
+        "indent_fypp",
+        "indent_mod",
+    )
+
+    __slots__ = OPTIONS + ("spacey", "impose_case", "rules", "_key", "_hash")
+
+    def __init__(
+        self,
+        impose_indent=True,
+        indent_size=3,
+        strict_indent=False,
+        impose_whitespace=True,
+        case_dict={},
+        impose_replacements=False,
+        cstyle=False,
+        whitespace=2,
+        whitespace_dict={},
+        llength=132,
+        strip_comments=False,
+        comment_spacing=1,
+        format_decl=False,
+        indent_fypp=True,
+        indent_mod=True,
+    ):
+        self.impose_indent = impose_indent
+        self.indent_size = indent_size
+        self.strict_indent = strict_indent
+        self.impose_whitespace = impose_whitespace
+        self.case_dict = dict(case_dict)
+        self.impose_replacements = impose_replacements
+        self.cstyle = cstyle
+        self.whitespace = whitespace
+        self.whitespace_dict = dict(whitespace_dict)
+        self.llength = llength
+        self.strip_comments = strip_comments
+        self.comment_spacing = comment_spacing
+        self.format_decl = format_decl
+        self.indent_fypp = indent_fypp
+        self.indent_mod = indent_mod
+
+        if whitespace not in _SPACING:
+            raise NotImplementedError("unknown value for whitespace")
+        spacey = list(_SPACING[whitespace])
+        # override settings of whitespace level
+        for key, index in _SPACING_INDEX.items():
+            if self.whitespace_dict.get(key) == True:
+                spacey[index] = 1
+            elif self.whitespace_dict.get(key) == False:
+                spacey[index] = 0
+        self.spacey = tuple(spacey)
+
+        self.impose_case = not all(v == 0 for v in self.case_dict.values())
+
+        # functions are looked up when called so that they can be profiled
+        rules = []
+        if impose_replacements:
+            rules.append(lambda f_line: replace_relational_single_fline(f_line, cstyle))
+        if self.impose_case:
+            case_dict = self.case_dict
+            rules.append(
+                lambda f_line: replace_keywords_single_fline(f_line, case_dict)
+            )
+        self.rules = tuple(rules)
+
+        self._key = tuple(
+            tuple(sorted(value.items())) if isinstance(value, dict) else value
+            for value in (getattr(self, name) for name in self.OPTIONS)
+        )
+        self._hash = hash(self._key)
+
+    def options(self):
+        """formatting options as keyword arguments of reformat_ffile"""
+        return {
+            name: dict(value) if isinstance(value, dict) else value
+            for name, value in ((_, getattr(self, _)) for _ in self.OPTIONS)
+        }
+
+    def replace(self, **options):
+        """new style with options `options` replaced"""
+        return FormatStyle(**dict(self.options(), **options))
+
+    def __eq__(self, other):
+        return isinstance(other, FormatStyle) and self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __getstate__(self):
+        return self.options()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __repr__(self):
+        return "FormatStyle({})".format(
+            ", ".join("{}={!r}".format(k, v) for k, v in self.options().items())
+        )
+
+
+def _style_kwargs(kwargs):
+    """
+    keyword arguments `kwargs` with the formatting options replaced by a
+    FormatStyle (keyword `style`) unless a style is given
+    """
+    kwargs = dict(kwargs)
+    options = {k: kwargs.pop(k) for k in FormatStyle.OPTIONS if k in kwargs}
+    if kwargs.get("style") is None:
+        kwargs["style"] = FormatStyle(**options)
+    return kwargs
+
+
+def format_single_fline(
+    f_line,
+    whitespace,
+    whitespace_dict,
+    linebreak_pos,
+    ampersand_sep,
+    scope_parser,
+    format_decl,
+    filename,
+    line_nr,
+    auto_format=True,
+):
+    """
+    format a single Fortran line - imposes white space formatting
+    and inserts linebreaks.
+    Takes a logical Fortran line `f_line` as input as well as the positions
+    of the linebreaks (`linebreak_pos`), and the number of
+    separating whitespace characters before ampersand (`ampersand_sep`).
+    `filename` and `line_nr` just for error messages.
     The higher `whitespace`, the more white space characters inserted -
     whitespace = 0, 1, 2, 3 are currently supported.
     whitespace formatting can additionally controlled more fine-grained
     via a dictionary of bools (whitespace_dict)
     auto formatting can be turned off by setting `auto_format` to False.
+    Builds a FormatStyle for each call, see format_single_fline_style.
     """
+    style = FormatStyle(
+        whitespace=whitespace, whitespace_dict=whitespace_dict, format_decl=format_decl
+    )
+    return format_single_fline_style(
+        f_line,
+        style,
+        linebreak_pos,
+        ampersand_sep,
+        scope_parser,
+        filename,
+        line_nr,
+        auto_format,
+    )
 
-    # define whether to put whitespaces around operators:
-    mapping = {
-        "comma": 0,  # 0: comma, semicolon
-        "assignments": 1,  # 1: assignment operators
-        "relational": 2,  # 2: relational operators
-        "logical": 3,  # 3: logical operators
-        "plusminus": 4,  # 4: arithm. operators plus and minus
-        "multdiv": 5,  # 5: arithm. operators multiply and divide
-        "print": 6,  # 6: print / read statements
-        "type": 7,  # 7: select type components
-        "intrinsics": 8,  # 8: intrinsics
-        "decl": 9,  # 9: declarations
-        "concat": 10,  # 10: string concatenation
-    }
 
-    if whitespace == 0:
-        spacey = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    elif whitespace == 1:
-        spacey = [1, 1, 1, 1, 0, 0, 1, 0, 1, 1, 0]
-    elif whitespace == 2:
-        spacey = [1, 1, 1, 1, 1, 0, 1, 0, 1, 1, 0]
-    elif whitespace == 3:
-        spacey = [1, 1, 1, 1, 1, 1, 1, 0, 1, 1, 0]
-    elif whitespace == 4:
-        spacey = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
-    else:
-        raise NotImplementedError("unknown value for whitespace")
+def format_single_fline_style(
+    f_line,
+    style,
+    linebreak_pos,
+    ampersand_sep,
+    scope_parser,
+    filename,
+    line_nr,
+    auto_format=True,
+    info=None,
+):
+    """
+    format a single Fortran line - imposes white space formatting
+    and inserts linebreaks.
+    Takes a logical Fortran line `f_line` as input as well as the positions
+    of the linebreaks (`linebreak_pos`), and the number of
+    separating whitespace characters before ampersand (`ampersand_sep`).
+    `filename` and `line_nr` just for error messages.
+    White space formatting is given by the spacing table of FormatStyle
+    `style`, see options `whitespace` and `whitespace_dict`.
+    auto formatting can be turned off by setting `auto_format` to False.
+    `info` is the StatementInfo of `f_line` with scope parser `scope_parser`.
+    """
 
-    if whitespace_dict:
-        # iterate over dictionary and override settings for 'spacey'
-        for key, value in mapping.items():
-            if whitespace_dict[key] == True:
-                spacey[value] = 1
-            elif whitespace_dict[key] == False:
-                spacey[value] = 0
+    spacey = style.spacey
+    format_decl = style.format_decl
 
     line = f_line
     line_orig = line
 
     if auto_format:
-
-        line = rm_extra_whitespace(line, format_decl)
-        line = add_whitespace_charwise(
-            line, spacey, scope_parser, format_decl, filename, line_nr
+        if info is None:
+            info = StatementInfo(line, scope_parser)
+        line_ftd = format_literal_list_fline(
+            line, spacey, scope_parser, format_decl, filename, line_nr, info
         )
-        line = add_whitespace_context(line, spacey)
+        if line_ftd is None:
+            line_ftd = add_whitespace(
+                line, spacey, scope_parser, format_decl, filename, line_nr, info
+            )
+        line = line_ftd
 
     lines_out = split_reformatted_line(
         line_orig, linebreak_pos, ampersand_sep, line, filename, line_nr
@@ -1616,6 +2380,81 @@ def format_single_fline(
     return lines_out
 
 
+def add_whitespace(
+    line, spacey, scope_parser, format_decl, filename, line_nr, info=None
+):
+    """
+    impose whitespace formatting on a Fortran line, `info` is its
+    StatementInfo (with scope parser `scope_parser`)
+    """
+    if info is None:
+        info = StatementInfo(line, scope_parser)
+    line = rm_extra_whitespace(line, format_decl)
+    line = add_whitespace_charwise(
+        line, spacey, scope_parser, format_decl, filename, line_nr, info
+    )
+    line = add_whitespace_context(line, spacey, info)
+    return line
+
+
+def split_literal_list(line):
+    """
+    split a Fortran line ending with a list of numeric literals in an array
+    constructor or a data statement into (head, list, tail), returns None if
+    line is not of this form.
+    """
+    what_close = LITERAL_LIST_CLOSE_RE.search(line)
+    if not what_close:
+        return None
+
+    close = what_close.group(1)
+    if close == "/)":
+        start = line.rfind("(/", 0, what_close.start())
+        start = start + 2 if start != -1 else None
+    elif close == "]":
+        start = line.rfind("[", 0, what_close.start())
+        start = start + 1 if start != -1 else None
+    else:
+        what_open = DATA_LIST_OPEN_RE.match(line)
+        start = what_open.end() if what_open else None
+
+    if start is None or not LITERAL_LIST_RE.fullmatch(line, start, what_close.start()):
+        return None
+
+    return line[:start], line[start : what_close.start()], line[what_close.start() :]
+
+
+def format_literal_list_fline(
+    line, spacey, scope_parser, format_decl, filename, line_nr, info=None
+):
+    """
+    fast lane for whitespace formatting of lists of numeric literals:
+    the line is formatted with a single literal in place of the list and
+    the list is formatted by a single substitution (consistent with
+    `add_whitespace`). Returns None if line does not end with such a list.
+    The line with a single literal is classified like the line (`info`).
+    """
+    literals = split_literal_list(line)
+    if not literals:
+        return None
+
+    head, literals, tail = literals
+    line_ftd = add_whitespace(
+        head + "0" + tail, spacey, scope_parser, format_decl, filename, line_nr, info
+    )
+
+    pos = line_ftd.rfind(LITERAL_LIST_CLOSE_RE.search(tail).group(1)) - 1
+    if pos < 0 or line_ftd[pos] != "0":
+        return None
+
+    # rm whitespace around literals and signs, add whitespace after commas
+    sep = "," + " " * spacey[0]
+    literals = LITERAL_LIST_SEP_RE.sub(
+        lambda match: sep if match.group(1) else "", literals.strip()
+    )
+    return line_ftd[:pos] + literals + line_ftd[pos + 1 :]
+
+
 def rm_extra_whitespace(line, format_decl):
     """rm all unneeded whitespace chars, except for declarations"""
     line_ftd = ""
@@ -1650,194 +2489,233 @@ def rm_extra_whitespace(line, format_decl):
     return line_ftd
 
 
-def add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, line_nr):
-    """add whitespace character wise (no need for context aware parsing)"""
-    line_ftd = line
+class _LineEditor(object):
+    """
+    Replace tokens of a line at increasing positions, stripping the blanks
+    around each token. This is equivalent to repeatedly doing
+
+        lhs = line_ftd[: pos + offset]
+        rhs = line_ftd[pos + length + offset :]
+        line_ftd = lhs.rstrip(" ") + text + rhs.lstrip(" ")
+
+    with offset = len(line_ftd) - len(line), but linear in the line length:
+    the formatted part is kept as a list of strings, the part not yet
+    formatted is referenced by its start position in the original line.
+    """
+
+    def __init__(self, line):
+        self._line = line
+        self._out = []  # formatted part
+        self._len = 0  # length of formatted part
+        self._start = 0  # start of unformatted part in line
+
+    def getvalue(self):
+        return "".join(self._out) + self._line[self._start :]
+
+    def _offset(self):
+        return self._len - self._start
+
+    def _materialize(self):
+        # fallback to plain string operations if a token overlaps with the
+        # formatted part or if the unformatted part changes
+        line_ftd = self.getvalue()
+        self._out = [line_ftd]
+        self._len = len(line_ftd)
+        self._start = len(self._line)
+        return line_ftd
+
+    def _rstrip_out(self):
+        out = self._out
+        while out:
+            piece = out[-1].rstrip(" ")
+            self._len -= len(out[-1]) - len(piece)
+            if piece:
+                out[-1] = piece
+                break
+            out.pop()
+
+    def replace(self, pos, length, text):
+        """
+        replace `length` characters at `pos` of the original line by `text`,
+        returns position of `text` in the formatted line.
+        """
+        line = self._line
+        if pos < self._start:
+            line_ftd = self._materialize()
+            lhs = line_ftd[: pos + self._offset()].rstrip(" ")
+            rhs = line_ftd[pos + length + self._offset() :].lstrip(" ")
+            self._out = [lhs + text + rhs]
+            self._len = len(self._out[0])
+            return len(lhs)
+
+        lhs = line[self._start : pos].rstrip(" ")
+        if lhs:
+            self._out.append(lhs)
+            self._len += len(lhs)
+        else:
+            self._rstrip_out()
+        text_pos = self._len
+        self._out.append(text)
+        self._len += len(text)
+
+        start = min(pos + length, len(line))
+        while start < len(line) and line[start] == " ":
+            start += 1
+        self._start = start
+        return text_pos
+
+    def leading_blanks(self, pos):
+        """number of blanks in formatted line at `pos` of the original line"""
+        line = self._line
+        if pos < self._start:
+            rhs = self.getvalue()[pos + self._offset() :]
+            return len(rhs) - len(rhs.lstrip(" "))
+        end = pos
+        while end < len(line) and line[end] == " ":
+            end += 1
+        return end - pos
+
+    def rstrip(self):
+        """strip trailing blanks of formatted line"""
+        line = self._line
+        if self._start >= len(line):
+            self._rstrip_out()
+        elif line[-1] == " ":
+            line_ftd = self._materialize().rstrip(" ")
+            self._out = [line_ftd]
+            self._len = len(line_ftd)
+
+
+# maximum length of an intrinsic statement keyword
+INTR_STMTS_MAXLEN = max(len(stmt) for stmt in re.findall(r"\w+", INTR_STMTS_PAR))
+
+
+def add_whitespace_charwise(
+    line, spacey, scope_parser, format_decl, filename, line_nr, info=None
+):
+    """
+    add whitespace character wise (no need for context aware parsing),
+    `info` is the StatementInfo of `line`
+    """
+    if info is None:
+        info = StatementInfo(line, scope_parser)
+    editor = _LineEditor(line)
     pos_eq = []
     end_of_delim = -1
     level = 0
-    for pos, char in CharFilter(line):
-        # offset w.r.t. unformatted line
-        offset = len(line_ftd) - len(line)
+    for start, end in CharFilter(line).spans():
+        for token in CHARWISE_TOKEN_RE.finditer(line, start, end):
+            pos = token.start()
+            char = line[pos]
 
-        # format delimiters
-        what_del_open = None
-        what_del_close = None
-        if pos > end_of_delim:
-            [what_del_open, what_del_close] = get_curr_delim(line, pos)
+            # format delimiters
+            what_del_open = None
+            what_del_close = None
+            if pos > end_of_delim:
+                [what_del_open, what_del_close] = get_curr_delim(line, pos)
 
-        if what_del_open or what_del_close:
-            sep1 = 0
-            sep2 = 0
+            if what_del_open or what_del_close:
+                sep1 = 0
+                sep2 = 0
 
-            if what_del_open:
-                delim = what_del_open.group()
-            else:
-                delim = what_del_close.group()
-
-            lhs = line_ftd[: pos + offset]
-            rhs = line_ftd[pos + len(delim) + offset :]
+                if what_del_open:
+                    delim = what_del_open.group()
+                else:
+                    delim = what_del_close.group()
 
-            # format opening delimiters
-            if what_del_open:
-                level += 1  # new scope
-                # add separating whitespace before opening delimiter
-                # with some exceptions:
-                # FIXME: duplication of regex, better to include them into
-                # INTR_STMTS_PAR
-                if (
-                    (
-                        not re.search(
-                            (r"(" + DEL_OPEN_STR + r"|[\w\*/=\+\-:])\s*$"),
-                            line[:pos],
-                            RE_FLAGS,
+                # format opening delimiters
+                if what_del_open:
+                    level += 1  # new scope
+                    # add separating whitespace before opening delimiter
+                    # with some exceptions:
+                    last = pos - 1  # last non-whitespace character before pos
+                    while last >= 0 and line[last].isspace():
+                        last -= 1
+                    if (
+                        (last >= 0 and not NO_SEP_DEL_OPEN_RE.match(line, last))
+                        or SEP_DEL_OPEN_STMT_RE.match(line, 0, pos)
+                        or SEP_DEL_OPEN_INTR_RE.search(
+                            line, max(0, last + 1 - INTR_STMTS_MAXLEN), pos
                         )
-                        and not EMPTY_RE.search(line[:pos])
-                    )
-                    or re.search(
-                        SOL_STR + r"(\w+\s*:)?(ELSE)?\s*IF\s*$", line[:pos], RE_FLAGS
-                    )
-                    or re.search(
-                        SOL_STR + r"(\w+\s*:)?\s*DO\s+WHILE\s*$", line[:pos], RE_FLAGS
-                    )
-                    or re.search(
-                        SOL_STR + r"(SELECT)?\s*CASE\s*$", line[:pos], RE_FLAGS
-                    )
-                    or re.search(
-                        SOL_STR + r"(SELECT)?\s*RANK\s*$", line[:pos], RE_FLAGS
-                    )
-                    or re.search(SOL_STR + r"SELECT\s*TYPE\s*$", line[:pos], RE_FLAGS)
-                    or re.search(SOL_STR + r"CLASS\s*DEFAULT\s*$", line[:pos], RE_FLAGS)
-                    or re.search(
-                        SOL_STR + r"(TYPE|CLASS)\s+IS\s*$", line[:pos], RE_FLAGS
-                    )
-                    or re.search(
-                        r"(?<!%)\b" + INTR_STMTS_PAR + r"\s*$", line[:pos], RE_FLAGS
-                    )
-                ):
-                    sep1 = 1 * spacey[8]
+                    ):
+                        sep1 = 1 * spacey[8]
 
-            # format closing delimiters
-            else:
-                if level > 0:
-                    level += -1  # close scope
+                # format closing delimiters
                 else:
-                    log_message(
-                        "unpaired bracket delimiters", "info", filename, line_nr
-                    )
+                    if level > 0:
+                        level += -1  # close scope
+                    else:
+                        log_message(
+                            "unpaired bracket delimiters", "info", filename, line_nr
+                        )
 
-                # add separating whitespace after closing delimiter
-                # with some exceptions:
-                if not re.search(
-                    r"^\s*(" + DEL_CLOSE_STR + r"|[,%:/\*])", line[pos + 1 :], RE_FLAGS
-                ):
-                    sep2 = 1
-                elif re.search(r"^\s*::", line[pos + 1 :], RE_FLAGS):
-                    sep2 = len(rhs) - len(rhs.lstrip(" ")) if not format_decl else 1
+                    # add separating whitespace after closing delimiter
+                    # with some exceptions:
+                    if not NO_SEP_DEL_CLOSE_RE.match(line, pos + 1):
+                        sep2 = 1
+                    elif DECL_SEP_RE.match(line, pos + 1):
+                        sep2 = (
+                            editor.leading_blanks(pos + len(delim))
+                            if not format_decl
+                            else 1
+                        )
 
-            # where delimiter token ends
-            end_of_delim = pos + len(delim) - 1
+                # where delimiter token ends
+                end_of_delim = pos + len(delim) - 1
 
-            line_ftd = (
-                lhs.rstrip(" ") + " " * sep1 + delim + " " * sep2 + rhs.lstrip(" ")
-            )
+                editor.replace(pos, len(delim), " " * sep1 + delim + " " * sep2)
 
-        # format commas and semicolons
-        if char in [",", ";"]:
-            lhs = line_ftd[: pos + offset]
-            rhs = line_ftd[pos + 1 + offset :]
-            line_ftd = lhs.rstrip(" ") + char + " " * spacey[0] + rhs.lstrip(" ")
-            line_ftd = line_ftd.rstrip(" ")
-
-        # format type selector %
-        if char == "%":
-            lhs = line_ftd[: pos + offset]
-            rhs = line_ftd[pos + 1 + offset :]
-            line_ftd = (
-                lhs.rstrip(" ")
-                + " " * spacey[7]
-                + char
-                + " " * spacey[7]
-                + rhs.lstrip(" ")
-            )
-            line_ftd = line_ftd.rstrip(" ")
-
-        # format string concatenation operator '//'
-        if (
-            char == "/"
-            and line[pos : pos + 2] == "//"
-            and (pos == 0 or line[pos - 1] != "/")
-            and level == 0
-            and pos > end_of_delim
-        ):
-            lhs = line_ftd[: pos + offset]
-            rhs = line_ftd[pos + 2 + offset :]
-            line_ftd = (
-                lhs.rstrip(" ")
-                + " " * spacey[10]
-                + "//"
-                + " " * spacey[10]
-                + rhs.lstrip(" ")
-            )
+            # format commas and semicolons
+            if char in [",", ";"]:
+                editor.replace(pos, 1, char + " " * spacey[0])
+                editor.rstrip()
 
-        # format '::'
-        if format_decl and line[pos : pos + 2] == "::":
-            lhs = line_ftd[: pos + offset]
-            rhs = line_ftd[pos + 2 + offset :]
-            line_ftd = (
-                lhs.rstrip(" ")
-                + " " * spacey[9]
-                + "::"
-                + " " * spacey[9]
-                + rhs.lstrip(" ")
-            )
-            line_ftd = line_ftd.rstrip(" ")
-
-        # format .NOT.
-        if re.search(r"^\.NOT\.", line[pos : pos + 5], RE_FLAGS):
-            lhs = line_ftd[: pos + offset]
-            rhs = line_ftd[pos + 5 + offset :]
-            line_ftd = (
-                lhs.rstrip(" ")
-                + line[pos : pos + 5]
-                + " " * spacey[3]
-                + rhs.lstrip(" ")
-            )
-
-        # strip whitespaces from '=' and prepare assignment operator
-        # formatting:
-        if char == "=" and not REL_OP_RE.search(line[pos - 1 : pos + 2]):
-            is_pointer = line[pos + 1] == ">" if pos + 1 < len(line) else False
-            lhs = line_ftd[: pos + offset]
-            rhs = line_ftd[pos + 1 + is_pointer + offset :]
-            assign_op = "=" + ">" * is_pointer
-            line_ftd = lhs.rstrip(" ") + assign_op + rhs.lstrip(" ")
-            if (not level) or is_pointer:  # remember position of assignment operator
-                pos_eq.append(len(lhs.rstrip(" ")))
-
-    line = line_ftd
+            # format type selector %
+            if char == "%":
+                editor.replace(pos, 1, " " * spacey[7] + char + " " * spacey[7])
+                editor.rstrip()
 
+            # format string concatenation operator '//'
+            if (
+                char == "/"
+                and line[pos : pos + 2] == "//"
+                and (pos == 0 or line[pos - 1] != "/")
+                and level == 0
+                and pos > end_of_delim
+            ):
+                editor.replace(pos, 2, " " * spacey[10] + "//" + " " * spacey[10])
+
+            # format '::'
+            if format_decl and line[pos : pos + 2] == "::":
+                editor.replace(pos, 2, " " * spacey[9] + "::" + " " * spacey[9])
+                editor.rstrip()
+
+            # format .NOT.
+            if NOT_RE.match(line, pos, pos + 5):
+                editor.replace(pos, 5, line[pos : pos + 5] + " " * spacey[3])
+
+            # strip whitespaces from '=' and prepare assignment operator
+            # formatting:
+            if char == "=" and not REL_OP_RE.search(line[pos - 1 : pos + 2]):
+                is_pointer = line[pos + 1] == ">" if pos + 1 < len(line) else False
+                assign_op = "=" + ">" * is_pointer
+                pos_assign = editor.replace(pos, 1 + is_pointer, assign_op)
+                # remember position of assignment operator
+                if (not level) or is_pointer:
+                    pos_eq.append(pos_assign)
+
+    line = editor.getvalue()
+
+    editor = _LineEditor(line)
     for pos in pos_eq:
-        offset = len(line_ftd) - len(line)
         is_pointer = line[pos + 1] == ">" if pos + 1 < len(line) else False
-        lhs = line_ftd[: pos + offset]
-        rhs = line_ftd[pos + 1 + is_pointer + offset :]
         assign_op = "=" + ">" * is_pointer
-        line_ftd = (
-            lhs.rstrip(" ")
-            + " " * spacey[1]
-            + assign_op
-            + " " * spacey[1]
-            + rhs.lstrip(" ")
+        editor.replace(
+            pos, 1 + is_pointer, " " * spacey[1] + assign_op + " " * spacey[1]
         )
-        # offset w.r.t. unformatted line
-
-    is_end = False
-    if END_RE.search(line_ftd):
-        for endre in scope_parser["end"]:
-            if endre and endre.search(line_ftd):
-                is_end = True
-    if is_end:
+    line_ftd = editor.getvalue()
+
+    if info.is_end:
         line_ftd = END_RE.sub(r"\1" + " " * spacey[8] + r"\2", line_ftd)
 
     if level != 0:
@@ -1846,29 +2724,31 @@ def add_whitespace_charwise(line, spacey, scope_parser, format_decl, filename, l
     return line_ftd
 
 
-def add_whitespace_context(line, spacey):
+def add_whitespace_context(line, spacey, info=None):
     """
     for context aware whitespace formatting we extract line parts that are
     not comments or strings in order to be able to apply a context aware regex.
+    `info` is the StatementInfo of `line`.
     """
+    if info is None:
+        info = StatementInfo(line)
 
-    pos_prev = -1
-    pos = -1
+    pos = 0
     line_parts = [""]
-    for pos, char in CharFilter(line):
-        if pos > pos_prev + 1:  # skipped string
-            line_parts.append(line[pos_prev + 1 : pos].strip())  # append string
+    for start, end in CharFilter(line).spans():
+        if start > pos:  # skipped string
+            line_parts.append(line[pos:start].strip())  # append string
             line_parts.append("")
 
-        line_parts[-1] += char
+        line_parts[-1] += line[start:end]
 
-        pos_prev = pos
+        pos = end
 
-    if pos + 1 < len(line):
-        line_parts.append(line[pos + 1 :])
+    if pos < len(line):
+        line_parts.append(line[pos:])
 
     # format namelists with spaces around /
-    if NML_STMT_RE.match(line):
+    if info.is_nml:
         for pos, part in enumerate(line_parts):
             # exclude comments, strings:
             if not STR_OPEN_RE.match(part):
@@ -1876,27 +2756,22 @@ def add_whitespace_context(line, spacey):
                 line_parts[pos] = " ".join(partsplit)
 
     # Two-sided operators
-    for n_op, lr_re in enumerate(LR_OPS_RE):
-        for pos, part in enumerate(line_parts):
-            # exclude comments, strings:
-            if not STR_OPEN_RE.match(part):
-                # also exclude / if we see a namelist and data statement
-                if not (
-                    NML_STMT_RE.match(line)
-                    or DATA_STMT_RE.match(line)
-                    or CUDA_CHEVRONS_RE.search(line)
-                ):
+    # also exclude / if we see a namelist and data statement
+    if not (info.is_nml or info.is_data or info.is_cuda):
+        for n_op, lr_re in enumerate(LR_OPS_RE):
+            for pos, part in enumerate(line_parts):
+                # exclude comments, strings:
+                if not STR_OPEN_RE.match(part):
                     partsplit = lr_re.split(part)
                     line_parts[pos] = (" " * spacey[n_op + 2]).join(partsplit)
 
     line = "".join(line_parts)
 
-    for newre in [IF_RE, DO_RE, BLK_RE]:
-        if newre.search(line) and re.search(SOL_STR + r"\w+\s*:", line):
-            line = ": ".join(_.strip() for _ in line.split(":", 1))
+    if info.construct_label is not None:
+        line = ": ".join(_.strip() for _ in line.split(":", 1))
 
     # format ':' for labels and use only statements
-    if USE_RE.search(line):
+    if info.is_use:
         line = re.sub(
             r"(only)\s*:\s*", r"\g<1>:" + " " * spacey[0], line, flags=RE_FLAGS
         )
@@ -1911,33 +2786,44 @@ def split_reformatted_line(
     Infer linebreak positions of formatted line from linebreak positions in
     original line and split line.
     """
-    # shift line break positions from original to reformatted line
-    pos_new = 0
-    pos_old = 0
-    linebreak_pos_orig.sort(reverse=True)
-    linebreak_pos_ftd = []
-    while 1:
+    # shift line break positions from original to reformatted line:
+    # the characters of both lines (first character and all non-blank
+    # characters) must be the same, a line break is shifted to the first
+    # character after the line break.
+    chars_orig = line_orig[:1] + line_orig[1:].replace(" ", "")
+    chars_ftd = line[:1] + line[1:].replace(" ", "")
+    n_chars = min(len(chars_orig), len(chars_ftd))
+    if chars_orig[:n_chars] != chars_ftd[:n_chars]:
+        raise FprettifyInternalException(
+            "failed at finding line break position", filename, line_nr
+        )
 
-        if pos_new == len(line) or pos_old == len(line_orig):
+    linebreak_pos_ftd = []
+    pos_old = 0
+    n_old = 1  # number of characters of original line up to pos_old
+    pos_new = 0
+    n_new = 0  # number of characters of formatted line before pos_new
+    for linebreak in sorted(linebreak_pos_orig):
+        # index of first character after line break
+        if linebreak >= 0:
+            linebreak = min(linebreak, len(line_orig) - 1)
+            if linebreak > pos_old:
+                n_old += (linebreak - pos_old) - line_orig.count(
+                    " ", pos_old + 1, linebreak + 1
+                )
+                pos_old = linebreak
+            n_char = n_old
+        else:
+            n_char = 0
+        if n_char >= n_chars:
             break
 
-        if line[pos_new] != line_orig[pos_old]:
-            raise FprettifyInternalException(
-                "failed at finding line break position", filename, line_nr
-            )
-
-        if linebreak_pos_orig and pos_old > linebreak_pos_orig[-1]:
-            linebreak_pos_orig.pop()
-            linebreak_pos_ftd.append(pos_new)
-            continue
-
-        pos_new += 1
-        while pos_new < len(line) and line[pos_new] == " ":
-            pos_new += 1
-
-        pos_old += 1
-        while pos_old < len(line_orig) and line_orig[pos_old] == " ":
-            pos_old += 1
+        # position of this character in formatted line
+        while n_new < n_char:
+            pos_next = pos_new + n_char - n_new
+            n_new += (n_char - n_new) - line.count(" ", pos_new + 1, pos_next + 1)
+            pos_new = pos_next
+        linebreak_pos_ftd.append(pos_new)
 
     linebreak_pos_ftd.insert(0, 0)
 
@@ -1968,64 +2854,252 @@ def diff(a, b, a_name, b_name):
     )
 
 
-def reformat_inplace(
-    filename, stdout=False, diffonly=False, **kwargs
-):  # pragma: no cover
-    """reformat a file in place."""
-    if filename == "-":
-        infile = io.StringIO()
-        infile.write(sys.stdin.read())
-    else:
-        infile = io.open(filename, "r", encoding="utf-8")
+class _ReplacementFile(object):
+    """
+    temporary file that replaces file `filename` on `commit`, so that the file
+    is never left partially written. File mode is preserved.
+    """
 
-    newfile = io.StringIO()
+    def __init__(self, filename):
+        import tempfile
+
+        # replace the target of a symbolic link rather than the link
+        self._filename = os.path.realpath(filename)
+        self._mode = os.stat(self._filename).st_mode & 0o7777
+        fd, self._tmpname = tempfile.mkstemp(
+            prefix="." + os.path.basename(self._filename) + ".",
+            suffix=".tmp",
+            dir=os.path.dirname(self._filename),
+        )
+        self._file = io.open(fd, "w", encoding="utf-8")
 
-    # check fprettify annotations overriding any previously parsed options
-    infile.seek(0)
-    arg_parser = get_arg_parser()
-    annotated_args = {}
-    for line in infile:
-        match = FPRETTIY_ANNOTATION_RE.search(line)
-        if match:
-            if annotated_args:
-                log_message(
-                    "Ignoring subsequent '! fprettify: ...' comments within same file."
-                )
-                continue
+    def write(self, text):
+        self._file.write(text)
 
-            args_tmp = arg_parser.parse_args(shlex.split(match.group(1)))
-            annotated_args = process_args(args_tmp)
+    def commit(self):
+        """replace the file"""
+        try:
+            self._file.close()
+            os.chmod(self._tmpname, self._mode)
+            os.replace(self._tmpname, self._filename)
+        except:
+            os.remove(self._tmpname)
+            raise
 
-    kwargs.update(annotated_args)
+    def discard(self):
+        """remove the temporary file, the file is not replaced"""
+        self._file.close()
+        os.remove(self._tmpname)
 
-    reformat_ffile(infile, newfile, orig_filename=filename, **kwargs)
 
-    if diffonly:
-        infile.seek(0)
-        newfile.seek(0)
-        diff_contents = diff(infile.read(), newfile.read(), filename, filename)
-        sys.stdout.write(diff_contents)
-    else:
+def _replace_file(filename, text):
+    """
+    write `text` to file `filename` through a temporary file that replaces it,
+    so that the file is never left partially written. File mode is preserved.
+    """
+    tmpfile = _ReplacementFile(filename)
+    try:
+        tmpfile.write(text)
+    except:
+        tmpfile.discard()
+        raise
+    tmpfile.commit()
 
-        if stdout:
-            sys.stdout.write(newfile.getvalue())
-        else:
-            outfile = io.open(filename, "r", encoding="utf-8")
 
-            # write to outfile only if content has changed
+class _FormatMismatch(Exception):
+    """raised by `_CheckStream` at the first difference"""
+
 
-            import hashlib
+class _CheckStream(object):
+    """
+    file-like object comparing written text with the text read from file
+    `reference`, raises `_FormatMismatch` as soon as the text differs.
+    Unless `outfile` is given: then the text is written to `outfile`.
+    Or, given a function `open_outfile`, the text is written to
+    `open_outfile(n)` from the first difference on, where n is the number of
+    equal characters before the difference.
+    """
 
-            hash_new = hashlib.md5()
-            hash_new.update(newfile.getvalue().encode("utf-8"))
-            hash_old = hashlib.md5()
-            hash_old.update(outfile.read().encode("utf-8"))
+    def __init__(self, reference, outfile=None, open_outfile=None):
+        self._reference = reference
+        self._outfile = outfile
+        self._open_outfile = open_outfile
+        self._pos = 0
+        self._changed = False
+
+    def write(self, text):
+        if not self._changed:
+            if self._reference.read(len(text)) == text:
+                self._pos += len(text)
+            else:
+                self._set_changed()
+        if self._outfile is not None:
+            self._outfile.write(text)
 
-            outfile.close()
+    def _set_changed(self):
+        if self._outfile is None and self._open_outfile is None:
+            raise _FormatMismatch()
+        self._changed = True
+        if self._outfile is None:
+            self._outfile = self._open_outfile(self._pos)
 
-            if hash_new.digest() != hash_old.digest():
-                outfile = io.open(filename, "w", encoding="utf-8")
-                outfile.write(newfile.getvalue())
+    def matches(self):
+        """whether the written text is equal to `reference`"""
+        if not self._changed and self._reference.read(1):
+            self._set_changed()
+        return not self._changed
+
+
+def reformat_inplace(
+    filename, stdout=False, diffonly=False, check=False, **kwargs
+):  # pragma: no cover
+    """
+    reformat a file in place, returns whether formatting changed the file.
+    If `check`, the file is not written and its name is printed if formatting
+    would change it, formatting stops at the first difference.
+    Files up to _MAX_IN_MEMORY_SIZE are read once and kept in memory. Larger
+    files (unless `diffonly` or memoization of results is enabled) are
+    formatted as a stream and compared with the original on the fly, they
+    are not read into memory.
+    """
+    instring = None
+    if filename == "-":
+        instring = sys.stdin.read()
+    elif os.path.getsize(filename) <= _MAX_IN_MEMORY_SIZE:
+        with io.open(filename, "r", encoding="utf-8") as f:
+            instring = f.read()
+    in_memory = instring is not None
+
+    def open_input():
+        """helper function to open the input for reading"""
+        if in_memory:
+            return io.StringIO(instring)
+        return io.open(filename, "r", encoding="utf-8")
+
+    with open_input() as infile, open_input() as reference:
+        # check fprettify annotations overriding any previously parsed options
+        arg_parser = None
+        annotated_args = {}
+        for line in infile:
+            match = FPRETTIY_ANNOTATION_RE.search(line)
+            if match:
+                if annotated_args:
+                    log_message(
+                        "Ignoring subsequent '! fprettify: ...' comments within same file."
+                    )
+                    continue
+
+                if arg_parser is None:
+                    arg_parser = get_arg_parser()
+                args_tmp = arg_parser.parse_args(shlex.split(match.group(1)))
+                annotated_args = process_args(args_tmp)
+
+        kwargs.update(annotated_args)
+        if annotated_args:
+            kwargs["style"] = None
+        kwargs = _style_kwargs(kwargs)
+
+        outstring = None
+        if not in_memory and (diffonly or _result_cache is not None):
+            instring = reference.read()
+            reference.seek(0)
+        if _result_cache is not None:
+            ranges = {k: v for k, v in kwargs.items() if k != "style"}
+            result_key = (kwargs["style"], json.dumps(ranges, sort_keys=True), instring)
+            outstring = _result_cache.get(result_key)
+
+        if outstring is None and check:
+            checkfile = _CheckStream(reference)
+            try:
+                reformat_ffile_ranges(
+                    infile, checkfile, orig_filename=filename, **kwargs
+                )
+                changed = not checkfile.matches()
+            except _FormatMismatch:
+                changed = True
+            if changed:
+                sys.stdout.write(filename + "\n")
+            return changed
+
+        if outstring is None and (in_memory or diffonly or _result_cache is not None):
+            newfile = io.StringIO()
+            n_log_messages = _n_log_messages
+            reformat_ffile_ranges(infile, newfile, orig_filename=filename, **kwargs)
+            outstring = newfile.getvalue()
+
+            # only memoize results that don't trigger any messages, also
+            # messages below the log level (they may be shown for later
+            # requests with another log level)
+            if _result_cache is not None and _n_log_messages == n_log_messages:
+                _result_cache[result_key] = outstring
+
+        if outstring is not None:
+            changed = instring != outstring
+            if check:
+                if changed:
+                    sys.stdout.write(filename + "\n")
+            elif diffonly:
+                diff_contents = diff(instring, outstring, filename, filename)
+                sys.stdout.write(diff_contents)
+            elif stdout:
+                sys.stdout.write(outstring)
+            elif changed:
+                # write to file only if content has changed
+                _replace_file(filename, outstring)
+            return changed
+
+        # format as a stream
+        if stdout:
+            # output is written only if formatting succeeds, it is kept in
+            # memory only if it is small
+            import tempfile
+
+            with tempfile.SpooledTemporaryFile(
+                _MAX_SPOOLED_SIZE, "w+", encoding="utf-8", newline=""
+            ) as spool:
+                outfile = _CheckStream(reference, outfile=spool)
+                reformat_ffile_ranges(infile, outfile, orig_filename=filename, **kwargs)
+                spool.seek(0)
+                for text in iter(lambda: spool.read(1 << 16), ""):
+                    sys.stdout.write(text)
+            return not outfile.matches()
+
+        # the file is replaced from the first difference on
+        replacement = []
+
+        def open_replacement(n_chars):
+            """
+            helper function to open the replacement of the file and to copy
+            the first `n_chars` characters (that are unchanged) into it
+            """
+            replacement.append(_ReplacementFile(filename))
+            with open_input() as prefix:
+                while n_chars:
+                    text = prefix.read(min(n_chars, 1 << 16))
+                    replacement[0].write(text)
+                    n_chars -= len(text)
+            return replacement[0]
+
+        outfile = _CheckStream(reference, open_outfile=open_replacement)
+        try:
+            reformat_ffile_ranges(infile, outfile, orig_filename=filename, **kwargs)
+            changed = not outfile.matches()
+        except:
+            if replacement:
+                replacement[0].discard()
+            raise
+
+    if changed:
+        replacement[0].commit()
+    return changed
+
+
+# size up to which intermediate results are kept in memory rather than in a
+# temporary file
+_MAX_SPOOLED_SIZE = 1 << 24
+
+# size of files up to which reformat_inplace reads them only once
+_MAX_IN_MEMORY_SIZE = 1 << 20
 
 
 def reformat_ffile(
@@ -2047,30 +3121,35 @@ def reformat_ffile(
     orig_filename=None,
     indent_fypp=True,
     indent_mod=True,
+    line_range=None,
+    style=None,
 ):
-    """main method to be invoked for formatting a Fortran file."""
+    """
+    main method to be invoked for formatting a Fortran file.
+    If `line_range` = (start, end) is given, only the Fortran lines overlapping
+    lines start to end (1-based, inclusive) are formatted, all other lines are
+    copied. Then the formatted lines (first, last) of `infile` are returned,
+    that is, start and end extended to entire Fortran lines.
+    A FormatStyle `style` replaces all formatting options.
+    """
 
     # note: whitespace formatting and indentation may require different parsing rules
     # (e.g. preprocessor statements may be indented but not whitespace formatted)
     # therefore we invoke reformat_ffile independently for:
     # 1) whitespace formatting
     # 2) indentation
+    # the output of 1) is passed line by line to 2), and if there are no fypp
+    # directives, indentation is inspected while formatting so that the
+    # output of 1) is parsed only once.
+    # The passes are chained, not fused: 2) parses the output of 1) since
+    # auto-split lines and fypp handling depend on the formatted text.
 
     if not orig_filename:
         orig_filename = infile.name
 
-    # 1) whitespace formatting
-    oldfile = infile
-    newfile = infile
-
-    if impose_whitespace:
-        _impose_indent = False
-
-        newfile = io.StringIO()
-        reformat_ffile_combined(
-            oldfile,
-            newfile,
-            _impose_indent,
+    if style is None:
+        style = FormatStyle(
+            impose_indent,
             indent_size,
             strict_indent,
             impose_whitespace,
@@ -2083,41 +3162,599 @@ def reformat_ffile(
             strip_comments,
             comment_spacing,
             format_decl,
-            orig_filename,
             indent_fypp,
             indent_mod,
         )
-        oldfile = newfile
+    impose_indent = style.impose_indent
+
+    infile.seek(0)
+    inspect_inline = impose_indent and not any(
+        FYPP_DIRECTIVE_RE.search(line) for line in infile
+    )
+    infile.seek(0)
+
+    chunks = None
+    oldfile = infile
+
+    # lines preceding the lines to be formatted are left out if they can't
+    # change scopes (see _scope_lines), formatted if they may change scopes
+    # (needed for indentation) and copied otherwise. Line numbers refer to
+    # infile, the numbers of the remaining lines are kept in line_numbers.
+    first_line, last_line = 1, None
+    line_numbers = None
+    if line_range is not None:
+        all_lines = infile.readlines()
+        start, end = line_range
+        end = min(end, len(all_lines))
+        start = max(1, min(start, end + 1))
+        indices = _scope_lines(all_lines, start) if start <= end else []
+        if inspect_inline:
+            scope_parser = build_scope_parser(fypp=False, mod=style.indent_mod)
+            indices = _reduce_scope_lines(
+                all_lines, indices, scope_parser, orig_filename
+            )
+        lines = [all_lines[_] for _ in indices] + all_lines[start - 1 :]
+        line_numbers = [_ + 1 for _ in indices]
+        line_numbers += range(start, len(all_lines) + 1)
+        first_line, last_line = _fline_span(
+            lines, len(indices) + 1, end - start + len(indices) + 1, orig_filename
+        )
+        if first_line <= last_line:
+            first_line = line_numbers[first_line - 1]
+            last_line = line_numbers[last_line - 1]
+        else:
+            first_line, last_line = start, end
+        span = first_line, last_line
+        oldfile = io.StringIO("".join(lines))
+
+    timer = None
+    if _slow_lines is not None and line_range is None:
+        timer = _LineTimer()
+
+    # 1) whitespace formatting
+    if style.impose_whitespace:
+        states = [] if timer is not None else None
+
+        chunks = _reformat_ffile_chunks(
+            oldfile,
+            style.replace(impose_indent=False),
+            orig_filename,
+            first_line=first_line,
+            last_line=last_line,
+            states=states,
+            line_numbers=line_numbers,
+        )
+        if timer is not None:
+            chunks = timer.time_pass(chunks, states)
+        if impose_indent:
+            if line_range is not None:
+                # output of 1) starts with a single chunk of the preceding lines
+                chunks = iter(chunks)
+                head = next(chunks) if first_line > 1 else ""
+                body = "".join(chunks)
+                oldfile = io.StringIO(head + body)
+                # numbers of preceding lines that were split are not exact
+                n_head = head.count("\n")
+                n_body = body.count("\n") + (bool(body) and not body.endswith("\n"))
+                line_numbers = line_numbers[
+                    : bisect.bisect(line_numbers, first_line - 1)
+                ]
+                line_numbers = line_numbers[:n_head]
+                line_numbers += [first_line - 1] * (n_head - len(line_numbers))
+                line_numbers += range(first_line, first_line + n_body)
+                last_line = first_line - 1 + n_body
+            elif inspect_inline:
+                oldfile = _ChunkReader(chunks, orig_filename)
+            else:
+                # indentation is inspected before formatting, this requires a
+                # seekable file that is kept in memory only if it is small
+                import tempfile
+
+                oldfile = tempfile.SpooledTemporaryFile(
+                    _MAX_SPOOLED_SIZE, "w+", encoding="utf-8", newline=""
+                )
+                oldfile.writelines(chunks)
+                oldfile.seek(0)
 
     # 2) indentation
     if impose_indent:
+        states = [] if timer is not None else None
 
-        _impose_whitespace = False
-        _impose_replacements = False
-
-        newfile = io.StringIO()
-        reformat_ffile_combined(
+        chunks = _reformat_ffile_chunks(
             oldfile,
-            newfile,
-            impose_indent,
-            indent_size,
-            strict_indent,
-            _impose_whitespace,
-            case_dict,
-            _impose_replacements,
-            cstyle,
-            whitespace,
-            whitespace_dict,
-            llength,
-            strip_comments,
-            comment_spacing,
-            format_decl,
+            style.replace(impose_whitespace=False, impose_replacements=False),
             orig_filename,
-            indent_fypp,
-            indent_mod,
+            inspect_inline,
+            first_line,
+            last_line,
+            states=states,
+            line_numbers=line_numbers,
         )
+        if timer is not None:
+            chunks = timer.time_pass(chunks, states)
+
+    if line_range is not None:
+        first_line, last_line = span
+        if chunks is None:
+            chunks = all_lines[first_line - 1 : last_line]
+        elif first_line > 1:
+            # preceding lines are copied instead
+            chunks = iter(chunks)
+            next(chunks)
+        outfile.write("".join(all_lines[: first_line - 1]))
+        for chunk in chunks:
+            outfile.write(chunk)
+        outfile.write("".join(all_lines[last_line:]))
+        return span
+
+    if chunks is None:
+        chunks = iter(lambda: infile.read(1 << 16), "")
+
+    for chunk in chunks:
+        outfile.write(chunk)
+
+    if timer is not None:
+        for line in timer.lines():
+            _slow_lines.add(line[0], orig_filename, *line[1:])
+
+
+def reformat_ffile_range(infile, outfile, start, end, **kwargs):
+    """
+    format only the Fortran lines overlapping lines `start` to `end` (1-based,
+    inclusive) of `infile` and write only these lines to `outfile` (e.g. to
+    format a selection in an editor). Returns the lines (first, last) of
+    `infile` that are replaced by the output, see `reformat_ffile`.
+
+    Lines before `start` are not formatted, but their scope statements are
+    parsed to determine the indent, and closed blocks are then left out.
+    """
+    text = io.StringIO()
+    first, last = reformat_ffile(infile, text, line_range=(start, end), **kwargs)
+    infile.seek(0)
+    lines = infile.readlines()
+    text = text.getvalue()
+    text_start = len("".join(lines[: first - 1]))
+    text_end = len(text) - len("".join(lines[last:]))
+    outfile.write(text[text_start:text_end])
+    return first, last
+
+
+def reformat_ffile_ranges(infile, outfile, line_ranges=None, **kwargs):
+    """
+    format only the Fortran lines overlapping any of the ranges of lines
+    `line_ranges` = [(start, end), ...] (1-based, inclusive) of `infile`, all
+    other lines are left unchanged. Formats the entire file if `line_ranges` is
+    None.
+    """
+    if line_ranges is None:
+        reformat_ffile(infile, outfile, **kwargs)
+        return
+
+    merged = []
+    for start, end in sorted(line_ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    # from the last range to the first so that line numbers remain valid
+    infile.seek(0)
+    text = infile.read()
+    for start, end in reversed(merged):
+        newfile = io.StringIO()
+        reformat_ffile(io.StringIO(text), newfile, line_range=(start, end), **kwargs)
+        text = newfile.getvalue()
+    outfile.write(text)
+
+
+class _IncrementalPass(object):
+    """
+    one pass of formatting (see reformat_ffile) of lines that are edited,
+    keeps the output of the Fortran lines ending on each input line and the
+    state of formatting after it.
+    """
+
+    def __init__(self, chunk_args):
+        # keyword arguments of _reformat_ffile_chunks
+        self._chunk_args = chunk_args
+        self._input = []
+        self._chunks = []
+        self._states = []
+        # number of output lines terminated on each input line
+        self._n_lines = []
+        self._unterminated = False
+
+    def edit(self, start, end, lines, resume=True):
+        """
+        replace input lines `start` to `end` (1-based, inclusive) by `lines`
+        and format. If `resume`, formatting resumes before the edited lines
+        and stops at the first line after them with the same state as before
+        the edit. Returns the resulting edit (start, end, lines) of the output.
+        """
+        old_input = self._input
+        new_input = old_input[: start - 1] + lines + old_input[end:]
+        delta = len(new_input) - len(old_input)
+        edit_end = start - 1 + len(lines)
+
+        # the state after a line depends on the next line, so formatting
+        # resumes from the second to last state before the edited lines
+        first = 0
+        if resume:
+            n_found = 0
+            for line_nr in range(start - 1, 0, -1):
+                if self._states[line_nr - 1] is not None:
+                    n_found += 1
+                    if n_found == 2:
+                        first = line_nr
+                        break
+
+        # indentation is inspected inline unless the text has fypp directives
+        if resume:
+            infile = _ChunkReader(islice(new_input, first, None), None)
+        else:
+            infile = io.StringIO("".join(new_input))
+        chunk_states = []
+        chunks = _reformat_ffile_chunks(
+            infile,
+            inspect_inline=resume and self._chunk_args["style"].impose_indent,
+            state=self._states[first - 1] if first else None,
+            states=chunk_states,
+            **self._chunk_args
+        )
+
+        # output and states of input lines first + 1, ...
+        out_chunks = []
+        out_states = []
+        last = len(old_input)
+        try:
+            for chunk in chunks:
+                line_nr, state = chunk_states[-1]
+                # a continuation at the end of the input ends on its last line
+                line_nr = min(line_nr + first, len(new_input))
+                prev_line_nr = first + len(out_chunks)
+                if line_nr == prev_line_nr:
+                    # several Fortran lines on the same line
+                    out_chunks[-1] += chunk
+                    out_states[-1] = state
+                    continue
+
+                if out_chunks and not out_chunks[-1].endswith("\n"):
+                    # next Fortran line starts on the same line
+                    out_states[-1] = None
+
+                old_line_nr = prev_line_nr - delta
+                if (
+                    resume
+                    and out_states
+                    and prev_line_nr >= edit_end
+                    and old_line_nr > 0
+                    and out_states[-1] is not None
+                    and out_states[-1] == self._states[old_line_nr - 1]
+                ):
+                    # following lines are formatted as before
+                    last = old_line_nr
+                    break
+
+                n_skipped = line_nr - prev_line_nr - 1
+                out_chunks += [""] * n_skipped + [chunk]
+                out_states += [None] * n_skipped + [state]
+            else:
+                n_skipped = len(new_input) - first - len(out_chunks)
+                out_chunks += [""] * n_skipped
+                out_states += [None] * n_skipped
+        except FprettifyException as e:
+            # line numbers of the input
+            e.line_nr += first
+            raise
+
+        out_start = sum(self._n_lines[:first]) + 1
+        out_end = sum(self._n_lines[:last])
+        if last == len(old_input) and self._unterminated:
+            out_end += 1
+
+        self._input = new_input
+        self._chunks[first:last] = out_chunks
+        self._states[first:last] = out_states
+        self._n_lines[first:last] = [c.count("\n") for c in out_chunks]
+        tail = next((c for c in reversed(self._chunks) if c), "")
+        self._unterminated = bool(tail) and not tail.endswith("\n")
+
+        return out_start, out_end, _split_lines("".join(out_chunks))
+
+    def get_input(self, start=1, end=None):
+        """input lines `start` to `end` (default: all lines)"""
+        return self._input[start - 1 : end]
+
+    def get_output(self):
+        """all output lines"""
+        return _split_lines("".join(self._chunks))
+
+
+def _split_lines(text):
+    """split `text` into lines as InputStream does"""
+    return io.StringIO(text).readlines()
+
+
+def _changed_lines(old, new):
+    """
+    edit (start, end, lines) replacing the lines of `old` that differ from
+    `new`, None if they are equal
+    """
+    n = min(len(old), len(new))
+    prefix = next((i for i in range(n) if old[i] != new[i]), n)
+    n -= prefix
+    suffix = next((i for i in range(n) if old[-1 - i] != new[-1 - i]), n)
+    if prefix == len(old) == len(new):
+        return None
+    return prefix + 1, len(old) - suffix, new[prefix : len(new) - suffix]
+
+
+class IncrementalFormatter(object):
+    """
+    Formatter of a Fortran text that is edited repeatedly (format as you
+    type). After an edit, formatting resumes shortly before the edited lines
+    and stops as soon as the state of formatting after a line (scopes,
+    indents) agrees with the state before the edit. Formatting options are
+    the same as for reformat_ffile.
+    Texts with fypp directives are formatted entirely.
+    """
+
+    def __init__(
+        self,
+        text,
+        impose_indent=True,
+        indent_size=3,
+        strict_indent=False,
+        impose_whitespace=True,
+        case_dict={},
+        impose_replacements=False,
+        cstyle=False,
+        whitespace=2,
+        whitespace_dict={},
+        llength=132,
+        strip_comments=False,
+        comment_spacing=1,
+        format_decl=False,
+        orig_filename="<buffer>",
+        indent_fypp=True,
+        indent_mod=True,
+        style=None,
+    ):
+        if style is None:
+            style = FormatStyle(
+                impose_indent,
+                indent_size,
+                strict_indent,
+                impose_whitespace,
+                case_dict,
+                impose_replacements,
+                cstyle,
+                whitespace,
+                whitespace_dict,
+                llength,
+                strip_comments,
+                comment_spacing,
+                format_decl,
+                indent_fypp,
+                indent_mod,
+            )
+
+        # same passes as in reformat_ffile
+        self._passes = []
+        self._indent_pass = None
+        if style.impose_whitespace:
+            self._passes.append(
+                _IncrementalPass(
+                    dict(
+                        style=style.replace(impose_indent=False),
+                        orig_filename=orig_filename,
+                    )
+                )
+            )
+        if style.impose_indent:
+            self._indent_pass = _IncrementalPass(
+                dict(
+                    style=style.replace(
+                        impose_whitespace=False, impose_replacements=False
+                    ),
+                    orig_filename=orig_filename,
+                )
+            )
+            self._passes.append(self._indent_pass)
+
+        self._lines = []
+        self._n_fypp_lines = 0
+        self.edit([(1, 0, text)])
+
+    def get_text(self):
+        """formatted text"""
+        return "".join(self._lines)
+
+    def edit(self, edits):
+        """
+        apply `edits` to the formatted text and format it, each edit
+        (start, end, text) replaces lines `start` to `end` (1-based,
+        inclusive, `end` = `start` - 1 to insert) by `text`. Edits are applied
+        one after another. Returns the formatted text.
+        Raises FprettifyException like reformat_ffile, then the edit that
+        could not be formatted is not applied.
+        """
+        for start, end, text in edits:
+            lines = _split_lines(text)
+            if lines and not lines[-1].endswith("\n") and end < len(self._lines):
+                lines[-1] += "\n"
+
+            if not self._passes:
+                self._lines[start - 1 : end] = lines
+                continue
+
+            self._format_edit(start, end, lines)
+            # formatting formatted lines may change them again, so the output
+            # may differ from the previous text also away from the edit
+            self._lines = self._passes[-1].get_output()
+
+            # edits refer to the formatted text, so this is the input from now on
+            edit = _changed_lines(self._passes[0].get_input(), self._lines)
+            if edit is not None:
+                self._format_edit(*edit)
+
+        return self.get_text()
+
+    def _format_edit(self, start, end, lines):
+        """format an edit of the input, returns the edit of the output"""
+        if not self._passes:
+            return start, end, lines
+
+        n_fypp_lines = self._n_fypp_lines
+        for l in self._passes[0].get_input(start, end):
+            n_fypp_lines -= bool(FYPP_DIRECTIVE_RE.search(l))
+        for l in lines:
+            n_fypp_lines += bool(FYPP_DIRECTIVE_RE.search(l))
+
+        done = []
+        try:
+            for pass_ in self._passes:
+                # states of the indentation pass depend on whether there are
+                # fypp directives
+                resume = pass_ is not self._indent_pass or not (
+                    n_fypp_lines or self._n_fypp_lines
+                )
+                old_lines = pass_.get_input(start, end)
+                output_edit = pass_.edit(start, end, lines, resume)
+                done.append((pass_, start, len(lines), old_lines, resume))
+                start, end, lines = output_edit
+        except FprettifyException:
+            # undo edit
+            for pass_, start, n_lines, old_lines, resume in reversed(done):
+                pass_.edit(start, start - 1 + n_lines, old_lines, resume)
+            raise
+
+        self._n_fypp_lines = n_fypp_lines
+        return start, end, lines
+
+
+class _LineTimer(object):
+    """
+    measures the time of each Fortran line through the passes of
+    reformat_ffile, the time of a pass excludes the time of the preceding pass
+    """
+
+    def __init__(self):
+        # per pass, (line number, chunk, time in ns) per chunk
+        self._passes = []
+        # per pass, total time in ns
+        self._times = []
+
+    def time_pass(self, chunks, states):
+        """
+        iterator over the `chunks` of a pass, `states` is the list of states
+        filled by `_reformat_ffile_chunks`. Passes must be added in order.
+        """
+        # passes are registered here and not in the (lazy) generator since
+        # the generator of the last pass runs first
+        level = len(self._passes)
+        records = []
+        self._passes.append(records)
+        self._times.append(0)
+        return self._time_chunks(level, iter(chunks), states, records)
+
+    def _time_chunks(self, level, chunks, states, records):
+        while True:
+            prev_time = self._times[level - 1] if level else 0
+            start = time.perf_counter_ns()
+            chunk = next(chunks, None)
+            ns = time.perf_counter_ns() - start
+            self._times[level] += ns
+            if chunk is None:
+                return
+            if level:
+                ns -= self._times[level - 1] - prev_time
+            records.append((states[-1][0], chunk, ns))
+            yield chunk
+
+    def lines(self):
+        """
+        list of (time in ns, first line number, number of lines, number of
+        characters) for each Fortran line of the input. Fortran lines
+        sharing a line (separated by semicolons) are counted as one.
+        """
+        lines = []
+        # index in lines and last line of the output, per chunk of 1st pass
+        chunk_lines = []
+        out_line_nr = 0
+        prev_line_nr = 0
+        for line_nr, chunk, ns in self._passes[0]:
+            if lines and line_nr == prev_line_nr:
+                lines[-1][0] += ns
+                lines[-1][3] += len(chunk.rstrip("\n"))
+            else:
+                n_lines = line_nr - prev_line_nr
+                n_chars = len(chunk.rstrip("\n"))
+                lines.append([ns, prev_line_nr + 1, n_lines, n_chars])
+                prev_line_nr = line_nr
+            out_line_nr += chunk.count("\n")
+            chunk_lines.append((out_line_nr, len(lines) - 1))
+
+        # lines of the 2nd pass are numbered by the lines of the 1st pass
+        if len(self._passes) > 1 and lines:
+            ends = [_[0] for _ in chunk_lines]
+            for line_nr, _, ns in self._passes[1]:
+                index = min(bisect.bisect_left(ends, line_nr), len(ends) - 1)
+                lines[chunk_lines[index][1]][0] += ns
+
+        return [tuple(_) for _ in lines]
+
 
-    outfile.write(newfile.getvalue())
+class _LineCache(OrderedDict):
+    """
+    memo of formatted Fortran lines, least recently used lines are evicted.
+    Counts hits and misses of lookups.
+    """
+
+    def __init__(self, max_entries):
+        super(_LineCache, self).__init__()
+        self._max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key not in self:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super(_LineCache, self).__setitem__(key, value)
+        if len(self) > self._max_entries:
+            self.popitem(last=False)
+
+
+class _ChunkReader(object):
+    """read lines from an iterator over formatted text chunks (file-like)"""
+
+    def __init__(self, chunks, name):
+        self._chunks = iter(chunks)
+        self._text = ""
+        self._pos = 0
+        self.name = name
+
+    def readline(self):
+        end = self._text.find("\n", self._pos)
+        while end == -1:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                line = self._text[self._pos :]
+                self._text = ""
+                self._pos = 0
+                return line
+            self._text = self._text[self._pos :] + chunk
+            self._pos = 0
+            end = self._text.find("\n")
+        line = self._text[self._pos : end + 1]
+        self._pos = end + 1
+        return line
 
 
 def reformat_ffile_combined(
@@ -2139,24 +3776,97 @@ def reformat_ffile_combined(
     orig_filename=None,
     indent_fypp=True,
     indent_mod=True,
+    style=None,
+):
+    if style is None:
+        style = FormatStyle(
+            impose_indent,
+            indent_size,
+            strict_indent,
+            impose_whitespace,
+            case_dict,
+            impose_replacements,
+            cstyle,
+            whitespace,
+            whitespace_dict,
+            llength,
+            strip_comments,
+            comment_spacing,
+            format_decl,
+            indent_fypp,
+            indent_mod,
+        )
+    for chunk in _reformat_ffile_chunks(infile, style, orig_filename):
+        outfile.write(chunk)
+
+
+def _reformat_ffile_chunks(
+    infile,
+    style,
+    orig_filename=None,
+    inspect_inline=False,
+    first_line=1,
+    last_line=None,
+    state=None,
+    states=None,
+    line_numbers=None,
 ):
+    """
+    generator of formatted text, one chunk per Fortran line.
+    If `inspect_inline`, indentation is inspected while formatting, this
+    requires a file without fypp directives (which needs not be seekable).
+    Only Fortran lines ending within lines `first_line` to `last_line` are
+    formatted, preceding lines are formatted only if they may change scopes
+    and are otherwise copied. These are yielded as a single chunk first.
+    If a list `states` is given, (line number, state) is appended to it
+    before a chunk is yielded, where state is the state of formatting after
+    that Fortran line (None if formatting can't be resumed from there).
+    Given such a `state`, formatting resumes as if `infile` followed that
+    line, this requires `inspect_inline` if indentation is imposed.
+    If `line_numbers` is given, the lines of `infile` have these (increasing)
+    line numbers, e.g. if lines were left out.
+    """
 
     if not orig_filename:
         orig_filename = infile.name
 
-    if not impose_indent:
+    impose_indent = style.impose_indent
+    indent_size = style.indent_size
+    strict_indent = style.strict_indent
+    impose_whitespace = style.impose_whitespace
+    indent_fypp = style.indent_fypp and impose_indent
+
+    if inspect_inline:
+        # fypp directives would need different parsing rules for inspection
         indent_fypp = False
+    elif not impose_indent:
+        # target indents are not needed
+        req_indents, first_indent = [], 0
+    else:
+        infile.seek(0)
+        req_indents, first_indent, has_fypp = inspect_ffile_format(
+            infile, indent_size, strict_indent, indent_fypp, orig_filename
+        )
+        infile.seek(0)
 
-    infile.seek(0)
-    req_indents, first_indent, has_fypp = inspect_ffile_format(
-        infile, indent_size, strict_indent, indent_fypp, orig_filename
-    )
-    infile.seek(0)
+        if not has_fypp:
+            indent_fypp = False
 
-    if not has_fypp:
-        indent_fypp = False
+    stream = InputStream(infile, not indent_fypp, orig_filename=orig_filename)
+    if inspect_inline:
+        flines = _InspectedStream(
+            stream, indent_size, strict_indent, state[-1] if state else None
+        )
+        first_indent = flines.first_indent
+    else:
+        flines = _read_flines(stream, req_indents)
 
-    scope_parser = build_scope_parser(fypp=indent_fypp, mod=indent_mod)
+    scope_parser = build_scope_parser(fypp=indent_fypp, mod=style.indent_mod)
+    line_cache = _line_cache
+    line_store = _line_store
+    memoize = (line_cache is not None or line_store is not None) and (
+        impose_whitespace or style.impose_replacements or style.impose_case
+    )
 
     # initialization
 
@@ -2172,21 +3882,25 @@ def reformat_ffile_combined(
     else:
         indent_special = 3
 
-    impose_case = not all(v == 0 for v in case_dict.values())
-
-    nfl = 0  # fortran line counter
     use_same_line = False
-    stream = InputStream(infile, not indent_fypp, orig_filename=orig_filename)
     skip_blank = False
     in_format_off_block = False
+    outfile = io.StringIO()
 
-    while 1:
-        f_line, comments, lines = stream.next_fortran_line()
+    if state is not None:
+        indent_special, skip_blank, use_same_line, in_format_off_block = state[:4]
+        if impose_indent:
+            indenter.set_state(state[4])
 
-        if not lines:
-            break
+    # output of the lines preceding first_line, yielded as a single chunk
+    skipped = [] if first_line > 1 else None
+    dispatcher = ScopeDispatcher(scope_parser)
 
-        nfl += 1
+    for f_line, comments, lines, line_nr, rel_indent in flines:
+        if line_numbers is not None:
+            line_nr = line_numbers[line_nr - 1]
+        if last_line is not None and line_nr > last_line:
+            break
         orig_lines = lines
 
         f_line, lines, is_omp_conditional = preprocess_omp(f_line, lines)
@@ -2198,15 +3912,15 @@ def reformat_ffile_combined(
             indent = [len(l) - len((l.lstrip(" ")).lstrip("&")) for l in lines]
 
         comment_lines = format_comments(
-            lines, comments, strip_comments, comment_spacing
+            lines, comments, style.strip_comments, style.comment_spacing
         )
 
         auto_align, auto_format, in_format_off_block = parse_fprettify_directives(
-            lines, comment_lines, in_format_off_block, orig_filename, stream.line_nr
+            lines, comment_lines, in_format_off_block, orig_filename, line_nr
         )
 
         lines, do_format, prev_indent, is_blank, is_special = preprocess_line(
-            f_line, lines, comments, orig_filename, stream.line_nr, indent_fypp
+            f_line, lines, comments, orig_filename, line_nr, indent_fypp
         )
 
         if is_special[0]:
@@ -2217,12 +3931,31 @@ def reformat_ffile_combined(
 
         if is_blank and skip_blank:
             continue
+        # lines preceding first_line are copied unless they may change scopes
+        copy_line = line_nr < first_line and not (
+            do_format
+            and dispatcher.may_match(
+                CharFilter(f_line, filter_fypp=not indent_fypp).filter_all()
+            )
+        )
         if not do_format:
             if indent_special == 2:
                 # inherit indent from previous line
                 indent[:] = [indenter.get_fline_indent()] * len(indent)
             elif indent_special == 0:
                 indent_special = 1
+        elif copy_line:
+            # only keep track of indentation
+            if indent_special != 3:
+                indenter.process_lines_of_fline(
+                    f_line.strip(" "),
+                    lines,
+                    rel_indent,
+                    indent_size,
+                    line_nr,
+                    indent_fypp,
+                    [0] * len(lines),
+                )
         else:
 
             if not auto_align:
@@ -2231,39 +3964,68 @@ def reformat_ffile_combined(
                 manual_lines_indent = []
 
             lines, pre_ampersand, ampersand_sep = remove_pre_ampersands(
-                lines, is_special, orig_filename, stream.line_nr
+                lines, is_special, orig_filename, line_nr
             )
 
             linebreak_pos = get_linebreak_pos(
-                lines, not indent_fypp, orig_filename, stream.line_nr
+                lines, not indent_fypp, orig_filename, line_nr
             )
 
             f_line = f_line.strip(" ")
 
-            if impose_replacements:
-                f_line = replace_relational_single_fline(f_line, cstyle)
-
-            if impose_case:
-                f_line = replace_keywords_single_fline(f_line, case_dict)
-
-            if impose_whitespace:
-                lines = format_single_fline(
+            # formatting of the Fortran line doesn't depend on its context,
+            # results are memoized unless they trigger any messages
+            cached = None
+            if memoize:
+                key = (
                     f_line,
-                    whitespace,
-                    whitespace_dict,
-                    linebreak_pos,
-                    ampersand_sep,
-                    scope_parser,
-                    format_decl,
-                    orig_filename,
-                    stream.line_nr,
+                    tuple(linebreak_pos),
+                    tuple(ampersand_sep),
                     auto_format,
+                    indent_fypp,
                 )
+                if line_cache is not None:
+                    cached = line_cache.get(key + (style,))
+                if cached is None and line_store is not None:
+                    cached = line_store.get(style, key)
+                    if cached is not None and line_cache is not None:
+                        line_cache[key + (style,)] = cached
+                n_log_messages = _n_log_messages
+
+            if cached is not None:
+                f_line = cached[0]
+                if impose_whitespace:
+                    lines = list(cached[1])
+                info = StatementInfo(f_line, scope_parser, dispatcher, not indent_fypp)
+            else:
+                for rule in style.rules:
+                    f_line = rule(f_line)
+
+                # classification of the Fortran line shared by all stages
+                info = StatementInfo(f_line, scope_parser, dispatcher, not indent_fypp)
+
+                if impose_whitespace:
+                    lines = format_single_fline_style(
+                        f_line,
+                        style,
+                        linebreak_pos,
+                        ampersand_sep,
+                        scope_parser,
+                        orig_filename,
+                        line_nr,
+                        auto_format,
+                        info,
+                    )
 
-                lines = append_comments(lines, comment_lines, is_special)
+                if memoize and _n_log_messages == n_log_messages:
+                    output = tuple(lines) if impose_whitespace else None
+                    if line_cache is not None:
+                        line_cache[key + (style,)] = (f_line, output)
+                    if line_store is not None:
+                        line_store.add(style, key, (f_line, output))
 
-            # target indent for next line
-            rel_indent = req_indents[nfl] if nfl < len(req_indents) else 0
+            if impose_whitespace:
+                lines = append_comments(lines, comment_lines, is_special)
 
             if indent_special != 3:
                 indenter.process_lines_of_fline(
@@ -2271,43 +4033,47 @@ def reformat_ffile_combined(
                     lines,
                     rel_indent,
                     indent_size,
-                    stream.line_nr,
+                    line_nr,
                     indent_fypp,
                     manual_lines_indent,
+                    info,
                 )
                 indent = indenter.get_lines_indent()
 
             lines, indent = prepend_ampersands(lines, indent, pre_ampersand)
 
-        if any(is_special):
-            for pos, line in enumerate(lines):
-                if is_special[pos]:
-                    indent[pos] = len(line) - len(line.lstrip(" "))
-                    lines[pos] = line.lstrip(" ")
-
-        lines = remove_trailing_whitespace(lines)
-
-        # need to shift indents if label wider than first indent
-        if label and impose_indent:
-            if indent[0] < len(label):
-                indent = [ind + len(label) - indent[0] for ind in indent]
-
-        allow_auto_split = auto_format and (impose_whitespace or impose_indent)
-        write_formatted_line(
-            outfile,
-            indent,
-            lines,
-            orig_lines,
-            indent_special,
-            indent_size,
-            llength,
-            use_same_line,
-            is_omp_conditional,
-            label,
-            orig_filename,
-            stream.line_nr,
-            allow_split=allow_auto_split,
-        )
+        if copy_line:
+            outfile.write("".join(orig_lines))
+        else:
+            if any(is_special):
+                for pos, line in enumerate(lines):
+                    if is_special[pos]:
+                        indent[pos] = len(line) - len(line.lstrip(" "))
+                        lines[pos] = line.lstrip(" ")
+
+            lines = remove_trailing_whitespace(lines)
+
+            # need to shift indents if label wider than first indent
+            if label and impose_indent:
+                if indent[0] < len(label):
+                    indent = [ind + len(label) - indent[0] for ind in indent]
+
+            allow_auto_split = auto_format and (impose_whitespace or impose_indent)
+            write_formatted_line(
+                outfile,
+                indent,
+                lines,
+                orig_lines,
+                indent_special,
+                indent_size,
+                style.llength,
+                use_same_line,
+                is_omp_conditional,
+                label,
+                orig_filename,
+                line_nr,
+                allow_split=allow_auto_split,
+            )
 
         # rm subsequent blank lines
         skip_blank = (
@@ -2326,6 +4092,37 @@ def reformat_ffile_combined(
             else:
                 indent_special = 1
 
+        if line_nr < first_line:
+            skipped.append(outfile.getvalue())
+        else:
+            if skipped is not None:
+                yield "".join(skipped)
+                skipped = None
+            if states is not None:
+                indenter_state = indenter.get_state() if impose_indent else None
+                if impose_indent and indenter_state is None:
+                    states.append((line_nr, None))
+                else:
+                    states.append(
+                        (
+                            line_nr,
+                            (
+                                indent_special,
+                                bool(skip_blank),
+                                use_same_line,
+                                in_format_off_block,
+                                indenter_state,
+                                flines.offset if inspect_inline else None,
+                            ),
+                        )
+                    )
+            yield outfile.getvalue()
+        outfile.seek(0)
+        outfile.truncate()
+
+    if skipped is not None:
+        yield "".join(skipped)
+
 
 def format_comments(lines, comments, strip_comments, comment_spacing=1):
     comments_ftd = []
@@ -2497,10 +4294,15 @@ def get_linebreak_pos(lines, filter_fypp, filename, line_nr):
         notfortran_re = NOTFORTRAN_FYPP_LINE_RE
 
     for line in lines:
+        # last ampersand (outside comments) that is a line break
         found = None
-        for char_pos, _ in CharFilter(line, filter_strings=False):
-            if re.match(LINEBREAK_STR, line[char_pos:], RE_FLAGS):
+        for start, end in reversed(CharFilter(line, filter_strings=False).spans()):
+            char_pos = line.rfind("&", start, end)
+            while char_pos != -1 and not LINEBREAK_RE.match(line, char_pos):
+                char_pos = line.rfind("&", start, char_pos)
+            if char_pos != -1:
                 found = char_pos
+                break
         if found:
             if re.search("&&", line, RE_FLAGS):
                 raise FprettifyParseException(
@@ -2510,9 +4312,7 @@ def get_linebreak_pos(lines, filter_fypp, filename, line_nr):
         elif notfortran_re.search(line.lstrip(" ")):
             linebreak_pos.append(0)
 
-    linebreak_pos = [
-        sum(linebreak_pos[0 : _ + 1]) - 1 for _ in range(0, len(linebreak_pos))
-    ]
+    linebreak_pos = [pos - 1 for pos in accumulate(linebreak_pos)]
 
     return linebreak_pos
 
@@ -2574,24 +4374,15 @@ def _find_split_position(text, max_width):
     if search_limit < 0:
         return None
 
-    spaces = []
-    commas = []
+    spans = CharFilter(text).spans()
 
-    for pos, char in CharFilter(text):
-        if pos > search_limit:
-            break
-        if char == " ":
-            spaces.append(pos)
-        elif char == ",":
-            commas.append(pos)
-
-    for candidate in reversed(spaces):
-        if len(text) - candidate >= 12:
-            return candidate
-
-    for candidate in reversed(commas):
-        if len(text) - candidate > 4:
-            return candidate + 1
+    # last space leaving at least 12 characters, last comma leaving at least 5
+    for char, limit, shift in ((" ", len(text) - 12, 0), (",", len(text) - 5, 1)):
+        end_max = max(0, min(search_limit, limit) + 1)
+        for start, end in reversed(spans):
+            candidate = text.rfind(char, start, min(end, end_max))
+            if candidate != -1:
+                return candidate + shift
 
     return None
 
@@ -2614,13 +4405,9 @@ def _auto_split_line(line, ind_use, llength, indent_size):
     if line_has_newline:
         stripped = stripped[:-1]
 
-    has_comment = False
-    for _, char in CharFilter(stripped, filter_comments=False):
-        if char == "!":
-            has_comment = True
-            break
-    if has_comment:
-        return None
+    for start, end in CharFilter(stripped, filter_comments=False).spans():
+        if stripped.find("!", start, end) != -1:
+            return None  # has comment
 
     max_first = llength - ind_use - 2  # reserve for trailing ampersand
     if max_first <= 0:
@@ -2758,10 +4545,8 @@ def write_formatted_line(
         orig_line = orig_lines[idx]
 
         # get actual line length excluding comment:
-        line_length = 0
-        for line_length, _ in CharFilter(line):
-            pass
-        line_length += 1
+        spans = CharFilter(line).spans()
+        line_length = spans[-1][1] if spans else 1
 
         if indent_special != 1:
             ind_use = ind
@@ -2870,14 +4655,59 @@ def set_fprettify_logger(level):
     logger.addHandler(stream_handler)
 
 
+class _LogRecordBuffer(logging.Handler):
+    """
+    logging handler that keeps records in memory so that messages of a worker
+    process can be passed to the parent process and emitted there.
+    """
+
+    def __init__(self):
+        super(_LogRecordBuffer, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        # merge message and arguments so that record can be pickled
+        record_dict = dict(record.__dict__)
+        record_dict["msg"] = record.getMessage()
+        record_dict["args"] = None
+        if record.exc_info:
+            record_dict["exc_text"] = logging.Formatter().formatException(
+                record.exc_info
+            )
+        record_dict["exc_info"] = None
+        self.records.append(record_dict)
+
+    def pop_records(self):
+        records = self.records
+        self.records = []
+        return records
+
+
+class _LogRecordCounter(logging.Handler):
+    """logging handler that counts messages"""
+
+    def __init__(self):
+        super(_LogRecordCounter, self).__init__()
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
 def log_exception(e, message, level="exception"):
     """log an exception and a message"""
     log_message(message, level, e.filename, e.line_nr)
 
 
+# number of messages logged so far (including messages below the log level)
+_n_log_messages = 0
+
+
 def log_message(message, level, filename, line_nr):
     """log a message"""
+    global _n_log_messages
 
+    _n_log_messages += 1
     logger = logging.getLogger("fprettify-logger")
     logger_d = {"ffilename": filename, "fline": line_nr}
     logger_to_use = getattr(logger, level)
@@ -2931,7 +4761,10 @@ def process_args(args):
 
 
 def get_arg_parser(args={}):
-    """helper function to create the parser object"""
+    """
+    helper function to create the parser object, a parser of configargparse if
+    `args` contains options for config files
+    """
 
     def str2bool(str):
         """helper function to convert strings to bool"""
@@ -2952,7 +4785,31 @@ def get_arg_parser(args={}):
             raise argparse.ArgumentTypeError("expected a non-negative integer")
         return int_value
 
-    parser = argparse.ArgumentParser(**args)
+    def positive_int(value):
+        """helper function to ensure a positive integer"""
+        int_value = non_negative_int(value)
+        if int_value == 0:
+            raise argparse.ArgumentTypeError("expected a positive integer")
+        return int_value
+
+    def line_range(value):
+        """helper function to parse a range of lines START:END"""
+        try:
+            start, end = value.split(":")
+        except ValueError:
+            raise argparse.ArgumentTypeError("expected START:END")
+        start, end = positive_int(start), positive_int(end)
+        if start > end:
+            raise argparse.ArgumentTypeError("START must not be greater than END")
+        return start, end
+
+    if "args_for_setting_config_path" in args or "default_config_files" in args:
+        # config files are in play, only then the (slow) import is worthwhile
+        import configargparse
+
+        parser = configargparse.ArgumentParser(**args)
+    else:
+        parser = argparse.ArgumentParser(**args)
 
     parser.add_argument(
         "-i", "--indent", type=int, default=3, help="relative indentation width"
@@ -3145,6 +5002,52 @@ def get_arg_parser(args={}):
         default=False,
         help="Write file differences to stdout instead of formatting inplace",
     )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="Don't write files, print the names of files that are not formatted "
+        "and exit with status 1 if there are any",
+    )
+    parser.add_argument(
+        "--line-range",
+        type=line_range,
+        metavar="START:END",
+        help="Format only the lines START to END (1-based, inclusive), extended to "
+        "entire Fortran lines, all other lines are left unchanged",
+    )
+    parser.add_argument(
+        "--changed-since",
+        type=str,
+        metavar="REF",
+        help="Format only the Fortran files in the given paths (default: current "
+        "directory) that were added or modified since git revision REF, including "
+        "uncommitted and untracked files",
+    )
+    parser.add_argument(
+        "--hunks-only",
+        action="store_true",
+        default=False,
+        help="With --changed-since, format only the changed lines, extended to "
+        "entire Fortran lines",
+    )
+    parser.add_argument(
+        "--profile-phases",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="Measure the time spent in each phase of formatting and write it per "
+        "file and in total as a table to stderr, or as JSON to FILE. Files are "
+        "formatted one at a time and are not skipped if cached",
+    )
+    parser.add_argument(
+        "--report-slow-lines",
+        type=positive_int,
+        metavar="N",
+        help="Measure the time of each Fortran line and write the N slowest lines "
+        "of all files to stderr. Files are formatted one at a time and are not "
+        "skipped if cached",
+    )
     parser.add_argument(
         "-s",
         "--stdout",
@@ -3204,26 +5107,313 @@ def get_arg_parser(args={}):
         default=[],
         help="Overrides default fortran extensions recognized by --recursive. Repeat this option to specify more than one extension.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes for formatting multiple files in parallel",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Directory of the cache of formatted files, these files are skipped if "
+        "unchanged (default: $XDG_CACHE_HOME/fprettify or ~/.cache/fprettify)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Don't use the cache of formatted files",
+    )
+    parser.add_argument(
+        "--line-cache",
+        type=str,
+        metavar="PATH",
+        help="Database file of a persistent cache of formatted Fortran lines, "
+        "shared by runs and parallel jobs, so that only changed lines of edited "
+        "files are formatted",
+    )
     parser.add_argument("--version", action="version", version="%(prog)s 0.3.7")
     return parser
 
 
+def _reformat_file(filename, file_args, cache=None, level=logging.WARNING):
+    """
+    reformat a single file, returns False if fprettify failed (or, with option
+    `check`, if the file is not formatted). Errors are logged, not raised.
+    If a `FormatCache` is given, files known to be formatted are skipped.
+    """
+    use_cache = cache is not None and filename != "-" and not file_args["stdout"]
+    try:
+        if use_cache:
+            style = cache.style_key(file_args, level)
+            stat = os.stat(filename)
+            is_formatted, digest = cache.is_formatted(filename, style, stat)
+            if is_formatted:
+                return True
+
+        # only cache files that don't trigger any messages
+        counter = _LogRecordCounter()
+        logger = logging.getLogger("fprettify-logger")
+        logger.addHandler(counter)
+        try:
+            changed = reformat_inplace(filename, **file_args)
+        finally:
+            logger.removeHandler(counter)
+            if _line_store is not None:
+                _line_store.flush()
+
+        if use_cache and not changed and not counter.count:
+            new_stat = os.stat(filename)
+            if (new_stat.st_size, new_stat.st_mtime_ns) == (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                from .cache import file_digest
+
+                cache.add(filename, style, digest or file_digest(filename), stat)
+    except FprettifyException as e:
+        log_exception(e, "Fatal error occured")
+        return False
+    except OSError as e:
+        # e.g. file removed or not readable, the other files are still formatted
+        log_message("Can not access file: {}".format(e), "error", filename, 0)
+        return False
+    except Exception:
+        # an error of fprettify itself, reported with the file so that the
+        # other files are still formatted (also by worker processes)
+        log_message("Unexpected error occured", "exception", filename, 0)
+        return False
+
+    return not (changed and file_args.get("check"))
+
+
+# state of worker process
+_worker_cache = None
+_worker_level = logging.WARNING
+
+
+def _init_worker(level, cache_dir, line_cache=None):
+    """worker process initialization: buffer log messages instead of writing them"""
+    global _worker_cache, _worker_level, _line_store
+
+    logger = logging.getLogger("fprettify-logger")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.setLevel(level)
+    logger.addHandler(_LogRecordBuffer())
+
+    _worker_level = level
+    _worker_cache = None
+    if cache_dir:
+        from .cache import FormatCache
+
+        _worker_cache = FormatCache(cache_dir)
+    if line_cache:
+        from .cache import LineStore
+
+        _line_store = LineStore(line_cache)
+
+
+def _reformat_file_worker(job):
+    """
+    reformat a single file in a worker process.
+    Returns success, buffered log records and buffered stdout.
+    """
+    filename, file_args = job
+    log_buffer = logging.getLogger("fprettify-logger").handlers[0]
+    log_buffer.pop_records()
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        success = _reformat_file(filename, file_args, _worker_cache, _worker_level)
+    return success, log_buffer.pop_records(), stdout.getvalue()
+
+
+def reformat_files(
+    jobs, n_jobs=1, level=logging.WARNING, cache_dir=None, line_cache=None
+):
+    """
+    reformat several files given as list `jobs` of (filename, options) tuples,
+    using a pool of `n_jobs` worker processes. Errors in one file don't stop the
+    formatting of the other files. Log messages and output to stdout are
+    emitted in the order of `jobs`, independently of `n_jobs`.
+    If `cache_dir` is given, files that are known to be formatted are skipped.
+    If `line_cache` (path of a LineStore database) is given, formatted lines
+    are looked up there.
+    Returns the number of files that could not be formatted (or, with option
+    `check`, that are not formatted).
+    """
+    global _line_store
+
+    # the cache module (and sqlite3) is only imported if a cache is used
+    cache = None
+    if cache_dir:
+        from .cache import FormatCache
+
+        cache = FormatCache(cache_dir)
+    prev_line_store = _line_store
+    if line_cache:
+        from .cache import LineStore
+
+        _line_store = LineStore(line_cache)
+    line_store = _line_store
+
+    n_jobs = min(n_jobs, len(jobs))
+    try:
+        if n_jobs <= 1 or any(filename == "-" for filename, _ in jobs):
+            n_failed = sum(
+                not _reformat_file(filename, file_args, cache, level)
+                for filename, file_args in jobs
+            )
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            logger = logging.getLogger("fprettify-logger")
+            chunksize = max(1, len(jobs) // (4 * n_jobs))
+            n_failed = 0
+            with ProcessPoolExecutor(
+                n_jobs,
+                initializer=_init_worker,
+                initargs=(level, cache_dir, line_cache),
+            ) as executor:
+                for success, records, output in executor.map(
+                    _reformat_file_worker, jobs, chunksize=chunksize
+                ):
+                    for record in records:
+                        logger.handle(logging.makeLogRecord(record))
+                    sys.stdout.write(output)
+                    n_failed += not success
+    finally:
+        _line_store = prev_line_store
+
+    if cache is not None:
+        cache.evict()
+        cache.close()
+    if line_cache:
+        line_store.evict()
+        line_store.close()
+
+    return n_failed
+
+
+# formatting options per command line and set of config files (with their
+# modification times), kept across calls of `run` by a long-running process
+_file_args_cache = {}
+
+# memo of formatting results {(options, text): formatted text} of a
+# long-running process, disabled if None
+_result_cache = None
+
+# the slowest Fortran lines (a SlowLines instance) of the formatted files,
+# disabled if None
+_slow_lines = None
+
+# scope dispatchers created while a PhaseProfiler is active, disabled if None
+_scope_dispatchers = None
+
+# memo of formatted Fortran lines {(Fortran line, line breaks, style, ...):
+# (Fortran line, formatted lines)}, shared by all files, disabled if None
+_line_cache = _LineCache(4096)
+
+# persistent cache of formatted Fortran lines (a LineStore) shared by
+# processes, disabled if None
+_line_store = None
+
+
+def _reconfigure_stdio():
+    """read stdin and write stdout as UTF-8, independently of the locale"""
+    if sys.stdin is sys.__stdin__ and isinstance(sys.stdin, io.TextIOWrapper):
+        sys.stdin = io.TextIOWrapper(
+            sys.stdin.detach(), encoding="UTF-8", line_buffering=True
+        )
+    if sys.stdout is sys.__stdout__ and isinstance(sys.stdout, io.TextIOWrapper):
+        sys.stdout = io.TextIOWrapper(
+            sys.stdout.detach(), encoding="UTF-8", line_buffering=True
+        )
+
+
+def _configargparse_installed():
+    """whether configargparse, which is needed for config files, is installed"""
+    try:
+        import configargparse  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _may_refer_to_config_files(args):
+    """
+    whether command line arguments `args` may contain a config file option or
+    a help option (the help describes config files). False positives only cost
+    the import of configargparse.
+    """
+    for arg in args:
+        if arg == "--":
+            break
+        option = arg.split("=", 1)[0]
+        if option.startswith("--"):
+            if "--config-file".startswith(option) or "--help".startswith(option):
+                return True
+        elif option.startswith("-") and ("c" in option or "h" in option):
+            return True
+    return False
+
+
 def run(argv=sys.argv):  # pragma: no cover
     """Command line interface"""
 
+    _reconfigure_stdio()
+
+    # config files per directory (with the modification times of all config
+    # files that apply), so that each directory is searched only once
+    config_file_lists = {}
+
     def get_config_file_list(filename):
-        """helper function to create list of config files found in parent directories"""
-        config_file_list = []
+        """
+        helper function to create list of config files found in parent
+        directories, returns (config files, ((config file, mtime), ...)) where
+        the modification times also include the user's and the command line
+        config files
+        """
         dir = os.path.dirname(filename)
-        while True:
+        if dir not in config_file_lists:
+            parent = os.path.dirname(dir)
+            config_file_list = [] if parent == dir else get_config_file_list(dir)[0][:]
             config_file = os.path.join(dir, ".fprettify.rc")
             if os.path.isfile(config_file):
-                config_file_list.insert(0, config_file)
-            parent = os.path.dirname(dir)
-            if parent == dir:
-                break
-            dir = parent
-        return config_file_list
+                config_file_list.append(config_file)
+            config_file_mtimes = tuple(
+                (config_file, os.path.getmtime(config_file))
+                for config_file in map(
+                    os.path.expanduser,
+                    ["~/.fprettify.rc"] + config_file_list + cmdline_config_files,
+                )
+                if os.path.isfile(config_file)
+            )
+            config_file_lists[dir] = (config_file_list, config_file_mtimes)
+        return config_file_lists[dir]
+
+    def get_file_args(config_files, config_file_mtimes):
+        """
+        helper function to parse arguments using a list of config files
+        (with their modification times as returned by get_config_file_list)
+        """
+        key = (os.getcwd(), tuple(argv)) + config_file_mtimes
+        if key not in _file_args_cache:
+            if (
+                config_file_mtimes or cmdline_config_files
+            ) and _configargparse_installed():
+                file_argparser = get_arg_parser(
+                    dict(config_arguments, default_config_files=config_files)
+                )
+            else:
+                file_argparser = get_arg_parser(arguments)
+
+            args_tmp = file_argparser.parse_args(argv[1:])
+            style = FormatStyle(**process_args(args_tmp))
+            _file_args_cache[key] = (args_tmp.stdout, {"style": style})
+        return _file_args_cache[key]
 
     arguments = {
         "prog": argv[0],
@@ -3231,21 +5421,88 @@ def run(argv=sys.argv):  # pragma: no cover
         "formatter_class": argparse.ArgumentDefaultsHelpFormatter,
     }
 
-    if argparse.__name__ == "configargparse":
-        arguments["args_for_setting_config_path"] = ["-c", "--config-file"]
-        arguments["description"] = (
-            arguments["description"]
-            + " Config files ('.fprettify.rc') in the home (~) directory and any such files located in parent directories of the input file will be used. When the standard input is used, the search is started from the current directory."
-        )
+    # arguments of a parser reading config files
+    config_arguments = dict(
+        arguments,
+        args_for_setting_config_path=["-c", "--config-file"],
+        description=arguments["description"]
+        + " Config files ('.fprettify.rc') in the home (~) directory and any such files located in parent directories of the input file will be used. When the standard input is used, the search is started from the current directory.",
+    )
 
-    parser = get_arg_parser(arguments)
+    if _may_refer_to_config_files(argv[1:]) and _configargparse_installed():
+        parser = get_arg_parser(config_arguments)
+    else:
+        parser = get_arg_parser(arguments)
 
     args = parser.parse_args(argv[1:])
 
+    # config file given on the command line
+    cmdline_config_files = []
+    if getattr(args, "config_file", None):
+        cmdline_config_files.append(args.config_file)
+
     # support legacy input:
     if "stdin" in args.path and not os.path.isfile("stdin"):
         args.path = ["-" if _ == "stdin" else _ for _ in args.path]
 
+    if args.hunks_only and not args.changed_since:
+        sys.stderr.write("--hunks-only requires --changed-since.\n")
+        sys.exit(1)
+    if args.hunks_only and args.line_range:
+        sys.stderr.write("--hunks-only and --line-range are mutually exclusive.\n")
+        sys.exit(1)
+
+    if args.fortran:
+        ext = args.fortran
+    else:
+        ext = FORTRAN_EXTENSIONS
+
+    from fnmatch import fnmatch
+
+    def exceeds_max_lines(ffile):
+        """helper function to check whether a file has too many lines"""
+        if args.exclude_max_lines is None:
+            return False
+        line_count = 0
+        with open(ffile) as f:
+            for i in f:
+                line_count += 1
+                if line_count > args.exclude_max_lines:
+                    return True
+        return False
+
+    if args.changed_since:
+        from .git_utils import GitChanges, GitError
+
+        paths = [_ for _ in args.path if _ != "-"] or [os.curdir]
+        try:
+            git_changes = GitChanges(args.changed_since)
+            changed_files = [
+                ffile
+                for ffile in git_changes.files(paths)
+                if any(ffile.endswith(_) for _ in ext)
+                and not any(
+                    fnmatch(part, exclude_pattern)
+                    for part in [ffile] + ffile.split(os.sep)
+                    for exclude_pattern in args.exclude_pattern
+                )
+                and not exceeds_max_lines(ffile)
+            ]
+            if args.hunks_only:
+                changed_lines = {
+                    ffile: git_changes.line_ranges(ffile) for ffile in changed_files
+                }
+        except GitError as e:
+            sys.stderr.write("--changed-since: {}\n".format(e))
+            sys.exit(1)
+
+        # changed files are formatted like files given on the command line
+        args.recursive = False
+        args.path = changed_files
+
+    # list of (filename, formatting options) for all files to be formatted
+    jobs = []
+
     for directory in args.path:
         if directory == "-":
             if args.recursive:
@@ -3266,14 +5523,8 @@ def run(argv=sys.argv):  # pragma: no cover
         if not args.recursive:
             filenames = [directory]
         else:
-            if args.fortran:
-                ext = args.fortran
-            else:
-                ext = FORTRAN_EXTENSIONS
             filenames = []
 
-            from fnmatch import fnmatch
-
             for dirpath, dirnames, files in os.walk(directory, topdown=True):
 
                 # Prune excluded patterns from list of child directories
@@ -3300,49 +5551,70 @@ def run(argv=sys.argv):  # pragma: no cover
                         ]
                     )
                 ]:
-
-                    include_file = True
-                    if args.exclude_max_lines is not None:
-                        line_count = 0
-                        with open(ffile) as f:
-                            for i in f:
-                                line_count += 1
-                                if line_count > args.exclude_max_lines:
-                                    include_file = False
-                                    break
-
-                    if include_file:
+                    if not exceeds_max_lines(ffile):
                         filenames.append(ffile)
 
         for filename in filenames:
 
             # reparse arguments using the file's list of config files
-            filearguments = arguments
-            if argparse.__name__ == "configargparse":
-                filearguments["default_config_files"] = [
-                    "~/.fprettify.rc"
-                ] + get_config_file_list(
-                    os.path.abspath(filename) if filename != "-" else os.getcwd()
-                )
-            file_argparser = get_arg_parser(filearguments)
-
-            args_tmp = file_argparser.parse_args(argv[1:])
-            file_args = process_args(args_tmp)
-            file_args["stdout"] = args_tmp.stdout or directory == "-"
+            config_file_list, config_file_mtimes = get_config_file_list(
+                os.path.abspath(filename) if filename != "-" else os.getcwd()
+            )
+            config_files = ["~/.fprettify.rc"] + config_file_list
+            stdout, file_args = get_file_args(config_files, config_file_mtimes)
+            file_args = dict(file_args)
+            file_args["stdout"] = stdout or directory == "-"
             file_args["diffonly"] = args.diff
+            file_args["check"] = args.check
+            if args.line_range:
+                file_args["line_range"] = args.line_range
+            if args.hunks_only:
+                file_args["line_ranges"] = changed_lines[filename]
+
+            jobs.append((filename, file_args))
+
+    if args.debug:
+        debug_level = logging.DEBUG
+    elif args.silent:
+        debug_level = logging.CRITICAL
+    else:
+        debug_level = logging.WARNING
+
+    set_fprettify_logger(debug_level)
+
+    if args.profile_phases or args.report_slow_lines:
+        from .profiling import write_json, write_table
+
+        profilers = []
+        total = PhaseProfiler()
+        slow_lines = SlowLines(args.report_slow_lines or 0)
+        n_failed = 0
+        for job in jobs:
+            with contextlib.ExitStack() as stack:
+                if args.profile_phases:
+                    profiler = stack.enter_context(PhaseProfiler())
+                if args.report_slow_lines:
+                    stack.enter_context(slow_lines)
+                n_failed += reformat_files([job], 1, debug_level)
+            if args.profile_phases:
+                profilers.append((job[0], profiler))
+                total.add(profiler)
+
+        if args.profile_phases == "-":
+            write_table(profilers, total, sys.stderr)
+        elif args.profile_phases:
+            with io.open(args.profile_phases, "w", encoding="utf-8") as outfile:
+                write_json(profilers, total, outfile)
+        if args.report_slow_lines:
+            slow_lines.write_table(sys.stderr)
+    else:
+        cache_dir = None
+        if not args.no_cache:
+            from .cache import default_cache_dir
 
-            if args.debug:
-                args.debug_level = logging.DEBUG
-            elif args.silent:
-                debug_level = logging.CRITICAL
-            else:
-                debug_level = logging.WARNING
-
-            set_fprettify_logger(debug_level)
-
-            try:
-                reformat_inplace(filename, **file_args)
-
-            except FprettifyException as e:
-                log_exception(e, "Fatal error occured")
-                sys.exit(1)
+            cache_dir = args.cache_dir or default_cache_dir()
+        n_failed = reformat_files(
+            jobs, args.jobs, debug_level, cache_dir, args.line_cache
+        )
+    if n_failed:
+        sys.exit(1)
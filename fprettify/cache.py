@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Persistent caches of files that are known to be formatted and of formatted
+Fortran lines.
+
+A file is skipped if it is already formatted w.r.t. the same fprettify version
+and the same options. Files are first identified by path, size and
+modification time, so that most files don't even need to be read. If these
+don't match, the file content hash is looked up.
+
+Formatted Fortran lines are identified by a hash of the line, its line
+breaks, the fprettify version and the options, so that formatting a file that
+has been edited only recomputes the changed lines.
+
+The caches are sqlite databases, sqlite takes care of locking so that the
+caches can be shared by concurrent worker processes.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# maximum number of entries per table, least recently used entries are evicted
+DEFAULT_MAX_ENTRIES = 100000
+
+_DB_NAME = "cache.sqlite"
+
+# maximum number of formatted lines and maximum age (in seconds since last
+# use) of formatted lines
+DEFAULT_MAX_LINES = 200000
+DEFAULT_MAX_LINE_AGE = 30 * 24 * 3600
+
+# errors due to an inaccessible cache
+_CACHE_ERRORS = (sqlite3.Error, OSError)
+
+# formatting options that don't influence the formatting result
+_OUTPUT_OPTIONS = ("stdout", "diffonly", "check")
+
+
+def _get_version():
+    """version string, falls back to a hash of the sources of this package"""
+    try:
+        from .version import __version__
+
+        return __version__
+    except Exception:
+        src_hash = hashlib.sha256()
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        for src in sorted(os.listdir(src_dir)):
+            if src.endswith(".py"):
+                with open(os.path.join(src_dir, src), "rb") as f:
+                    src_hash.update(f.read())
+        return "src-" + src_hash.hexdigest()
+
+
+def default_cache_dir():
+    """per-user cache directory, $XDG_CACHE_HOME/fprettify"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "fprettify")
+
+
+def file_digest(filename):
+    """content hash of a file"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FormatCache(object):
+    """
+    Cache of formatted files, stored in `cache_dir` (default: per-user cache
+    directory). Files are identified by their absolute paths. The database is opened lazily so that an instance can be created before
+    forking worker processes.
+    """
+
+    _version = None
+
+    def __init__(self, cache_dir=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self._cache_dir = cache_dir or default_cache_dir()
+        self._max_entries = max_entries
+        self._conn = None
+        self._pid = None
+        # a cache that can not be accessed (e.g. read-only directory) is
+        # treated as empty
+        self._disabled = False
+
+    def _connection(self):
+        # sqlite connections must not be shared with forked processes
+        if self._conn is None or self._pid != os.getpid():
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir, exist_ok=True)
+                with open(os.path.join(self._cache_dir, ".gitignore"), "w") as f:
+                    f.write("# created by fprettify\n*\n")
+
+            conn = sqlite3.connect(
+                os.path.join(self._cache_dir, _DB_NAME),
+                timeout=60,
+                isolation_level=None,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT, style TEXT, size INTEGER, mtime_ns INTEGER, "
+                "digest TEXT, last_used REAL, PRIMARY KEY (path, style))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "style TEXT, digest TEXT, last_used REAL, PRIMARY KEY (style, digest))"
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    @classmethod
+    def style_key(cls, file_args, level=None):
+        """
+        key identifying the formatting result: fprettify version, all options
+        as returned by `process_args` (or their FormatStyle) and log level
+        (since we only cache files that don't produce any messages).
+        """
+        if cls._version is None:
+            cls._version = _get_version()
+        options = {k: v for k, v in file_args.items() if k not in _OUTPUT_OPTIONS}
+        style = options.pop("style", None)
+        if style is not None:
+            options.update(style.options())
+        key = json.dumps([cls._version, level, options], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def is_formatted(self, filename, style, stat=None):
+        """
+        Check whether file is known to be formatted. Returns (found, digest)
+        where digest is None if the file was identified by its stat alone.
+        """
+        if self._disabled:
+            return False, None
+        path = os.path.abspath(filename)
+        if stat is None:
+            stat = os.stat(filename)
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT size, mtime_ns FROM files WHERE path = ? AND style = ?",
+                (path, style),
+            ).fetchone()
+            if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                conn.execute(
+                    "UPDATE files SET last_used = ? WHERE path = ? AND style = ?",
+                    (time.time(), path, style),
+                )
+                return True, None
+        except _CACHE_ERRORS:
+            self._disabled = True
+            return False, None
+
+        digest = file_digest(filename)
+        try:
+            row = conn.execute(
+                "SELECT 1 FROM digests WHERE style = ? AND digest = ?", (style, digest)
+            ).fetchone()
+        except _CACHE_ERRORS:
+            self._disabled = True
+            return False, digest
+        if row:
+            self.add(filename, style, digest, stat)
+            return True, digest
+
+        return False, digest
+
+    def add(self, filename, style, digest, stat):
+        """record file with content hash `digest` and `stat` as formatted"""
+        if self._disabled:
+            return
+        path = os.path.abspath(filename)
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, style, stat.st_size, stat.st_mtime_ns, digest, now),
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?)",
+                    (style, digest, now),
+                )
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except _CACHE_ERRORS:
+            self._disabled = True
+
+    def evict(self):
+        """remove least recently used entries exceeding maximum size"""
+        if self._disabled or not os.path.isdir(self._cache_dir):
+            return
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table in ("files", "digests"):
+                    conn.execute(
+                        "DELETE FROM {0} WHERE rowid NOT IN (SELECT rowid FROM {0} "
+                        "ORDER BY last_used DESC LIMIT ?)".format(table),
+                        (self._max_entries,),
+                    )
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except _CACHE_ERRORS:
+            self._disabled = True
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+class LineStore(object):
+    """
+    Cache of formatted Fortran lines, stored in the sqlite database `path`.
+    Lines are looked up by `get` and added by `add`, additions and usage
+    times are written by `flush` (e.g. once per file). Like FormatCache, the
+    database is opened lazily and is treated as empty if it can't be accessed.
+    """
+
+    def __init__(
+        self, path, max_entries=DEFAULT_MAX_LINES, max_age=DEFAULT_MAX_LINE_AGE
+    ):
+        self._path = path
+        self._max_entries = max_entries
+        self._max_age = max_age
+        self._conn = None
+        self._pid = None
+        self._disabled = False
+        # hash of version and options per style
+        self._style_digests = {}
+        self._added = []
+        self._used = []
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # sqlite connections must not be shared with forked processes
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lines ("
+                "key BLOB PRIMARY KEY, result TEXT, last_used REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS lines_last_used ON lines (last_used)"
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+            self._added = []
+            self._used = []
+        return self._conn
+
+    def _key(self, style, line_key):
+        """
+        hash of formatting `line_key` (a tuple of strings, numbers and tuples
+        thereof, with a deterministic repr) with `style`
+        """
+        style_digest = self._style_digests.get(style)
+        if style_digest is None:
+            style_digest = json.dumps([_get_version(), style.options()], sort_keys=True)
+            style_digest = hashlib.sha256(style_digest.encode("utf-8")).hexdigest()
+            self._style_digests[style] = style_digest
+        key = style_digest + repr(line_key)
+        return hashlib.sha256(key.encode("utf-8", "surrogatepass")).digest()
+
+    def get(self, style, line_key):
+        """
+        result of formatting `line_key` with FormatStyle `style` as stored by
+        `add`, None if not found
+        """
+        if self._disabled:
+            return None
+        key = self._key(style, line_key)
+        try:
+            row = (
+                self._connection()
+                .execute("SELECT result FROM lines WHERE key = ?", (key,))
+                .fetchone()
+            )
+        except _CACHE_ERRORS:
+            self._disabled = True
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.append(key)
+        return json.loads(row[0])
+
+    def add(self, style, line_key, result):
+        """store `result` (JSON types) of formatting `line_key` with `style`"""
+        if not self._disabled:
+            self._added.append((self._key(style, line_key), json.dumps(result)))
+
+    def flush(self):
+        """write added lines and usage times to the database"""
+        if self._disabled or not (self._added or self._used):
+            return
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "UPDATE lines SET last_used = ? WHERE key = ?",
+                    ((now, key) for key in self._used),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO lines VALUES (?, ?, ?)",
+                    ((key, result, now) for key, result in self._added),
+                )
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except _CACHE_ERRORS:
+            self._disabled = True
+        self._added = []
+        self._used = []
+
+    def evict(self):
+        """
+        remove lines exceeding maximum age and least recently used lines
+        exceeding maximum size
+        """
+        if self._disabled or not os.path.isfile(self._path):
+            return
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "DELETE FROM lines WHERE last_used < ?",
+                    (time.time() - self._max_age,),
+                )
+                (n_entries,) = conn.execute("SELECT COUNT(*) FROM lines").fetchone()
+                if n_entries > self._max_entries:
+                    conn.execute(
+                        "DELETE FROM lines WHERE rowid NOT IN (SELECT rowid FROM "
+                        "lines ORDER BY last_used DESC LIMIT ?)",
+                        (self._max_entries,),
+                    )
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except _CACHE_ERRORS:
+            self._disabled = True
+
+    def close(self):
+        self.flush()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Formatter daemon: a long-running process serving requests of fprettify_client
+over a Unix domain socket (see fprettify_client for the protocol).
+
+Each request is an fprettify command line that is run in the working directory
+of the client, exactly as fprettify would run it. The daemon saves the start of
+the Python interpreter and the import of fprettify, and it keeps formatting
+options parsed from config files as well as formatting results in memory.
+Requests are served one at a time.
+"""
+
+import argparse
+import contextlib
+import io
+import logging
+import os
+import signal
+import socketserver
+import sys
+import traceback
+from collections import OrderedDict
+
+import fprettify
+from fprettify_client import (
+    check_directory,
+    check_socket,
+    connect,
+    default_socket_path,
+    peer_uid,
+    receive_message,
+    send_message,
+)
+
+# maximum number of memoized formatting results
+DEFAULT_MAX_RESULTS = 1000
+
+# maximum number of memoized sets of formatting options
+_MAX_FILE_ARGS = 1000
+
+
+class _ResultCache(OrderedDict):
+    """memo of formatting results, least recently used results are evicted"""
+
+    def __init__(self, max_entries):
+        super(_ResultCache, self).__init__()
+        self._max_entries = max_entries
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super(_ResultCache, self).__setitem__(key, value)
+        if len(self) > self._max_entries:
+            self.popitem(last=False)
+
+
+class _ClientStdin(io.TextIOBase):
+    """stdin of the client, requested from the client when it is first read"""
+
+    def __init__(self, rfile, wfile):
+        self._rfile = rfile
+        self._wfile = wfile
+        self._text = None
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self._text is None:
+            send_message(self._wfile, {"stdin": True})
+            message = receive_message(self._rfile)
+            self._text = message["stdin"] if message else ""
+        text = self._text if size is None or size < 0 else self._text[:size]
+        self._text = self._text[len(text) :]
+        return text
+
+
+def run_request(argv, cwd, stdin=None):
+    """
+    run fprettify with command line `argv` in directory `cwd`, reading `stdin`.
+    Returns dict with exit status and the output to stdout and stderr.
+    """
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    logger = logging.getLogger("fprettify-logger")
+    handlers = list(logger.handlers)
+    level = logger.level
+    prev_cwd = os.getcwd()
+    prev_stdin = sys.stdin
+    status = 0
+    try:
+        os.chdir(cwd)
+        sys.stdin = stdin if stdin is not None else io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                fprettify.run(argv)
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    sys.stderr.write("{}\n".format(e.code))
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+    finally:
+        os.chdir(prev_cwd)
+        sys.stdin = prev_stdin
+        logger.handlers[:] = handlers
+        logger.setLevel(level)
+        if len(fprettify._file_args_cache) > _MAX_FILE_ARGS:
+            fprettify._file_args_cache.clear()
+
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = receive_message(self.rfile)
+        if request is None:
+            return
+        stdin = _ClientStdin(self.rfile, self.wfile)
+        send_message(self.wfile, run_request(request["argv"], request["cwd"], stdin))
+
+
+class FormatServer(socketserver.UnixStreamServer):
+    """server of format requests listening on Unix domain socket `socket_path`"""
+
+    def __init__(self, socket_path=None, max_results=DEFAULT_MAX_RESULTS):
+        socket_path = socket_path or default_socket_path()
+        directory = os.path.dirname(os.path.abspath(socket_path))
+        if not os.path.isdir(directory):
+            os.mkdir(directory, 0o700)
+        try:
+            check_directory(directory)
+            if os.path.lexists(socket_path):
+                # only a socket of the current user may belong to a running
+                # daemon or be replaced
+                check_socket(socket_path)
+                try:
+                    connect(socket_path).close()
+                except PermissionError:
+                    raise
+                except OSError:
+                    # left over by a daemon that was killed
+                    os.remove(socket_path)
+                else:
+                    raise RuntimeError("daemon already running on " + socket_path)
+        except PermissionError as e:
+            raise RuntimeError("refusing to serve: {}".format(e))
+
+        # socket must be accessible by the current user only
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+        fprettify._result_cache = _ResultCache(max_results)
+
+    def verify_request(self, request, client_address):
+        """serve processes of the current user only"""
+        return peer_uid(request) in (None, os.getuid())
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        fprettify._result_cache = None
+        with contextlib.suppress(OSError):
+            os.remove(self.server_address)
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    """command line interface of the daemon"""
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description="Formatter daemon serving requests of fprettify-client.",
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=default_socket_path(),
+        help="Path of the Unix domain socket",
+    )
+    parser.add_argument(
+        "--max-results",
+        type=int,
+        default=DEFAULT_MAX_RESULTS,
+        help="Maximum number of formatting results kept in memory",
+    )
+    args = parser.parse_args(argv[1:])
+
+    try:
+        server = FormatServer(args.socket, args.max_results)
+    except (RuntimeError, OSError) as e:
+        sys.stderr.write("{}\n".format(e))
+        sys.exit(1)
+
+    # remove socket on termination
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
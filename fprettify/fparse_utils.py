@@ -24,14 +24,75 @@ from collections import deque
 
 RE_FLAGS = re.IGNORECASE | re.UNICODE
 
+# methods of a compiled regular expression
+_PATTERN_METHODS = (
+    "match",
+    "fullmatch",
+    "search",
+    "split",
+    "findall",
+    "finditer",
+    "sub",
+    "subn",
+)
+
+
+class LazyRegex(object):
+    """
+    A regular expression that is compiled when it is first used, so that
+    importing fprettify does not compile all regular expressions. Behaves like
+    the compiled regular expression, `pattern` is available without compiling.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def _compile(self):
+        # methods of the compiled regex shadow the methods of this class
+        compiled = re.compile(self.pattern, self.flags)
+        for name in _PATTERN_METHODS:
+            setattr(self, name, getattr(compiled, name))
+        return compiled
+
+    def match(self, *args, **kwargs):
+        return self._compile().match(*args, **kwargs)
+
+    def fullmatch(self, *args, **kwargs):
+        return self._compile().fullmatch(*args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        return self._compile().search(*args, **kwargs)
+
+    def split(self, *args, **kwargs):
+        return self._compile().split(*args, **kwargs)
+
+    def findall(self, *args, **kwargs):
+        return self._compile().findall(*args, **kwargs)
+
+    def finditer(self, *args, **kwargs):
+        return self._compile().finditer(*args, **kwargs)
+
+    def sub(self, *args, **kwargs):
+        return self._compile().sub(*args, **kwargs)
+
+    def subn(self, *args, **kwargs):
+        return self._compile().subn(*args, **kwargs)
+
+    def __repr__(self):
+        return "LazyRegex({!r}, {!r})".format(self.pattern, self.flags)
+
+
 # FIXME bad ass regex!
-VAR_DECL_RE = re.compile(
-    r"^ *(?P<type>integer(?: *\* *[0-9]+)?|logical|character(?: *\* *[0-9]+)?|real(?: *\* *[0-9]+)?|complex(?: *\* *[0-9]+)?|type) *(?P<parameters>\((?:[^()]+|\((?:[^()]+|\([^()]*\))*\))*\))? *(?P<attributes>(?: *, *[a-zA-Z_0-9]+(?: *\((?:[^()]+|\((?:[^()]+|\([^()]*\))*\))*\))?)+)? *(?P<dpnt>::)?(?P<vars>[^\n]+)\n?",
+# Note: parentheses (nested up to 3 levels) are matched character by character,
+#       a repeated [^()]+ would backtrack exponentially on lines that don't match
+VAR_DECL_RE = LazyRegex(
+    r"^ *(?P<type>integer(?: *\* *[0-9]+)?|logical|character(?: *\* *[0-9]+)?|real(?: *\* *[0-9]+)?|complex(?: *\* *[0-9]+)?|type) *(?P<parameters>\((?:[^()]|\((?:[^()]|\([^()]*\))*\))*\))? *(?P<attributes>(?: *, *[a-zA-Z_0-9]+(?: *\((?:[^()]|\((?:[^()]|\([^()]*\))*\))*\))?)+)? *(?P<dpnt>::)?(?P<vars>[^\n]+)\n?",
     RE_FLAGS,
 )
 
-OMP_COND_RE = re.compile(r"^\s*(!\$ )", RE_FLAGS)
-OMP_DIR_RE = re.compile(r"^\s*(!\$OMP)", RE_FLAGS)
+OMP_COND_RE = LazyRegex(r"^\s*(!\$ )", RE_FLAGS)
+OMP_DIR_RE = LazyRegex(r"^\s*(!\$OMP)", RE_FLAGS)
 
 # supported preprocessors
 FYPP_LINE_STR = r"^(#!|#:|\$:|@:)"
@@ -40,19 +101,19 @@ CPP_STR = r"^#[^!:{}]"
 COMMENT_LINE_STR = r"^!"
 FYPP_OPEN_STR = r"(#{|\${|@{)"
 FYPP_CLOSE_STR = r"(}#|}\$|}@)"
-NOTFORTRAN_LINE_RE = re.compile(
+NOTFORTRAN_LINE_RE = LazyRegex(
     r"(" + FYPP_LINE_STR + r"|" + CPP_STR + r"|" + COMMENT_LINE_STR + r")", RE_FLAGS
 )
-NOTFORTRAN_FYPP_LINE_RE = re.compile(
+NOTFORTRAN_FYPP_LINE_RE = LazyRegex(
     r"(" + CPP_STR + r"|" + COMMENT_LINE_STR + r")", RE_FLAGS
 )
-FYPP_LINE_RE = re.compile(FYPP_LINE_STR, RE_FLAGS)
-FYPP_WITHOUT_PREPRO_RE = re.compile(FYPP_WITHOUT_PREPRO_STR, RE_FLAGS)
-FYPP_OPEN_RE = re.compile(FYPP_OPEN_STR, RE_FLAGS)
-FYPP_CLOSE_RE = re.compile(FYPP_CLOSE_STR, RE_FLAGS)
+FYPP_LINE_RE = LazyRegex(FYPP_LINE_STR, RE_FLAGS)
+FYPP_WITHOUT_PREPRO_RE = LazyRegex(FYPP_WITHOUT_PREPRO_STR, RE_FLAGS)
+FYPP_OPEN_RE = LazyRegex(FYPP_OPEN_STR, RE_FLAGS)
+FYPP_CLOSE_RE = LazyRegex(FYPP_CLOSE_STR, RE_FLAGS)
 
-STR_OPEN_RE = re.compile(r"(" + FYPP_OPEN_STR + r"|" + r"'|\"|!)", RE_FLAGS)
-CPP_RE = re.compile(CPP_STR, RE_FLAGS)
+STR_OPEN_RE = LazyRegex(r"(" + FYPP_OPEN_STR + r"|" + r"'|\"|!)", RE_FLAGS)
+CPP_RE = LazyRegex(CPP_STR, RE_FLAGS)
 
 
 class fline_parser(object):
@@ -96,88 +157,151 @@ class FprettifyInternalException(FprettifyException):
     pass
 
 
+# tokens that start a string, a fypp inline expression or a comment in code,
+# for filter_fypp = True / False (see NOTFORTRAN_LINE_RE, NOTFORTRAN_FYPP_LINE_RE),
+# the lookahead lets the regex engine skip quickly to the first candidate
+_CODE_TOKEN_RE = {
+    True: LazyRegex(
+        r"(?=[#$@!\"'])"
+        r"(?:(?P<fypp>[#$@]\{)|(?P<comment>#[!:]|[$@]:|#[^!:{}]|!)|(?P<string>[\"']))"
+    ),
+    False: LazyRegex(
+        r"(?=[#$@!\"'])"
+        r"(?:(?P<fypp>[#$@]\{)|(?P<comment>#[^!:{}]|!)|(?P<string>[\"']))"
+    ),
+}
+_FYPP_CLOSE_TOKEN_RE = LazyRegex(r"\}[#$@]")
+
+
 class CharFilter(object):
     """
     An iterator to wrap the iterator returned by `enumerate(string)`
-    and ignore comments and characters inside strings
+    and ignore comments and characters inside strings.
+
+    The string is scanned once when the filter is created (or updated), the
+    characters that are not ignored are available as spans, see `spans`.
     """
 
     def __init__(
         self, string, filter_comments=True, filter_strings=True, filter_fypp=True
     ):
-        self._content = string
-        self._it = enumerate(self._content)
         self._instring = ""
         self._infypp = False
         self._incomment = ""
-        self._instring = ""
-        self._filter_comments = filter_comments
-        self._filter_strings = filter_strings
-        if filter_fypp:
-            self._notfortran_re = NOTFORTRAN_LINE_RE
-        else:
-            self._notfortran_re = NOTFORTRAN_FYPP_LINE_RE
+        self.update(string, filter_comments, filter_strings, filter_fypp)
 
     def update(
         self, string, filter_comments=True, filter_strings=True, filter_fypp=True
     ):
+        """
+        filter a new string, the state (inside string, fypp expression or
+        comment) is continued from the previous string
+        """
         self._content = string
-        self._it = enumerate(self._content)
         self._filter_comments = filter_comments
         self._filter_strings = filter_strings
-        if filter_fypp:
-            self._notfortran_re = NOTFORTRAN_LINE_RE
-        else:
-            self._notfortran_re = NOTFORTRAN_FYPP_LINE_RE
+        self._code_re = _CODE_TOKEN_RE[bool(filter_fypp)]
+        self._spans = self._scan()
+        self._it = self._iter_chars()
 
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-
-        pos, char = next(self._it)
+    def _scan(self):
+        """
+        Find all spans of characters that are not filtered, equivalent to
+        iterating character by character:
+        - a string starts with a quote and ends with the same quote, a fypp
+          expression starts with #{, ${ or @{ and ends with }#, }$ or }@.
+          If strings are filtered, the first character that is not filtered
+          after }# etc. is skipped as well.
+        - a comment starts with a character that starts a non-Fortran line
+          (comment or preprocessor statement) and ends at the end of input.
+        """
+        content = self._content
+        n = len(content)
+        filter_comments = self._filter_comments
+        filter_strings = self._filter_strings
+        spans = []
+        skip = 0
+        pos = 0
+
+        def add_span(start, end):
+            nonlocal skip
+            if skip:
+                nskip = min(skip, end - start)
+                skip -= nskip
+                start += nskip
+            if start < end:
+                if spans and spans[-1][1] == start:
+                    spans[-1] = (spans[-1][0], end)
+                else:
+                    spans.append((start, end))
 
-        char2 = self._content[pos : pos + 2]
+        while pos < n:
+            if self._incomment:
+                if not filter_comments:
+                    add_span(pos, n)
+                break
 
-        if not self._instring:
-            if not self._incomment:
-                if FYPP_OPEN_RE.search(char2):
-                    self._instring = char2
-                    self._infypp = True
-                elif self._notfortran_re.search(char2):
-                    self._incomment = char
-                elif char in ['"', "'"]:
-                    self._instring = char
-        else:
             if self._infypp:
-                if FYPP_CLOSE_RE.search(char2):
-                    self._instring = ""
-                    self._infypp = False
-                    if self._filter_strings:
-                        self.__next__()
-                        return self.__next__()
-
-            elif char in ['"', "'"]:
-                if self._instring == char:
-                    self._instring = ""
-                    if self._filter_strings:
-                        return self.__next__()
-
-        if self._filter_comments:
-            if self._incomment:
-                raise StopIteration
+                match = _FYPP_CLOSE_TOKEN_RE.search(content, pos)
+                end = match.start() + 1 if match else n
+                if not filter_strings:
+                    add_span(pos, end)
+                if not match:
+                    break
+                if filter_strings:
+                    skip += 1
+                self._instring = ""
+                self._infypp = False
+                pos = end
+                continue
 
-        if self._filter_strings:
             if self._instring:
-                return self.__next__()
+                end = content.find(self._instring, pos) + 1
+                if not filter_strings:
+                    add_span(pos, end if end else n)
+                if not end:
+                    break
+                self._instring = ""
+                pos = end
+                continue
+
+            match = self._code_re.search(content, pos)
+            if not match:
+                add_span(pos, n)
+                break
+            start = match.start()
+            add_span(pos, start)
+            if match.lastgroup == "comment":
+                self._incomment = match.group()[0]
+                pos = start
+                continue
+            if match.lastgroup == "fypp":
+                self._infypp = True
+            self._instring = match.group()
+            if not filter_strings:
+                add_span(start, start + 1)
+            pos = start + 1
+
+        return spans
+
+    def _iter_chars(self):
+        content = self._content
+        for start, end in self._spans:
+            yield from zip(range(start, end), content[start:end])
+
+    def __iter__(self):
+        return self._it
+
+    def __next__(self):
+        return next(self._it)
 
-        return (pos, char)
+    def spans(self):
+        """list of (start, end) of the spans of characters that are not filtered"""
+        return self._spans
 
     def filter_all(self):
-        filtered_str = ""
-        for pos, char in self:
-            filtered_str += char
-        return filtered_str
+        content = self._content
+        return "".join(content[start:end] for start, end in self._spans)
 
     def instring(self):
         return self._instring
@@ -205,7 +329,10 @@ class InputStream(object):
         returns a touple with the joined line, and a list with the original lines.
         Doesn't support multiline character constants!
         """
-        joined_line = ""
+        # joined line is built from parts, without trailing newline
+        joined_parts = []
+        joined_blank = True
+        joined_newline = False
         comments = []
         lines = []
         continuation = 0
@@ -240,13 +367,24 @@ class InputStream(object):
 
                 # update instead of CharFilter(line) to account for multiline strings
                 string_iter.update(line)
-                for pos, char in string_iter:
-                    if char == ";" or pos + 1 == len(line):
-                        self.endpos.append(pos - line_start)
-                        self.line_buffer.append(line[line_start : pos + 1])
-                        self.what_omp.append(what_omp)
-                        what_omp = ""
-                        line_start = pos + 1
+
+                # split at semicolons and end of line (outside of strings / comments)
+                line_ends = []
+                for start, end in string_iter.spans():
+                    line_end = line.find(";", start, end)
+                    while line_end != -1:
+                        line_ends.append(line_end)
+                        line_end = line.find(";", line_end + 1, end)
+                    pos = end - 1
+                if pos != -1 and pos + 1 == len(line) and line[pos] != ";":
+                    line_ends.append(pos)
+
+                for line_end in line_ends:
+                    self.endpos.append(line_end - line_start)
+                    self.line_buffer.append(line[line_start : line_end + 1])
+                    self.what_omp.append(what_omp)
+                    what_omp = ""
+                    line_start = line_end + 1
 
                 if pos + 1 < len(line):
                     if fypp_cont:
@@ -308,12 +446,15 @@ class InputStream(object):
             line_core = line_core.strip("&")
 
             comments.append(line_comments.rstrip("\n"))
-            if joined_line.strip():
-                joined_line = joined_line.rstrip("\n") + line_core + "\n" * newline
+            if joined_blank:
+                joined_parts = [what_omp + line_core]
+                joined_blank = not joined_parts[0].strip()
             else:
-                joined_line = what_omp + line_core + "\n" * newline
+                joined_parts.append(line_core)
+            joined_newline = newline
 
             if not (continuation or fypp_cont):
                 break
 
+        joined_line = "".join(joined_parts) + "\n" * joined_newline
         return (joined_line, comments, lines)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Changes of the working tree of a local git repository w.r.t. a commit.
+
+Only git plumbing commands are used (their output is stable across git
+versions and doesn't depend on user configuration), the repository is never
+modified and no remote is contacted.
+"""
+
+import os
+import re
+import subprocess
+
+# hunk header of a diff without context lines, e.g. "@@ -12,3 +12,4 @@"
+_HUNK_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", re.MULTILINE)
+
+
+class GitError(Exception):
+    """git is not available or failed"""
+
+
+def _git(args, cwd=None):
+    """run git command with arguments `args`, returns its output"""
+    try:
+        result = subprocess.run(
+            ["git", "--no-pager", "--literal-pathspecs"] + args,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        raise GitError("can not run git: {}".format(e))
+    if result.returncode:
+        raise GitError(
+            result.stderr.decode("utf-8", "replace").strip()
+            or "git {} failed".format(args[0])
+        )
+    return result.stdout.decode("utf-8", "surrogateescape")
+
+
+class GitChanges(object):
+    """
+    files of the git repository of the current directory that were added or
+    modified after commit `ref` (including uncommitted and untracked files).
+    """
+
+    def __init__(self, ref):
+        self._top = _git(["rev-parse", "--show-toplevel"]).rstrip("\n")
+        try:
+            self._commit = _git(
+                ["rev-parse", "--verify", "--quiet", ref + "^{commit}"]
+            ).strip()
+        except GitError:
+            raise GitError("unknown revision " + ref)
+        self._cwd = os.path.realpath(os.getcwd())
+        self._untracked = set()
+
+    def files(self, paths):
+        """
+        changed files in `paths` (files or directories), relative to the
+        current directory.
+        """
+        # unlike --name-only, --numstat compares the contents of files whose
+        # stat information is outdated in the index (e.g. files only touched)
+        changed = _git(
+            ["diff-index", "--numstat", "-z", "--diff-filter=ACMT", self._commit]
+            + ["--"]
+            + paths
+        )
+        untracked = _git(
+            ["ls-files", "-z", "--full-name", "--others", "--exclude-standard"]
+            + ["--"]
+            + paths
+        )
+        untracked = [os.path.join(self._top, _) for _ in untracked.split("\0") if _]
+        self._untracked.update(untracked)
+        # "added<TAB>deleted<TAB>path" per file
+        changed = [
+            os.path.join(self._top, _.split("\t", 2)[2])
+            for _ in changed.split("\0")
+            if _
+        ]
+        changed = sorted(set(changed + untracked))
+        return [os.path.relpath(_, self._cwd) for _ in changed]
+
+    def line_ranges(self, filename):
+        """
+        changed lines of file `filename`, as sorted list of ranges (start, end)
+        (1-based, inclusive). None if the entire file is new.
+        """
+        path = os.path.normpath(os.path.join(self._cwd, filename))
+        if path in self._untracked:
+            return None
+        diff = _git(
+            ["diff-index", "-p", "-U0", "--no-ext-diff", "--no-textconv"]
+            + [self._commit, "--", os.path.relpath(path, self._top)],
+            cwd=self._top,
+        )
+        ranges = []
+        for match in _HUNK_RE.finditer(diff):
+            start = int(match.group(1))
+            count = int(match.group(2)) if match.group(2) is not None else 1
+            # hunks with count 0 only delete lines
+            if count:
+                ranges.append((start, start + count - 1))
+        return ranges
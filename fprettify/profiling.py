@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Timing of the phases of formatting and of individual Fortran lines.
+
+While a `PhaseProfiler` is active, the functions implementing the phases are
+replaced by wrappers accumulating the time spent in them, so that profiling
+costs nothing while it is disabled. Times are exclusive: time spent in a
+nested phase (e.g. F90Aligner called by F90Indenter) is only counted for the
+nested phase. Time spent outside of all phases is counted as "other".
+Hits and misses of the memo of formatted Fortran lines and the lines that
+did not need any scope regex (see ScopeDispatcher) are counted as well.
+
+While a `SlowLines` instance is active, the time of each Fortran line through
+all passes of formatting is measured and the slowest lines are kept.
+"""
+
+import heapq
+import json
+import time
+
+# phases: (phase, module name, object name, attribute name or None)
+PHASES = [
+    ("inspect_ffile_format", "fprettify", "inspect_ffile_format", None),
+    ("inspect_fline", "fprettify", "_inspect_fline", None),
+    (
+        "next_fortran_line",
+        "fprettify.fparse_utils",
+        "InputStream",
+        "next_fortran_line",
+    ),
+    ("format_single_fline", "fprettify", "format_single_fline_style", None),
+    (
+        "replace_keywords_single_fline",
+        "fprettify",
+        "replace_keywords_single_fline",
+        None,
+    ),
+    ("F90Indenter", "fprettify", "F90Indenter", "process_lines_of_fline"),
+    ("F90Aligner", "fprettify", "F90Aligner", "process_lines_of_fline"),
+    ("write_formatted_line", "fprettify", "write_formatted_line", None),
+]
+
+OTHER = "other"
+
+
+class PhaseProfiler(object):
+    """
+    Context manager accumulating the time (in ns, `times`) and the number of
+    calls (`calls`) per phase of formatting, the hits and misses of the memo
+    of formatted lines (`line_cache`) and the lines that did not need any
+    scope regex out of all lines (`scope_dispatch`, see ScopeDispatcher)
+    while it is active, e.g.
+
+        with PhaseProfiler() as profiler:
+            reformat_ffile(infile, outfile)
+        print(profiler.report())
+
+    Profilers can't be nested and are not thread-safe.
+    """
+
+    _active = False
+
+    def __init__(self):
+        self.times = dict.fromkeys([_[0] for _ in PHASES] + [OTHER], 0)
+        self.calls = dict.fromkeys([_[0] for _ in PHASES], 0)
+        self.line_cache = {"hits": 0, "misses": 0}
+        self.scope_dispatch = {"hits": 0, "lines": 0}
+        self._patched = []
+        self._phase = OTHER
+        self._start = None
+
+    def _wrap(self, phase, func):
+        """wrapper of function `func` accumulating its time for `phase`"""
+        times = self.times
+        calls = self.calls
+        clock = time.perf_counter_ns
+
+        def wrapper(*args, **kwargs):
+            now = clock()
+            prev_phase = self._phase
+            times[prev_phase] += now - self._start
+            calls[phase] += 1
+            self._phase = phase
+            self._start = now
+            try:
+                return func(*args, **kwargs)
+            finally:
+                now = clock()
+                times[phase] += now - self._start
+                self._phase = prev_phase
+                self._start = now
+
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def __enter__(self):
+        import importlib
+
+        import fprettify
+
+        if PhaseProfiler._active:
+            raise RuntimeError("PhaseProfiler is already active")
+        PhaseProfiler._active = True
+
+        for phase, module_name, name, attribute in PHASES:
+            owner = importlib.import_module(module_name)
+            if attribute is not None:
+                owner, name = getattr(owner, name), attribute
+            func = getattr(owner, name)
+            self._patched.append((owner, name, func))
+            setattr(owner, name, self._wrap(phase, func))
+
+        self._line_cache_start = _line_cache_counts()
+        fprettify._scope_dispatchers = []
+        self._phase = OTHER
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        import fprettify
+
+        self.times[self._phase] += time.perf_counter_ns() - self._start
+        for key, count in _line_cache_counts().items():
+            self.line_cache[key] += count - self._line_cache_start[key]
+        for dispatcher in fprettify._scope_dispatchers:
+            self.scope_dispatch["hits"] += dispatcher.n_hits
+            self.scope_dispatch["lines"] += dispatcher.n_lines
+        fprettify._scope_dispatchers = None
+        for owner, name, func in reversed(self._patched):
+            setattr(owner, name, func)
+        self._patched = []
+        PhaseProfiler._active = False
+
+    def total(self):
+        """total time in ns"""
+        return sum(self.times.values())
+
+    def report(self):
+        """
+        dict of times (ns) and calls per phase, of hits and misses of the
+        memo of formatted lines ("line_cache") and of lines without scope
+        regex out of all lines ("scope_dispatch")
+        """
+        report = {
+            phase: {"ns": ns, "calls": self.calls.get(phase)}
+            for phase, ns in self.times.items()
+        }
+        report["line_cache"] = dict(self.line_cache)
+        report["scope_dispatch"] = dict(self.scope_dispatch)
+        return report
+
+    def add(self, other):
+        """add times and calls of profiler `other`"""
+        for phase, ns in other.times.items():
+            self.times[phase] += ns
+        for phase, calls in other.calls.items():
+            self.calls[phase] += calls
+        for key, count in other.line_cache.items():
+            self.line_cache[key] += count
+        for key, count in other.scope_dispatch.items():
+            self.scope_dispatch[key] += count
+
+
+def _line_cache_counts():
+    """hits and misses of the memo of formatted lines so far"""
+    import fprettify
+
+    line_cache = fprettify._line_cache
+    if line_cache is None:
+        return {"hits": 0, "misses": 0}
+    return {"hits": line_cache.hits, "misses": line_cache.misses}
+
+
+def write_table(profilers, total, outfile):
+    """
+    write table of the time per phase (in ms and in percent) for each
+    (filename, profiler) in `profilers` and for profiler `total`
+    """
+    for name, profiler in profilers + [("total", total)]:
+        total_ns = profiler.total() or 1
+        outfile.write("{}: {:.1f} ms\n".format(name, total_ns / 1e6))
+        for phase, ns in sorted(profiler.times.items(), key=lambda _: -_[1]):
+            calls = profiler.calls.get(phase)
+            outfile.write(
+                "  {:<30} {:>10.1f} ms {:>6.1f} % {:>9}\n".format(
+                    phase, ns / 1e6, 100 * ns / total_ns, "" if calls is None else calls
+                )
+            )
+        lookups = sum(profiler.line_cache.values())
+        outfile.write(
+            "  {:<30} {:>10} hits {:>6.1f} % {:>9}\n".format(
+                "line cache",
+                profiler.line_cache["hits"],
+                100 * profiler.line_cache["hits"] / (lookups or 1),
+                lookups,
+            )
+        )
+        outfile.write(
+            "  {:<30} {:>10} hits {:>6.1f} % {:>9}\n".format(
+                "scope dispatch",
+                profiler.scope_dispatch["hits"],
+                100
+                * profiler.scope_dispatch["hits"]
+                / (profiler.scope_dispatch["lines"] or 1),
+                profiler.scope_dispatch["lines"],
+            )
+        )
+
+
+def write_json(profilers, total, outfile):
+    """
+    write times per phase for each (filename, profiler) in `profilers` and
+    for profiler `total` as JSON
+    """
+    report = {
+        "files": {name: profiler.report() for name, profiler in profilers},
+        "total": total.report(),
+    }
+    json.dump(report, outfile, indent=1)
+    outfile.write("\n")
+
+
+class SlowLines(object):
+    """
+    Context manager keeping the `n` slowest Fortran lines of all files that
+    are formatted while it is active (by reformat_ffile, except if formatting
+    a range of lines).
+    """
+
+    def __init__(self, n):
+        self._n = n
+        self._heap = []
+        self._count = 0
+
+    def __enter__(self):
+        import fprettify
+
+        fprettify._slow_lines = self
+        return self
+
+    def __exit__(self, *exc_info):
+        import fprettify
+
+        fprettify._slow_lines = None
+
+    def add(self, ns, filename, line_nr, n_lines, n_chars):
+        """add a Fortran line of file `filename` that took `ns` nanoseconds"""
+        # count breaks ties so that lines are never compared by filename
+        self._count += 1
+        line = (ns, -self._count, filename, line_nr, n_lines, n_chars)
+        if len(self._heap) < self._n:
+            heapq.heappush(self._heap, line)
+        elif line > self._heap[0]:
+            heapq.heapreplace(self._heap, line)
+
+    def lines(self):
+        """
+        list of (time in ns, filename, line number, number of lines, number of
+        characters) of the slowest Fortran lines, slowest first
+        """
+        return [
+            (ns, filename, line_nr, n_lines, n_chars)
+            for ns, _, filename, line_nr, n_lines, n_chars in sorted(
+                self._heap, reverse=True
+            )
+        ]
+
+    def write_table(self, outfile):
+        """write table of the slowest Fortran lines"""
+        outfile.write(
+            "{:>10} {:>7} {:>7}  {}\n".format("time", "lines", "chars", "location")
+        )
+        for ns, filename, line_nr, n_lines, n_chars in self.lines():
+            outfile.write(
+                "{:>7.2f} ms {:>7} {:>7}  {}:{}\n".format(
+                    ns / 1e6, n_lines, n_chars, filename, line_nr
+                )
+            )
@@ -23,15 +23,27 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import io
 import logging
 import os
+import pickle
+import shutil
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import unittest
 
 sys.stderr = io.TextIOWrapper(
     sys.stderr.detach(), encoding="UTF-8", line_buffering=True
 )
 
 import fprettify
-from fprettify.tests.test_common import RUNSCRIPT, FprettifyTestCase
+from fprettify.tests.test_common import (
+    _MYPATH,
+    RUNSCRIPT,
+    FprettifyTestCase,
+    joinpath,
+)
 
 fprettify.set_fprettify_logger(logging.ERROR)
 
@@ -467,6 +479,26 @@ class FprettifyUnitTestCase(FprettifyTestCase):
                 ["--case", "1", "1", "1", "2"], instring[i], outstring[i]
             )
 
+    def test_swap_case_words(self):
+        """test keyword character case of operators, words and procedure names"""
+        instring = (
+            "LOGICAL :: Abs, lgc\n"
+            "IF (A.AND.B.OR..NOT.C) Abs=.TRUE.\n"
+            "lgc = LOGICAL(Abs.EQV.1.5D0>2_INT8)\n"
+            "SYNC ALL\n"
+            "X = Abs + SQRT  (Y)"
+        )
+        outstring_exp = (
+            "logical :: Abs, lgc\n"
+            "if (A .and. B .or. .not. C) Abs = .true.\n"
+            "lgc = logical(Abs .eqv. 1.5d0 > 2_int8)\n"
+            "SYNC ALL\n"
+            "X = Abs + sqrt(Y)"
+        )
+        self.assert_fprettify_result(
+            ["--case", "1", "1", "1", "1"], instring, outstring_exp
+        )
+
     def test_do(self):
         """test correct parsing of do statement"""
         instring = "do = 1\nb = 2"
@@ -1096,3 +1128,950 @@ END MODULE
         )
 
         self.assert_fprettify_result(["-i", "4", "-l", "72"], instring, outstring_exp)
+
+    def test_jobs(self):
+        """parallel formatting of several files, a failing file doesn't stop the others"""
+        instring = "program p\nx=1+2\nend program\n"
+        outstring_exp = "program p\n   x = 1 + 2\nend program\n"
+        invalid = "x=1\n!&>\n"
+        # raises an unexpected error (not a FprettifyException)
+        crash = "x='''&!'''\n"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for n in range(4):
+                with io.open(os.path.join(tmpdir, "f{}.f90".format(n)), "w") as f:
+                    f.write(instring)
+            with io.open(os.path.join(tmpdir, "invalid.f90"), "w") as f:
+                f.write(invalid)
+            with io.open(os.path.join(tmpdir, "crash.f90"), "w") as f:
+                f.write(crash)
+            # file that can't be accessed
+            os.symlink("missing.f90", os.path.join(tmpdir, "broken.f90"))
+
+            cache_dir = os.path.join(tmpdir, "cache")
+            p1 = subprocess.Popen(
+                [RUNSCRIPT, "-r", tmpdir, "--jobs", "2", "--silent"]
+                + ["--cache-dir", cache_dir],
+                stderr=subprocess.PIPE,
+            )
+            stderr = p1.communicate()[1].decode("UTF-8")
+            self.assertEqual(p1.returncode, 1)
+            self.assertNotIn("Traceback", stderr)
+
+            for n in range(4):
+                with io.open(os.path.join(tmpdir, "f{}.f90".format(n))) as f:
+                    self.assertEqual(f.read(), outstring_exp)
+            with io.open(os.path.join(tmpdir, "invalid.f90")) as f:
+                self.assertEqual(f.read(), invalid)
+            with io.open(os.path.join(tmpdir, "crash.f90")) as f:
+                self.assertEqual(f.read(), crash)
+
+    def test_config_files(self):
+        """config files of parent directories apply to all files of a directory"""
+        instring = "program p\nx=1+2\nend program\n"
+        outstring_exp = {
+            "": "program p\n   x = 1 + 2\nend program\n",
+            "a": "program p\n  x = 1 + 2\nend program\n",
+            os.path.join("a", "b"): "program p\n  x=1+2\nend program\n",
+        }
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "a", "b"))
+            with io.open(os.path.join(tmpdir, "a", ".fprettify.rc"), "w") as f:
+                f.write("indent: 2\n")
+            with io.open(os.path.join(tmpdir, "a", "b", ".fprettify.rc"), "w") as f:
+                f.write("disable-whitespace: true\n")
+            for subdir in outstring_exp:
+                for n in range(3):
+                    filename = os.path.join(tmpdir, subdir, "f{}.f90".format(n))
+                    with io.open(filename, "w") as f:
+                        f.write(instring)
+
+            p1 = subprocess.Popen([RUNSCRIPT, "-r", tmpdir, "--no-cache", "--silent"])
+            p1.wait()
+            self.assertEqual(p1.returncode, 0)
+
+            for subdir, outstring in outstring_exp.items():
+                for n in range(3):
+                    filename = os.path.join(tmpdir, subdir, "f{}.f90".format(n))
+                    with io.open(filename) as f:
+                        self.assertEqual(f.read(), outstring)
+
+            # config files are looked up once per directory, not once per file
+            config_file = os.path.join(tmpdir, "a", ".fprettify.rc")
+            stat_calls = []
+            getmtime = os.path.getmtime
+
+            def getmtime_counted(filename):
+                if filename == config_file:
+                    stat_calls.append(filename)
+                return getmtime(filename)
+
+            os.path.getmtime = getmtime_counted
+            try:
+                fprettify.run([RUNSCRIPT, "-r", tmpdir, "--no-cache", "--silent"])
+            finally:
+                os.path.getmtime = getmtime
+                fprettify.set_fprettify_logger(logging.ERROR)
+            self.assertEqual(len(stat_calls), 2)
+
+    def test_check(self):
+        """check mode reports files that are not formatted without changing them"""
+        formatted = "program p\n   x = 1 + 2\nend program\n"
+        unformatted = ("program p\n   x = 1 + 2\n   y=3\nend program\n", formatted[:-1])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = [os.path.join(tmpdir, "f{}.f90".format(n)) for n in range(3)]
+            for filename, instring in zip(filenames, (formatted,) + unformatted):
+                with io.open(filename, "w") as f:
+                    f.write(instring)
+
+            p1 = subprocess.Popen(
+                [RUNSCRIPT, "--check", "--no-cache"] + filenames,
+                stdout=subprocess.PIPE,
+            )
+            output = p1.communicate()[0].decode("utf-8")
+            self.assertEqual(p1.returncode, 1)
+            self.assertEqual(output.splitlines(), filenames[1:])
+
+            for filename, instring in zip(filenames, (formatted,) + unformatted):
+                with io.open(filename) as f:
+                    self.assertEqual(f.read(), instring)
+
+            p1 = subprocess.Popen([RUNSCRIPT, "--check", "--no-cache", filenames[0]])
+            p1.wait()
+            self.assertEqual(p1.returncode, 0)
+
+    def test_inplace(self):
+        """files are replaced by formatted files with same mode, links are kept"""
+        instring = "program p\nx=1+2\nend program\n"
+        outstring_exp = "program p\n   x = 1 + 2\nend program\n"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "f.f90")
+            link = os.path.join(tmpdir, "g.f90")
+            with io.open(filename, "w") as f:
+                f.write(instring)
+            os.chmod(filename, 0o640)
+            os.symlink(filename, link)
+
+            p1 = subprocess.Popen([RUNSCRIPT, "--no-cache", link])
+            p1.wait()
+            self.assertEqual(p1.returncode, 0)
+
+            with io.open(filename) as f:
+                self.assertEqual(f.read(), outstring_exp)
+            self.assertEqual(os.stat(filename).st_mode & 0o777, 0o640)
+            self.assertTrue(os.path.islink(link))
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["f.f90", "g.f90"])
+
+            # small files are read only once
+            with io.open(filename, "w") as f:
+                f.write(instring)
+            opened = []
+            io_open = io.open
+
+            def open_counted(file, mode="r", *args, **kwargs):
+                if file == filename and "r" in mode:
+                    opened.append(file)
+                return io_open(file, mode, *args, **kwargs)
+
+            io.open = open_counted
+            try:
+                self.assertTrue(fprettify.reformat_inplace(filename))
+            finally:
+                io.open = io_open
+            self.assertEqual(len(opened), 1)
+            with io.open(filename) as f:
+                self.assertEqual(f.read(), outstring_exp)
+
+    def test_stdout(self):
+        """formatted output is written to stdout only if formatting succeeds"""
+        instrings = ["program p\nx=1\nend program\n", "program p\nx=1\n!&>\n"]
+        outstrings_exp = ["program p\n   x = 1\nend program\n", ""]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "f.f90")
+            for instring, outstring_exp in zip(instrings, outstrings_exp):
+                with io.open(filename, "w") as f:
+                    f.write(instring)
+                for args, stdin in (([filename, "--stdout"], None), (["-"], instring)):
+                    p1 = subprocess.Popen(
+                        [RUNSCRIPT, "--no-cache"] + args,
+                        stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                    )
+                    outstring = p1.communicate((stdin or "").encode("UTF-8"))[0]
+                    self.assertEqual(p1.returncode, 0 if outstring_exp else 1)
+                    self.assertEqual(outstring.decode("UTF-8"), outstring_exp)
+
+    def test_line_range(self):
+        """only the Fortran lines overlapping a line range are formatted"""
+        instring = (
+            "module m\n"
+            "contains\n"
+            "subroutine s(a,b)\n"
+            "integer :: a,b\n"
+            "if(a==b)then\n"
+            "a=b+&\n"
+            "1; b=a\n"
+            "endif\n"
+            "end subroutine\n"
+            "end module\n"
+        )
+        outstring_exp = [
+            "      if (a == b) then\n",
+            "         a = b + &\n",
+            "             1; b = a\n",
+        ]
+
+        for start, end, first, last in ((5, 5, 5, 5), (6, 6, 6, 7), (5, 7, 5, 7)):
+            outfile = io.StringIO()
+            span = fprettify.reformat_ffile_range(
+                io.StringIO(instring), outfile, start, end, orig_filename="StringIO"
+            )
+            self.assertEqual(span, (first, last))
+            self.assertEqual(
+                outfile.getvalue(), "".join(outstring_exp[first - 5 : last - 4])
+            )
+
+        lines = instring.splitlines(True)
+        outfile = io.StringIO()
+        fprettify.reformat_ffile(
+            io.StringIO(instring),
+            outfile,
+            orig_filename="StringIO",
+            line_range=(7, 7),
+        )
+        self.assertEqual(
+            outfile.getvalue(), "".join(lines[:5] + outstring_exp[1:] + lines[7:])
+        )
+
+        p1 = subprocess.Popen(
+            [RUNSCRIPT, "--line-range", "5:5", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        outstring = p1.communicate(instring.encode("UTF-8"))[0].decode("UTF-8")
+        self.assertEqual(outstring, "".join(lines[:4] + outstring_exp[:1] + lines[5:]))
+
+        # closed blocks before the range do not change the result
+        instring = "module m\ncontains\n" + 50 * (
+            "subroutine s(a)\ninteger::a\ndo i=1,2;if(a>i)then\na=a+&\n1\n"
+            "endif;enddo\nselect case(a)\ncase(1)\na=2\nend select\n"
+            "end subroutine\n"
+        )
+        instring += "subroutine t(a)\nif(a>0)then\na=1\nendif\nend subroutine\n"
+        instring += "end module\n"
+        outfile = io.StringIO()
+        fprettify.reformat_ffile(
+            io.StringIO(instring), outfile, orig_filename="StringIO"
+        )
+        lines = outfile.getvalue().splitlines(True)
+        nlines = len(lines)
+        for start in (1, 15, 16, 500, nlines - 5, nlines - 3, nlines - 1):
+            outfile = io.StringIO()
+            first, last = fprettify.reformat_ffile_range(
+                io.StringIO(instring),
+                outfile,
+                start,
+                start + 1,
+                orig_filename="StringIO",
+            )
+            self.assertEqual(outfile.getvalue(), "".join(lines[first - 1 : last]))
+
+    def test_incremental(self):
+        """incremental formatting of edits gives the same result as formatting"""
+        instring = (
+            "module m\ncontains\nsubroutine s(a)\nreal :: a\ncall t(a)\n"
+            "a=a+1\nend subroutine\nsubroutine t(a)\nreal::a\nend subroutine\n"
+            "end module\n"
+        )
+        edits = [
+            (6, 6, "a=a+2\n"),
+            (5, 4, "if(a>0)then\n"),
+            (7, 6, "endif\n"),
+            (5, 5, ""),
+            (1, 0, "! comment\n"),
+            (3, 3, "contains; subroutine s(a)\n"),
+            (9, 9, "end subroutine s\n"),
+        ]
+
+        def reformat(instring):
+            outfile = io.StringIO()
+            fprettify.reformat_ffile(
+                io.StringIO(instring), outfile, orig_filename="StringIO"
+            )
+            return outfile.getvalue()
+
+        formatter = fprettify.IncrementalFormatter(instring)
+        outstring = reformat(instring)
+        self.assertEqual(formatter.get_text(), outstring)
+
+        for n, (start, end, text) in enumerate(edits):
+            if n == 4:
+                # edit that can't be formatted is not applied
+                with self.assertRaises(fprettify.FprettifyParseException):
+                    formatter.edit([(2, 2, "!&>\n")])
+                self.assertEqual(formatter.get_text(), outstring)
+
+            lines = outstring.splitlines(True)
+            outstring = reformat("".join(lines[: start - 1] + [text] + lines[end:]))
+            self.assertEqual(formatter.edit([(start, end, text)]), outstring)
+
+        # continuation at the end of the text
+        formatter = fprettify.IncrementalFormatter("x=1\n")
+        self.assertEqual(formatter.edit([(1, 1, "a=b+&\n")]), reformat("a=b+&\n"))
+        self.assertEqual(formatter.edit([(2, 1, "c\n")]), reformat("a = b +\nc\n"))
+
+        # edit changing scopes, formatting the result again would change it
+        with io.open(
+            joinpath(_MYPATH, "../../examples/in/example.f90"), encoding="utf-8"
+        ) as infile:
+            instring = infile.read()
+        formatter = fprettify.IncrementalFormatter(instring)
+        lines = reformat(instring).splitlines(True)
+        outstring = reformat("".join(lines[:117] + ["if(x>0)then\n"] + lines[117:]))
+        self.assertEqual(formatter.edit([(118, 117, "if(x>0)then\n")]), outstring)
+        lines = outstring.splitlines(True)
+        outstring = reformat("".join(lines[:3] + lines[4:]))
+        self.assertEqual(formatter.edit([(4, 4, "")]), outstring)
+
+    @unittest.skipIf(shutil.which("git") is None, "git not available")
+    def test_changed_since(self):
+        """only files (or lines) changed since a git revision are formatted"""
+        committed = "program p\ninteger :: a\ndo a=1,2\nprint*,a\nend do\nend program\n"
+        modified = committed.replace("end do\n", "a=a+1\nend do\n")
+        untracked = "module m\ninteger::a\nend module\n"
+        outstring_exp = [
+            modified.replace("a=a+1", "      a = a + 1"),
+            "module m\n   integer::a\nend module\n",
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            git = ["git", "-C", tmpdir, "-c", "user.name=u", "-c", "user.email=u@u"]
+            filenames = [os.path.join(tmpdir, "f{}.f90".format(n)) for n in range(3)]
+            for filename in filenames[::2]:
+                with io.open(filename, "w") as f:
+                    f.write(committed)
+            subprocess.check_call(git + ["init", "-q"])
+            subprocess.check_call(git + ["add", "."])
+            subprocess.check_call(git + ["commit", "-q", "-m", "init"])
+            with io.open(filenames[0], "w") as f:
+                f.write(modified)
+            with io.open(filenames[1], "w") as f:
+                f.write(untracked)
+            # only touched, not changed
+            mtime = os.stat(filenames[2]).st_mtime + 10
+            os.utime(filenames[2], (mtime, mtime))
+
+            p1 = subprocess.Popen(
+                [RUNSCRIPT, "--changed-since", "HEAD", "--hunks-only", "--no-cache"],
+                cwd=tmpdir,
+            )
+            p1.wait()
+            self.assertEqual(p1.returncode, 0)
+
+            for filename, outstring in zip(filenames, outstring_exp + [committed]):
+                with io.open(filename) as f:
+                    self.assertEqual(f.read(), outstring)
+
+            p1 = subprocess.Popen(
+                [RUNSCRIPT, "--changed-since", "HEAD", "--no-cache"], cwd=tmpdir
+            )
+            p1.wait()
+            self.assertEqual(p1.returncode, 0)
+            with io.open(filenames[2]) as f:
+                self.assertEqual(f.read(), committed)
+
+            p1 = subprocess.Popen(
+                [RUNSCRIPT, "--changed-since", "unknown-ref"],
+                cwd=tmpdir,
+                stderr=subprocess.DEVNULL,
+            )
+            p1.wait()
+            self.assertEqual(p1.returncode, 1)
+
+    def test_streaming_memory(self):
+        """peak memory use of formatting a file doesn't grow with its size"""
+        import tracemalloc
+
+        def source(n_blocks):
+            block = "x=1\n" + ("!" + "c" * 1000 + "\n") * 10
+            return "program p\n" + block * n_blocks + "end program\n"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "f.f90")
+            peaks = []
+            # first run is a warm-up
+            for n_blocks in (10, 10, 160):
+                with io.open(filename, "w") as f:
+                    f.write(source(n_blocks))
+                tracemalloc.start()
+                try:
+                    fprettify.reformat_inplace(filename)
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+
+            outfile = io.StringIO()
+            fprettify.reformat_ffile(
+                io.StringIO(source(160)), outfile, orig_filename="StringIO"
+            )
+            with io.open(filename) as f:
+                self.assertEqual(f.read(), outfile.getvalue())
+
+        size = len(source(160))
+        self.assertLess(peaks[2], size)
+        self.assertLess(peaks[2] - peaks[1], (size - len(source(10))) / 4)
+
+    def test_benchmark_corpus(self):
+        """benchmark scenarios are deterministic and can be formatted, micro-benchmarks run"""
+        from benchmarks.corpus import SCENARIOS, generate
+        from benchmarks.micro import MICRO_BENCHMARKS
+        from benchmarks.runner import run_benchmarks, run_micro_benchmarks
+
+        for scenario in SCENARIOS:
+            self.assertEqual(generate(scenario, 50), generate(scenario, 50))
+            self.assertNotEqual(generate(scenario, 50), generate(scenario, 50, seed=2))
+
+        results = run_benchmarks(list(SCENARIOS), ["case"], 50, repeat=1)
+        self.assertEqual([_["scenario"] for _ in results], list(SCENARIOS))
+        for result in results:
+            self.assertGreaterEqual(result["lines"], 50)
+            self.assertGreater(result["bytes_per_sec"], 0)
+
+        results = run_micro_benchmarks(list(MICRO_BENCHMARKS), repeat=1, sizes=[2])
+        self.assertEqual([_["benchmark"] for _ in results], list(MICRO_BENCHMARKS))
+        for result in results:
+            self.assertGreater(result["seconds"], 0)
+
+    def test_profile_phases(self):
+        """time per phase is measured while a profiler is active"""
+        instring = "program p\ninteger::a\nif(a>1)then\na=f(a)\nendif\nend program\n"
+        case_dict = {"keywords": 2, "procedures": 0, "operators": 0, "constants": 0}
+        format_single_fline = fprettify.format_single_fline_style
+
+        with fprettify.PhaseProfiler() as profiler:
+            with self.assertRaises(RuntimeError):
+                with fprettify.PhaseProfiler():
+                    pass
+            for instring_profiled in (instring, "#:set n = 1\n" + instring):
+                fprettify.reformat_ffile(
+                    io.StringIO(instring_profiled),
+                    io.StringIO(),
+                    case_dict=case_dict,
+                    orig_filename="StringIO",
+                )
+
+        self.assertIs(fprettify.format_single_fline_style, format_single_fline)
+        self.assertEqual(profiler.total(), sum(profiler.times.values()))
+        report = profiler.report()
+        for phase in profiler.calls:
+            self.assertGreater(report[phase]["calls"], 0, phase)
+            self.assertGreater(report[phase]["ns"], 0, phase)
+        # files with fypp directives are inspected in a separate pass
+        self.assertEqual(report["inspect_ffile_format"]["calls"], 1)
+        self.assertEqual(report["inspect_fline"]["calls"], 6 + 7)
+        self.assertIsNone(fprettify._scope_dispatchers)
+        self.assertGreater(report["scope_dispatch"]["hits"], 0)
+        self.assertLess(
+            report["scope_dispatch"]["hits"], report["scope_dispatch"]["lines"]
+        )
+
+        outfile = io.StringIO()
+        fprettify.profiling.write_table([("StringIO", profiler)], profiler, outfile)
+        self.assertIn("scope dispatch", outfile.getvalue())
+
+    def test_format_style(self):
+        """a FormatStyle gives the same result as the formatting options"""
+        instring = "program p\nif(a==b.and.c)then\nCALL f(a,b)\nendif\nend program\n"
+        options = dict(
+            indent_size=2,
+            whitespace=1,
+            whitespace_dict={"comma": False},
+            case_dict={"keywords": 2, "procedures": 0, "operators": 1, "constants": 0},
+        )
+        style = fprettify.FormatStyle(**options)
+        self.assertEqual(style, fprettify.FormatStyle(**options))
+        self.assertEqual(hash(style), hash(fprettify.FormatStyle(**options)))
+        self.assertNotEqual(style, style.replace(indent_size=3))
+        self.assertEqual(style, pickle.loads(pickle.dumps(style)))
+        self.assertEqual(style.spacey[0], 0)
+        self.assertEqual(len(style.rules), 1)
+        self.assertEqual(style.rules[0]("if(a==b)then"), "IF(a==b)THEN")
+        f_line = "if(a.EQ.b)then"
+        for rule in style.replace(impose_replacements=True, cstyle=True).rules:
+            f_line = rule(f_line)
+        self.assertEqual(f_line, "IF(a==  b)THEN")
+        self.assertEqual(style.replace(case_dict={}).rules, ())
+        with self.assertRaises(NotImplementedError):
+            fprettify.FormatStyle(whitespace=5)
+
+        outfile = io.StringIO()
+        fprettify.reformat_ffile(
+            io.StringIO(instring), outfile, orig_filename="StringIO", style=style
+        )
+        outfile_options = io.StringIO()
+        fprettify.reformat_ffile(
+            io.StringIO(instring), outfile_options, orig_filename="StringIO", **options
+        )
+        self.assertEqual(outfile.getvalue(), outfile_options.getvalue())
+        self.assertEqual(
+            fprettify.IncrementalFormatter(instring, style=style).get_text(),
+            outfile.getvalue(),
+        )
+
+        # formatting options of format_single_fline
+        f_line = "x=f(a,b)+1"
+        args = [[], [], fprettify.build_scope_parser(), "StringIO", 1]
+        self.assertEqual(
+            fprettify.format_single_fline(
+                f_line, 1, {"comma": False}, *args[:3], False, *args[3:]
+            ),
+            fprettify.format_single_fline_style(f_line, style, *args),
+        )
+
+    def test_line_cache(self):
+        """repeated Fortran lines are memoized unless they trigger messages"""
+        instring = "call timeset(routineN,handle)\nx=(a+b\n" * 3
+        instring = "program p\n" + instring + "end program\n"
+        logger = logging.getLogger("fprettify-logger")
+        line_cache = fprettify._line_cache
+
+        results = []
+        for cache in (fprettify._LineCache(16), None):
+            fprettify._line_cache = cache
+            counter = fprettify._LogRecordCounter()
+            logger.addHandler(counter)
+            level = logger.level
+            logger.setLevel(logging.INFO)
+            try:
+                outfile = io.StringIO()
+                fprettify.reformat_ffile(
+                    io.StringIO(instring), outfile, orig_filename="StringIO"
+                )
+            finally:
+                logger.setLevel(level)
+                logger.removeHandler(counter)
+                fprettify._line_cache = line_cache
+            results.append((outfile.getvalue(), counter.count))
+            if cache is not None:
+                self.assertEqual(cache.hits, 2)
+
+        self.assertGreater(results[0][1], 0)
+        self.assertEqual(results[0], results[1])
+
+    def test_line_store(self):
+        """formatted lines are stored persistently and looked up by later runs"""
+        from fprettify.cache import LineStore
+
+        instring = "program p\ninteger::a\na=f(a,1)+&\n2\nend program\n"
+        line_cache = fprettify._line_cache
+        fprettify._line_cache = None
+
+        def reformat(path, **kwargs):
+            store = LineStore(path, **kwargs)
+            fprettify._line_store = store
+            try:
+                outfile = io.StringIO()
+                fprettify.reformat_ffile(
+                    io.StringIO(instring), outfile, orig_filename="StringIO"
+                )
+            finally:
+                fprettify._line_store = None
+            store.close()
+            return store, outfile.getvalue()
+
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "lines.sqlite")
+                store, outstring = reformat(path)
+                self.assertEqual((store.hits, store.misses), (0, 4))
+                store, outstring_stored = reformat(path)
+                self.assertEqual((store.hits, store.misses), (4, 0))
+                self.assertEqual(outstring, outstring_stored)
+
+                LineStore(path, max_entries=1).evict()
+                store, _ = reformat(path)
+                self.assertEqual(store.hits, 1)
+                LineStore(path, max_age=-1).evict()
+                store, _ = reformat(path)
+                self.assertEqual(store.hits, 0)
+
+                # database with an incompatible schema is not used
+                path = os.path.join(tmpdir, "incompatible.sqlite")
+                conn = sqlite3.connect(path)
+                conn.execute("CREATE TABLE lines (key TEXT)")
+                conn.commit()
+                conn.close()
+                LineStore(path).evict()
+                store, outstring_stored = reformat(path)
+                self.assertEqual(outstring, outstring_stored)
+        finally:
+            fprettify._line_cache = line_cache
+
+    def test_slow_lines(self):
+        """the slowest Fortran lines are reported with their line numbers"""
+        instring = (
+            "program p\n"
+            "integer::a,b\n"
+            "a=1+&\n"
+            "2\n"
+            "b=" + "+".join(["a*(b-1)"] * 12) + "\n"
+            "end program\n"
+        )
+
+        with fprettify.SlowLines(3) as slow:
+            fprettify.reformat_ffile(
+                io.StringIO(instring), io.StringIO(), orig_filename="StringIO"
+            )
+        self.assertIsNone(fprettify._slow_lines)
+
+        lines = slow.lines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(sorted(lines, reverse=True), lines)
+        locations = {(line[1], line[2], line[3]) for line in lines}
+        for ns, filename, line_nr, n_lines, n_chars in lines:
+            self.assertGreater(ns, 0)
+            self.assertGreater(n_chars, 0)
+        all_lines = {("StringIO", i + 1, 1) for i in range(6)}
+        all_lines.remove(("StringIO", 4, 1))
+        all_lines.remove(("StringIO", 3, 1))
+        all_lines.add(("StringIO", 3, 2))
+        self.assertLessEqual(locations, all_lines)
+
+    def test_daemon(self):
+        """formatting by the daemon gives the same output as fprettify"""
+        import fprettify_client
+        from fprettify.daemon import FormatServer
+
+        instring = "program p\nx=1+2\nend program\n"
+        outstring_exp = "program p\n   x = 1 + 2\nend program\n"
+
+        def request(argv, stdin=None):
+            sock = fprettify_client.connect(socket_path)
+            return fprettify_client.request(sock, ["fprettify"] + argv, stdin)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, "run", "fprettifyd.sock")
+            filename = os.path.join(tmpdir, "f.f90")
+            with io.open(filename, "w") as f:
+                f.write(instring)
+
+            server = FormatServer(socket_path)
+            # socket is created in a private directory
+            mode = os.stat(os.path.dirname(socket_path)).st_mode
+            self.assertEqual(mode & 0o777, 0o700)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                # the second request is served from memoized results
+                for _ in range(2):
+                    response = request(["--stdout", "--no-cache", filename])
+                    self.assertEqual(response["status"], 0)
+                    self.assertEqual(response["stdout"], outstring_exp)
+
+                response = request(["-"], io.StringIO(instring))
+                self.assertEqual(response["stdout"], outstring_exp)
+
+                response = request(["--check", "--no-cache", filename])
+                self.assertEqual(response["status"], 1)
+                self.assertEqual(response["stdout"], filename + "\n")
+
+                # results with messages are not memoized, even if not shown
+                long_line = "program p\nprint*,'{}'\nend program\n".format("a" * 200)
+                response = request(["-S", "-"], io.StringIO(long_line))
+                self.assertEqual(response["stderr"], "")
+                response = request(["-"], io.StringIO(long_line))
+                self.assertIn("chars limit", response["stderr"])
+
+                response = request(["--no-such-option"])
+                self.assertEqual(response["status"], 2)
+                self.assertIn("--no-such-option", response["stderr"])
+
+                with self.assertRaises(RuntimeError):
+                    FormatServer(socket_path)
+
+                # neither client nor server trust a socket that others can replace
+                os.chmod(os.path.dirname(socket_path), 0o777)
+                with self.assertRaises(PermissionError):
+                    fprettify_client.connect(socket_path)
+                with self.assertRaises(RuntimeError):
+                    FormatServer(socket_path)
+                os.chmod(os.path.dirname(socket_path), 0o700)
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+            self.assertFalse(os.path.exists(socket_path))
+
+            # a file that is not a socket is not replaced
+            with io.open(socket_path, "w") as f:
+                f.write("")
+            with self.assertRaises(RuntimeError):
+                FormatServer(socket_path)
+            self.assertTrue(os.path.isfile(socket_path))
+
+    def test_import_time(self):
+        """import of fprettify is cheap and has no side effects"""
+        # budget for the self time of fprettify modules in microseconds, generous
+        # enough for sources that are not byte-compiled
+        budget = 150000
+        code = (
+            "import sys\n"
+            "stdio = (sys.stdin, sys.stdout)\n"
+            "import fprettify\n"
+            "assert (sys.stdin, sys.stdout) == stdio, 'stdio replaced'\n"
+            "assert 'configargparse' not in sys.modules, 'configargparse imported'\n"
+            "assert 'sqlite3' not in sys.modules, 'sqlite3 imported'\n"
+            "assert 'search' not in vars(fprettify.VAR_DECL_RE), 'regex compiled'\n"
+        )
+        p = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.assertEqual(p.returncode, 0, p.stderr)
+
+        self_time = 0
+        for line in p.stderr.splitlines():
+            if line.startswith("import time:"):
+                us, _, name = line[len("import time:") :].split("|")
+                if name.strip().startswith("fprettify"):
+                    self_time += int(us)
+        self.assertGreater(self_time, 0)
+        self.assertLess(self_time, budget)
+
+    def test_cache(self):
+        """files known to be formatted are skipped"""
+        from fprettify.cache import FormatCache, file_digest
+
+        instring = "program p\nx=1+2\nend program\n"
+        outstring_exp = "program p\n   x = 1 + 2\nend program\n"
+
+        parser = fprettify.get_arg_parser()
+        file_args = fprettify.process_args(parser.parse_args([]))
+        file_args.update(stdout=False, diffonly=False)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, "cache")
+            filename = os.path.join(tmpdir, "f.f90")
+            with io.open(filename, "w") as f:
+                f.write(instring)
+
+            jobs = [(filename, file_args)]
+            self.assertEqual(fprettify.reformat_files(jobs, cache_dir=cache_dir), 0)
+            self.assertEqual(fprettify.reformat_files(jobs, cache_dir=cache_dir), 0)
+
+            cache = FormatCache(cache_dir)
+            style = cache.style_key(file_args, logging.WARNING)
+            self.assertEqual(cache.is_formatted(filename, style), (True, None))
+
+            # same content in a different file is found by its hash
+            filename_copy = os.path.join(tmpdir, "g.f90")
+            shutil.copyfile(filename, filename_copy)
+            self.assertTrue(cache.is_formatted(filename_copy, style)[0])
+
+            # unformatted file wrongly recorded as formatted is not touched
+            with io.open(filename, "w") as f:
+                f.write(instring)
+            stat = os.stat(filename)
+            cache.add(filename, style, file_digest(filename), stat)
+            cache.close()
+            fprettify.reformat_files(jobs, cache_dir=cache_dir)
+            with io.open(filename) as f:
+                self.assertEqual(f.read(), instring)
+
+            fprettify.reformat_files(jobs)
+            with io.open(filename) as f:
+                self.assertEqual(f.read(), outstring_exp)
+
+            # an incompatible database disables the cache but not formatting
+            for name in os.listdir(cache_dir):
+                if name != ".gitignore":
+                    os.remove(os.path.join(cache_dir, name))
+            conn = sqlite3.connect(os.path.join(cache_dir, "cache.sqlite"))
+            conn.execute("CREATE TABLE files (path TEXT)")
+            conn.execute("CREATE TABLE digests (style TEXT)")
+            conn.commit()
+            conn.close()
+            with io.open(filename, "w") as f:
+                f.write(instring)
+            self.assertEqual(fprettify.reformat_files(jobs, cache_dir=cache_dir), 0)
+            with io.open(filename) as f:
+                self.assertEqual(f.read(), outstring_exp)
+
+            # the cache is kept in the per-user cache directory by default
+            env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmpdir, "xdg"))
+            p1 = subprocess.Popen([RUNSCRIPT, "f.f90"], cwd=tmpdir, env=env)
+            p1.wait()
+            self.assertEqual(p1.returncode, 0)
+            self.assertTrue(os.path.isdir(os.path.join(tmpdir, "xdg", "fprettify")))
+            self.assertEqual(
+                sorted(os.listdir(tmpdir)), ["cache", "f.f90", "g.f90", "xdg"]
+            )
+
+    def test_inspect_inline(self):
+        """single pass inspection of indentation gives same result as separate passes"""
+        instring = (
+            "program p\n"
+            "  integer :: i\n"
+            "  do i=1,3 ; print *,i\n"
+            "  if(i>1)then\n"
+            "    x=1\n"
+            "  endif\n"
+            "  enddo\n"
+            "10 continue\n"
+            "end program\n"
+        )
+
+        parser = fprettify.get_arg_parser()
+        for args in ([], ["--strict-indent"], ["-i", "2", "-w", "4"]):
+            file_args = fprettify.process_args(parser.parse_args(args))
+            ws_args = dict(file_args, impose_indent=False, orig_filename="StringIO")
+            ind_args = dict(
+                file_args, impose_whitespace=False, orig_filename="StringIO"
+            )
+            ind_args.update(impose_replacements=False)
+
+            tmpfile = io.StringIO()
+            outfile = io.StringIO()
+            fprettify.reformat_ffile_combined(io.StringIO(instring), tmpfile, **ws_args)
+            fprettify.reformat_ffile_combined(tmpfile, outfile, **ind_args)
+
+            outfile_inline = io.StringIO()
+            fprettify.reformat_ffile(
+                io.StringIO(instring),
+                outfile_inline,
+                orig_filename="StringIO",
+                **file_args
+            )
+            self.assertEqual(outfile_inline.getvalue(), outfile.getvalue())
+
+    def test_long_string(self):
+        """long strings and fypp expressions are not parsed character-wise"""
+        long_str = "a" * 1000
+        instring = "x='" + long_str + "';y=1\nz=${" + long_str + "}$+1\n"
+        outstring_exp = "x = '" + long_str + "'; y = 1\nz = ${" + long_str + "}$+1\n"
+
+        self.assert_fprettify_result(["-l", "0"], instring, outstring_exp)
+
+    def test_long_array_constructor(self):
+        """whitespace formatting of long continued array constructors"""
+        elements = ["a(%d)%%b,%d" % (i, i) for i in range(2000)]
+        instring = "x=(/" + ",&\n".join(elements) + "/)\n"
+        elements_exp = ["a(%d)%%b, %d" % (i, i) for i in range(2000)]
+        outstring_exp = "x = (/" + ", &\n      ".join(elements_exp) + "/)\n"
+
+        self.assert_fprettify_result([], instring, outstring_exp)
+
+    def test_literal_list(self):
+        """lists of numeric literals in array constructors and data statements"""
+        instring = (
+            "real(dp),parameter::c(6)=(/1.0d0,- 2.5E-3_dp , &\n"
+            "+.5,3 ,&\n"
+            "  -1.e+2,7/)\n"
+            "data d/1,-2 , 3.0d+1/\n"
+            "x=[1.5q-2,2]\n"
+        )
+        outstring_exp = (
+            "real(dp), parameter::c(6) = (/1.0d0, -2.5E-3_dp, &\n"
+            "                              +.5, 3, &\n"
+            "                              -1.e+2, 7/)\n"
+            "data d/1, -2, 3.0d+1/\n"
+            "x = [1.5q - 2, 2]\n"
+        )
+        self.assert_fprettify_result([], instring, outstring_exp)
+
+    def test_scope_dispatch(self):
+        """only scope parsers matching the leading keyword are tried"""
+        scope_parser = fprettify.build_scope_parser()
+        dispatcher = fprettify.ScopeDispatcher(scope_parser)
+
+        for line in ("x = 1", "call foo(a, b)", "integer :: i", "print *, 'if'"):
+            candidates = dispatcher.candidates(line)
+            self.assertFalse(any(candidates.values()))
+        self.assertEqual((dispatcher.n_hits, dispatcher.n_lines), (4, 4))
+
+        for line, kind in (
+            ("outer: DO i = 1, n", "new"),
+            ("elemental function f(x) result(y)", "new"),
+            ("ELSEIF (x) THEN", "continue"),
+            ("  enddo outer", "end"),
+            ("#:endif", "end"),
+        ):
+            candidates = dispatcher.candidates(line)
+            self.assertTrue(
+                any(scope_parser[kind][n].search(line) for n in candidates[kind])
+            )
+        self.assertEqual((dispatcher.n_hits, dispatcher.n_lines), (4, 9))
+
+    def test_statement_info(self):
+        """classification of Fortran lines shared by all formatting stages"""
+        scope_parser = fprettify.build_scope_parser()
+        dispatcher = fprettify.ScopeDispatcher(scope_parser)
+
+        for line, kind, label in (
+            ("outer: DO i = 1, n", "new", "outer"),
+            ("check: if (x) then", "new", "check"),
+            ("else", "continue", None),
+            ("end do outer", "end", None),
+            ("use mod, only: a", "use", None),
+            ("integer, intent(in) :: n", "decl", None),
+            ("namelist /nml/ a, b", "namelist", None),
+            ("data x/1, 2/", "data", None),
+            ("x = 'do i = 1, n'", None, None),
+        ):
+            info = fprettify.StatementInfo(line, scope_parser, dispatcher)
+            self.assertEqual(info.kind, kind)
+            self.assertEqual(info.construct_label, label)
+            self.assertEqual(info.is_end, kind == "end")
+
+        # attributes are determined once
+        info = fprettify.StatementInfo("call k<<<1, 2>>>(a)", scope_parser)
+        self.assertTrue(info.is_cuda)
+        self.assertFalse(info.is_decl)
+        self.assertEqual(info.scopes, {"new": [], "continue": [], "end": []})
+        self.assertIs(info.scopes, info.scopes)
+        with self.assertRaises(AttributeError):
+            info.unknown
+
+    def test_long_lines(self):
+        """regexes recognizing statements take linear time on long lines"""
+        # budget in seconds for lines of about 20000 characters, generous enough
+        # for slow machines but exceeded by regexes that backtrack quadratically
+        budget = 0.25
+        n = 20000
+        multdiv = fprettify.LR_OPS_RE[3]
+
+        for regex, line, match in (
+            (fprettify.VAR_DECL_RE, "real(" + "a" * n + ")", True),
+            (fprettify.VAR_DECL_RE, "real(" + "a b " * (n // 4) + ") :: x", True),
+            (fprettify.TYPE_RE, "type" + ", extends(a)" * (n // 12) + " ::", False),
+            (fprettify.TYPE_RE, "type,extends(a)" + ", public" * (n // 8) + " t", True),
+            (fprettify.USE_RE, "use m, a=>b" + ", c" * (n // 3), True),
+            (fprettify.USE_RE, "use m, only: a" + ", c" * (n // 3), True),
+            (fprettify.USE_RE, "use m" + ", c" * (n // 3), False),
+            (fprettify.IF_RE, "if (x) then" + " " * n + "y", False),
+            (fprettify.STATEMENT_LABEL_RE, "10 " + " " * n + "x", True),
+            (fprettify.IF_RE, "if (" + "a) .and. (b" * (n // 11) + ") then", True),
+        ):
+            start = time.perf_counter()
+            self.assertEqual(bool(regex.search(line)), match)
+            self.assertLess(time.perf_counter() - start, budget, regex)
+
+        # * and / are split except before :: (the trailing / is not an operator),
+        # longer lines as the quadratic lookahead for :: used to be cheap per step
+        for line, n_ops in (
+            ("x = " + "a*b/" * (n // 2), n - 1),
+            ("real*8 :: x = " + "a*b/" * (n // 2), n - 1),
+            ("a" + "*b" * n + " :: x", 0),
+        ):
+            start = time.perf_counter()
+            partsplit = multdiv.split(line)
+            self.assertLess(time.perf_counter() - start, budget)
+            self.assertEqual(len(partsplit), 2 * n_ops + 1)
+            self.assertEqual("".join(partsplit), line)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+#    This file is part of fprettify.
+#    Copyright (C) 2016-2019 Patrick Seewald, CP2K developers group
+#
+#    fprettify is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    fprettify is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with fprettify. If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+"""
+Thin client of the fprettify daemon (fprettifyd), takes the same arguments as
+fprettify. If no daemon is running, files are formatted in process.
+
+This module is kept separate from the fprettify package and imports it only
+if needed, so that a request to a running daemon costs hardly more than
+starting the Python interpreter.
+
+Protocol: each message is a JSON object on a single line. The client sends
+{"argv": [...], "cwd": ...}, the daemon answers with
+{"status": ..., "stdout": ..., "stderr": ...}. If the daemon needs to read
+from stdin, it first sends {"stdin": true} and the client answers with
+{"stdin": ...}.
+
+The socket is only used if it and its directory are owned by the current user
+and the directory is not writable by others. Where supported, client and
+daemon also check the user of the peer process.
+"""
+
+import io
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+
+def socket_directory():
+    """private directory of the daemon socket of the current user"""
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if directory:
+        return os.path.join(directory, "fprettifyd")
+    import tempfile
+
+    return os.path.join(tempfile.gettempdir(), "fprettifyd-{}".format(os.getuid()))
+
+
+def default_socket_path():
+    """socket of the daemon of the current user"""
+    if os.environ.get("FPRETTIFYD_SOCKET"):
+        return os.environ["FPRETTIFYD_SOCKET"]
+    return os.path.join(socket_directory(), "fprettifyd.sock")
+
+
+def check_directory(directory):
+    """
+    raise PermissionError unless `directory` is owned by the current user and
+    not writable by others (so that nobody else can replace the socket)
+    """
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(
+            "{} is not a directory of the current user".format(directory)
+        )
+    if st.st_mode & 0o022:
+        raise PermissionError("{} is writable by others".format(directory))
+
+
+def check_socket(socket_path):
+    """
+    raise PermissionError unless `socket_path` is a socket of the current user
+    in a directory checked by `check_directory`
+    """
+    check_directory(os.path.dirname(os.path.abspath(socket_path)))
+    st = os.lstat(socket_path)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(
+            "{} is not a socket of the current user".format(socket_path)
+        )
+
+
+def peer_uid(sock):
+    """user id of the process connected to Unix socket `sock`, None if unknown"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    return struct.unpack("3i", creds)[1]
+
+
+def send_message(wfile, message):
+    """send a message (dict) to binary file-like object `wfile`"""
+    wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+    wfile.flush()
+
+
+def receive_message(rfile):
+    """receive a message from binary file-like object `rfile`, None if closed"""
+    line = rfile.readline()
+    return json.loads(line.decode("utf-8")) if line else None
+
+
+def connect(socket_path=None):
+    """
+    connect to daemon, raises OSError if no daemon is running and
+    PermissionError if the socket or the daemon belong to another user
+    """
+    socket_path = socket_path or default_socket_path()
+    check_socket(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        if peer_uid(sock) not in (None, os.getuid()):
+            raise PermissionError(
+                "daemon on {} is run by another user".format(socket_path)
+            )
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def request(sock, argv, stdin=None):
+    """
+    let the daemon connected to `sock` run fprettify with command line `argv`
+    in the current directory, returns the daemon's response.
+    """
+    with sock, sock.makefile("rb") as rfile, sock.makefile("wb") as wfile:
+        send_message(wfile, {"argv": list(argv), "cwd": os.getcwd()})
+        while True:
+            message = receive_message(rfile)
+            if message is None:
+                raise ConnectionError("connection closed by fprettify daemon")
+            if "stdin" not in message:
+                return message
+            if stdin is None:
+                stdin = io.TextIOWrapper(sys.stdin.buffer, encoding="UTF-8")
+            send_message(wfile, {"stdin": stdin.read()})
+
+
+def main(argv=None):
+    """command line interface"""
+    if argv is None:
+        argv = sys.argv
+
+    try:
+        sock = connect()
+    except OSError as e:
+        if isinstance(e, PermissionError):
+            sys.stderr.write("fprettify-client: daemon not used: {}\n".format(e))
+        from fprettify import run
+
+        run(argv)
+        return
+
+    response = request(sock, argv)
+    sys.stdout.buffer.write(response["stdout"].encode("utf-8"))
+    sys.stdout.flush()
+    sys.stderr.write(response["stderr"])
+    sys.exit(response["status"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
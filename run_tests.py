@@ -50,7 +50,7 @@ if __name__ == "__main__":
         "-s",
         "--suite",
         nargs="+",
-        choices=["unittests", "builtin", "regular", "cron", "custom"],
+        choices=["unittests", "builtin", "regular", "cron", "custom", "bench"],
         default=["unittests", "builtin"],
         help="select suite.",
     )
@@ -63,6 +63,9 @@ if __name__ == "__main__":
         test_cases.append(generate_suite(name=args.name))
     else:
         for suite in args.suite:
+            if suite == "bench":
+                # benchmarks are run after the tests
+                continue
             if suite == "unittests":
                 test_cases.append(FprettifyUnitTestCase)
             else:
@@ -89,4 +92,9 @@ if __name__ == "__main__":
 
         os.remove(FAILED_FILE)
 
+    if "bench" in args.suite and not args.name:
+        from benchmarks.runner import main as run_benchmarks
+
+        run_benchmarks([])
+
     sys.exit(0 if result.wasSuccessful() else 1)